@@ -104,6 +104,7 @@ setup(
         "fastjsonschema>=2.15.3",
         "filetype>=1.0.7",
         "h3>=4.2.2",
+        "numpy>=1.20",
         "Pillow>=8.0",
         "pyyaml",
         "requests>=2.24.0",
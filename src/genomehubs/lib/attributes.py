@@ -6,6 +6,7 @@ import sys
 
 from genomehubs.vendor.tolkein import tolog
 
+from .es_functions import bulk_options
 from .es_functions import index_stream
 from .es_functions import load_mapping
 from .es_functions import stream_template_search_results
@@ -123,7 +124,7 @@ def index_types(es, types_name, types, opts, *, dry_run=False):
                 stream,
                 dry_run=dry_run,
                 log=opts.get("log-es", True),
-                chunk_size=opts.get("es-batch", 500),
+                **bulk_options(opts, refresh=True),
             )
     if "identifiers" in types:
         if "defaults" in types and "identifiers" in types["defaults"]:
@@ -143,7 +144,7 @@ def index_types(es, types_name, types, opts, *, dry_run=False):
             stream,
             dry_run=dry_run,
             log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
+            **bulk_options(opts),
         )
     if "taxon_names" in types:
         if "defaults" in types and "taxon_names" in types["defaults"]:
@@ -163,7 +164,7 @@ def index_types(es, types_name, types, opts, *, dry_run=False):
             stream,
             dry_run=dry_run,
             log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
+            **bulk_options(opts),
         )
     return types
 
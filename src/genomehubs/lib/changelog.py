@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""Record taxon IDs that receive new attribute values during indexing."""
+
+from genomehubs.vendor.tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+
+
+def record_changed_taxa(docs, changed):
+    """Add IDs of taxa with attributes to a set as docs are streamed."""
+    for doc_id, doc in docs:
+        if doc.get("attributes"):
+            changed.add(doc["taxon_id"])
+        yield doc_id, doc
+
+
+def write_change_log(path, taxon_ids):
+    """Append taxon IDs to a change log file."""
+    if not taxon_ids:
+        return
+    with open(path, "a") as fh:
+        for taxon_id in sorted(taxon_ids):
+            fh.write(f"{taxon_id}\n")
+    LOGGER.info("Recorded %d changed taxa in %s", len(taxon_ids), path)
+
+
+def read_change_log(path):
+    """Read the set of taxon IDs in a change log file."""
+    taxon_ids = set()
+    with open(path) as fh:
+        for line in fh:
+            taxon_id = line.strip()
+            if taxon_id and not taxon_id.startswith("#"):
+                taxon_ids.add(taxon_id)
+    return taxon_ids
@@ -1,41 +1,118 @@
 #!/usr/bin/env python3
 """Elasticsearch functions."""
 
+import contextlib
+import heapq
+import io
+import json
 import logging
 import os
 import platform
 import signal
 import sys
+import threading
 import time
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
+from queue import Full
+from queue import Queue
 from subprocess import PIPE
 from subprocess import Popen
 
 import ujson
-from elasticsearch import ConflictError
+from elasticsearch import ApiError
+from elasticsearch import ConnectionError as ESConnectionError
+from elasticsearch import ConnectionTimeout
 from elasticsearch import Elasticsearch
 from elasticsearch import NotFoundError
+from elasticsearch import SerializationError
+from elasticsearch import TransportError
 from elasticsearch import client
-from elasticsearch import helpers
 from tqdm import tqdm
 
 from genomehubs.vendor.tolkein import tofile
 from genomehubs.vendor.tolkein import tolog
 
 LOGGER = tolog.logger(__name__)
+MAX_CHUNK_BYTES = 100 * 1024 * 1024
+MIN_CHUNK_BYTES = 64 * 1024
+ADAPTIVE_MAX_DOCS = 10000
+BACKPRESSURE_STATUS = {413, 429, 503, 504}
+FAST_BULK_SECONDS = 1
+SLOW_BULK_SECONDS = 10
+BULK_RETRIES = 5
+BULK_INITIAL_BACKOFF = 2
+BULK_MAX_BACKOFF = 600
+BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": 0}
+BULK_LOAD = {"targets": set(), "saved": {}}
+SEARCH_PAGE_SIZE = 1000
+CONNECTIONS_PER_NODE = 10
+CLIENTS = {}
+INDEX_CACHE = {}
+MSEARCH_BATCH_SIZE = 100
+MSEARCH_THREADS = 4
+MAX_SEARCH_PAGE_SIZE = 10000
+PIT_KEEP_ALIVE = "5m"
+
+
+def es_hosts(opts):
+    """List Elasticsearch host URLs from options."""
+    return [
+        host if host.startswith(("http://", "https://")) else f"http://{host}"
+        for host in opts["es-host"]
+    ]
+
+
+def client_options(opts):
+    """Set Elasticsearch client connection options."""
+    options = {
+        "request_timeout": 1800,
+        "max_retries": 10,
+        "retry_on_timeout": True,
+        "connections_per_node": int(opts.get("es-connections", CONNECTIONS_PER_NODE)),
+        "http_compress": bool(opts.get("es-compress", False)),
+        "node_selector_class": "round_robin",
+    }
+    if opts.get("es-sniff", False):
+        options.update(
+            {
+                "sniff_on_start": True,
+                "sniff_on_node_failure": True,
+                "min_delay_between_sniffing": 60,
+            }
+        )
+    return options
+
+
+def clear_clients():
+    """Discard cached Elasticsearch clients, e.g. in a forked child process."""
+    CLIENTS.clear()
+
+
+os.register_at_fork(after_in_child=clear_clients)
+
+
+def es_client(opts):
+    """Get a pooled Elasticsearch client, cached once per process."""
+    hosts = es_hosts(opts)
+    options = client_options(opts)
+    key = (tuple(hosts), tuple(sorted(options.items())))
+    if key not in CLIENTS:
+        CLIENTS[key] = Elasticsearch(hosts=hosts, **options)
+    return CLIENTS[key]
 
 
 def test_connection(opts, *, log=False):
     """Test connection to Elasticsearch."""
-    connected = False
-    host = opts["es-host"][0]
-    host = f"http://{host}"
-    hosts = [host]
-    # with tolog.DisableLogger():
-    # try:
-    es = Elasticsearch(hosts=hosts, timeout=1800, max_retries=10, retry_on_timeout=True)
-    connected = es.info()
-    #   pass
+    hosts = es_hosts(opts)
+    try:
+        es = es_client(opts)
+        with tolog.DisableLogger():
+            connected = es.info()
+    except TransportError:
+        connected = False
     # sourcery skip: no-conditionals-in-tests
     if not connected:
         message = f"""Could not connect to Elasticsearch at '{", ".join(hosts)}'"""
@@ -140,22 +217,41 @@ def launch_es(opts, log=True):
     return es
 
 
+def invalidate_index_cache(index_name=None):
+    """Remove an index, or all indices, from the index metadata cache."""
+    if index_name is None:
+        INDEX_CACHE.clear()
+    else:
+        INDEX_CACHE.pop(index_name, None)
+
+
 def index_exists(es, index_name):
-    """Test if Elasticsearch index exists."""
+    """Test if Elasticsearch index exists.
+
+    Indices found to exist are cached for the session so repeated lookups do
+    not need a request.
+    """
+    if INDEX_CACHE.get(index_name, False):
+        return True
     es_client = client.IndicesClient(es)
     with tolog.DisableLogger():
         res = es_client.exists(index=index_name)
+    if res:
+        INDEX_CACHE[index_name] = True
     return res
 
 
 def index_create(es, index_name):
     """Create an Elasticsearch index if it does not already exist."""
     es_client = client.IndicesClient(es)
+    invalidate_index_cache(index_name)
     res = index_exists(es, index_name)
     if not res:
         LOGGER.info(f"Creating index '{index_name}'")
         with tolog.DisableLogger():
             res = es_client.create(index=index_name)
+        if index_name in BULK_LOAD["targets"]:
+            apply_bulk_load_settings(es, index_name)
         # Verify the created index has correct mapping
         try:
             mapping = es_client.get_mapping(index=index_name)
@@ -229,6 +325,324 @@ def get_size(obj, seen=None):
     return size
 
 
+def bulk_options(opts, *, refresh=None):
+    """Set bulk indexing keyword arguments from command line/config options.
+
+    Indices are refreshed after each call to index_stream unless
+    es-skip-refresh or es-bulk-load is set. Pass refresh=True where indexed
+    documents must be searchable immediately.
+    """
+    if refresh is None:
+        refresh = not (opts.get("es-skip-refresh") or opts.get("es-bulk-load"))
+    target_bytes = opts.get("es-chunk-bytes", None)
+    dead_letter = opts.get("es-dead-letter", None)
+    if dead_letter is None and "hub-path" in opts:
+        dead_letter = os.path.join(opts["hub-path"], "dead_letter.jsonl")
+    return {
+        "chunk_size": int(opts.get("es-batch", 500)),
+        "threads": int(opts.get("es-threads", 1)),
+        "max_chunk_bytes": int(opts.get("es-max-bytes", MAX_CHUNK_BYTES)),
+        "target_bytes": int(target_bytes) if target_bytes else None,
+        "dead_letter": dead_letter,
+        "refresh": refresh,
+    }
+
+
+def search_page_size(opts):
+    """Get page size for streaming search results from options."""
+    return int(opts.get("es-page-size", SEARCH_PAGE_SIZE))
+
+
+def msearch_options(opts):
+    """Set multi search batching options from config."""
+    return {
+        "batch_size": int(opts.get("es-msearch-batch", MSEARCH_BATCH_SIZE)),
+        "threads": int(opts.get("es-msearch-threads", MSEARCH_THREADS)),
+    }
+
+
+def search_slices(opts):
+    """Get number of parallel slices for streaming search results from options."""
+    return int(opts.get("es-slices", 1))
+
+
+class BulkChunkSizer:
+    """Class for setting bulk chunk limits from Elasticsearch responses."""
+
+    def __init__(
+        self, *, chunk_size=500, max_chunk_bytes=MAX_CHUNK_BYTES, target_bytes=None
+    ):
+        """Init BulkChunkSizer class.
+
+        Chunks are limited to chunk_size documents and max_chunk_bytes unless
+        target_bytes is set, in which case chunks are built to a target size
+        that shrinks under backpressure and grows while requests are fast.
+        """
+        self.adaptive = target_bytes is not None
+        self.max_bytes = max_chunk_bytes
+        if self.adaptive:
+            self.max_docs = max(ADAPTIVE_MAX_DOCS, chunk_size)
+            self.target_bytes = max(MIN_CHUNK_BYTES, min(target_bytes, max_chunk_bytes))
+        else:
+            self.max_docs = chunk_size
+            self.target_bytes = max_chunk_bytes
+        self.sizes = []
+        self._lock = threading.Lock()
+
+    def fits(self, docs, size):
+        """Test whether a chunk of docs and size bytes is within limits."""
+        return docs <= self.max_docs and size <= self.target_bytes
+
+    def shrink(self, factor=0.5):
+        """Reduce the target chunk size."""
+        if self.adaptive:
+            with self._lock:
+                self.target_bytes = max(
+                    MIN_CHUNK_BYTES, int(self.target_bytes * factor)
+                )
+
+    def record(self, docs, size, latency):
+        """Record a successful request and adjust the target chunk size."""
+        with self._lock:
+            self.sizes.append((docs, size))
+            if not self.adaptive:
+                return
+            if latency < FAST_BULK_SECONDS:
+                self.target_bytes = min(self.max_bytes, int(self.target_bytes * 1.5))
+            elif latency > SLOW_BULK_SECONDS:
+                self.target_bytes = max(MIN_CHUNK_BYTES, int(self.target_bytes * 0.75))
+
+    def report(self, index_name):
+        """Log a summary of chunk sizes sent to an index."""
+        if not self.sizes:
+            return
+        docs = sorted(entry[0] for entry in self.sizes)
+        size = sorted(entry[1] for entry in self.sizes)
+        LOGGER.info(
+            "Wrote %d documents (%d bytes) to '%s'", sum(docs), sum(size), index_name
+        )
+        log = LOGGER.info if self.adaptive else LOGGER.debug
+        log(
+            "Sent %d bulk requests to '%s' (docs per request min/median/max %d/%d/%d, "
+            "bytes per request min/median/max %d/%d/%d, final target %d bytes)",
+            len(self.sizes),
+            index_name,
+            docs[0],
+            docs[len(docs) // 2],
+            docs[-1],
+            size[0],
+            size[len(size) // 2],
+            size[-1],
+            self.target_bytes,
+        )
+
+
+def is_backpressure(err):
+    """Test whether an Elasticsearch error means requests should be smaller."""
+    if isinstance(err, ConnectionTimeout):
+        return True
+    return isinstance(err, ApiError) and err.status_code in BACKPRESSURE_STATUS
+
+
+def bulk_backoff(attempt):
+    """Wait before retrying a bulk request."""
+    time.sleep(min(BULK_MAX_BACKOFF, BULK_INITIAL_BACKOFF * 2**attempt))
+
+
+class DeadLetterFile:
+    """Class for recording documents that could not be indexed."""
+
+    def __init__(self, path=None):
+        """Init DeadLetterFile class."""
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, action, error, *, status=None):
+        """Record a failed action, returning an (ok, response) tuple."""
+        op_type = action["_op_type"]
+        info = {"_index": action["_index"], "_id": action["_id"], "status": status}
+        if isinstance(error, ApiError):
+            info["status"] = error.status_code
+            error = error.info
+        elif isinstance(error, Exception):
+            error = str(error)
+        info["error"] = error
+        size = get_size(action)
+        LOGGER.warning(
+            "Unable to index document %s (%d bytes): %s", action["_id"], size, error
+        )
+        with self._lock:
+            self.count += 1
+            if self.path is not None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as fh:
+                    fh.write(
+                        json.dumps(
+                            {
+                                **info,
+                                "_op_type": op_type,
+                                "size": size,
+                                "document": action.get(
+                                    "_source", action.get("doc", action.get("script"))
+                                ),
+                            },
+                            default=str,
+                        )
+                    )
+                    fh.write("\n")
+        return False, {op_type: info}
+
+
+def serialise_action(action, serializer):
+    """Convert a bulk action to NDJSON bytes."""
+    op_type = action["_op_type"]
+    header = {op_type: {"_index": action["_index"], "_id": action["_id"]}}
+    if op_type == "index":
+        body = action["_source"]
+    elif "script" in action:
+        body = {"script": action["script"]}
+    else:
+        body = {"doc": action["doc"]}
+    return b"%s\n%s\n" % (serializer.dumps(header), serializer.dumps(body))
+
+
+def chunk_actions(es, actions, sizer, dead_letter):
+    """Group bulk actions into chunks within the current sizer limits.
+
+    Yields (chunk, failures) tuples, where failures holds responses for
+    actions that could not be serialised.
+    """
+    serializer = es.transport.serializers.get_serializer("application/json")
+    chunk = []
+    failures = []
+    size = 0
+    for action in actions:
+        try:
+            data = serialise_action(action, serializer)
+        except (SerializationError, TypeError, ValueError, OverflowError) as err:
+            failures.append(dead_letter.write(action, err))
+            continue
+        if chunk and not sizer.fits(len(chunk) + 1, size + len(data)):
+            yield chunk, failures
+            chunk = []
+            failures = []
+            size = 0
+        chunk.append((action, data))
+        size += len(data)
+    if chunk or failures:
+        yield chunk, failures
+
+
+def bisect_bulk_chunk(es, chunk, sizer, dead_letter, *, attempt=0):
+    """Split a chunk in two and send each half separately."""
+    mid = len(chunk) // 2
+    return send_bulk_chunk(
+        es, chunk[:mid], sizer, dead_letter, attempt=attempt
+    ) + send_bulk_chunk(es, chunk[mid:], sizer, dead_letter, attempt=attempt)
+
+
+def send_bulk_chunk(es, chunk, sizer, dead_letter, *, attempt=0):
+    """Send a chunk of bulk actions, returning an (ok, response) tuple per action.
+
+    Requests that fail because Elasticsearch is busy are retried with
+    exponential backoff. Requests that fail for any other reason are split
+    in half and retried until the failing documents are isolated and
+    written to the dead letter file.
+    """
+    size = sum(len(entry[1]) for entry in chunk)
+    start = time.monotonic()
+    try:
+        with tolog.DisableLogger():
+            resp = es.bulk(operations=[entry[1] for entry in chunk])
+    except (ApiError, TransportError) as err:
+        if isinstance(err, ApiError) and err.status_code == 413:
+            sizer.shrink()
+            if len(chunk) == 1:
+                return [dead_letter.write(chunk[0][0], err)]
+            return bisect_bulk_chunk(es, chunk, sizer, dead_letter, attempt=attempt)
+        if is_backpressure(err) or isinstance(err, ESConnectionError):
+            if attempt >= BULK_RETRIES:
+                raise err
+            sizer.shrink()
+            bulk_backoff(attempt)
+            if len(chunk) > 1 and size > sizer.target_bytes:
+                return bisect_bulk_chunk(
+                    es, chunk, sizer, dead_letter, attempt=attempt + 1
+                )
+            return send_bulk_chunk(es, chunk, sizer, dead_letter, attempt=attempt + 1)
+        if len(chunk) == 1:
+            return [dead_letter.write(chunk[0][0], err)]
+        return bisect_bulk_chunk(es, chunk, sizer, dead_letter, attempt=attempt)
+    sizer.record(len(chunk), size, time.monotonic() - start)
+    results = []
+    rejected = []
+    for entry, item in zip(chunk, resp["items"]):
+        op_type, info = item.copy().popitem()
+        status = info.get("status", 500)
+        if 200 <= status < 300:
+            results.append((True, {op_type: info}))
+        elif status == 429 and attempt < BULK_RETRIES:
+            rejected.append(entry)
+        else:
+            results.append(
+                dead_letter.write(entry[0], info.get("error"), status=status)
+            )
+    if rejected:
+        sizer.shrink()
+        bulk_backoff(attempt)
+        results += send_bulk_chunk(
+            es, rejected, sizer, dead_letter, attempt=attempt + 1
+        )
+    return results
+
+
+def process_bulk_chunk(es, chunk_failures, *, sizer, dead_letter):
+    """Send a chunk of bulk actions, including responses for unsent actions."""
+    chunk, failures = chunk_failures
+    if not chunk:
+        return failures
+    return failures + send_bulk_chunk(es, chunk, sizer, dead_letter)
+
+
+def bounded_imap(func, iterable, threads):
+    """Map func over iterable using a thread pool, yielding results in order.
+
+    Limits the number of inputs held in memory while waiting for a thread.
+    """
+    if threads <= 1:
+        yield from map(func, iterable)
+        return
+    slots = threading.Semaphore(threads * 2)
+    stop = threading.Event()
+
+    def bounded_inputs():
+        for item in iterable:
+            slots.acquire()
+            if stop.is_set():
+                return
+            yield item
+
+    with ThreadPool(threads) as pool:
+        try:
+            for result in pool.imap(func, bounded_inputs()):
+                slots.release()
+                yield result
+        finally:
+            stop.set()
+            slots.release()
+
+
+def stream_bulk_chunks(es, actions, sizer, *, threads=1, dead_letter=None):
+    """Send bulk actions in chunks, yielding an (ok, response) tuple per action."""
+    if dead_letter is None:
+        dead_letter = DeadLetterFile()
+    chunks = chunk_actions(es, actions, sizer, dead_letter)
+    process = partial(process_bulk_chunk, es, sizer=sizer, dead_letter=dead_letter)
+    for results in bounded_imap(process, chunks, threads):
+        yield from results
+
+
 def index_stream(
     es,
     index_name,
@@ -238,8 +652,23 @@ def index_stream(
     log=False,
     dry_run=False,
     chunk_size=500,
+    threads=1,
+    max_chunk_bytes=MAX_CHUNK_BYTES,
+    target_bytes=None,
+    dead_letter=None,
+    refresh=True,
+    script=None,
 ):
-    """Load bulk entries from stream into Elasticsearch index."""
+    """Load bulk entries from stream into Elasticsearch index.
+
+    Entries are sent in chunks limited by both document count (chunk_size)
+    and request size (max_chunk_bytes). Setting target_bytes builds chunks
+    to an adaptive target size instead. Setting threads > 1 sends chunks
+    in parallel using a thread pool. Documents that cannot be indexed are
+    appended to the dead_letter JSON Lines file. The index is refreshed
+    at the end of the stream unless refresh is False. Setting script to the
+    ID of a stored script sends each update entry as the script params.
+    """
     # LOGGER.info("Indexing bulk entries to %s", index_name)
     if _op_type == "index":
         actions = (
@@ -251,6 +680,16 @@ def index_stream(
             }
             for entry_id, entry in stream
         )
+    elif _op_type == "update" and script is not None:
+        actions = (
+            {
+                "_index": index_name,
+                "_id": entry_id,
+                "script": {"id": script, "params": entry},
+                "_op_type": _op_type,
+            }
+            for entry_id, entry in stream
+        )
     elif _op_type == "update":
         actions = (
             {"_index": index_name, "_id": entry_id, "doc": entry, "_op_type": _op_type}
@@ -262,62 +701,97 @@ def index_stream(
         for action in actions:
             yield True, {}
 
-    def debug_actions(actions, batch):
-        """Wrap actions for debugging."""
-        for action in actions:
-            if len(batch) == chunk_size:
-                batch = []
-            batch.append(action)
-            yield action
+    sizer = BulkChunkSizer(
+        chunk_size=int(chunk_size),
+        max_chunk_bytes=int(max_chunk_bytes),
+        target_bytes=int(target_bytes) if target_bytes else None,
+    )
+    dead_letter_file = DeadLetterFile(dead_letter)
+    tracer = logging.getLogger("elasticsearch")
+    tracer.setLevel(logging.ERROR)
+    if dry_run:
+        iterator = dry_run_iterator(es, actions)
+    else:
+        iterator = stream_bulk_chunks(
+            es, actions, sizer, threads=int(threads), dead_letter=dead_letter_file
+        )
+    success = 0
+    failed = 0
+    if log:
+        iterator = tqdm(iterator, unit=" records", unit_scale=True)
+    for ok, response in iterator:
+        if ok:
+            success += 1
+        else:
+            failed += 1
+    sizer.report(index_name)
+    if dead_letter_file.count and dead_letter is not None:
+        LOGGER.warning(
+            "Wrote %d documents that failed to index to '%s'",
+            dead_letter_file.count,
+            dead_letter,
+        )
+    if refresh:
+        es_client = client.IndicesClient(es)
+        es_client.refresh(index=index_name)
+    return success, failed
+
+
+def refresh_indices(es, index_names):
+    """Refresh a list of Elasticsearch indices."""
+    es_client = client.IndicesClient(es)
+    for index_name in index_names:
+        if index_exists(es, index_name):
+            with tolog.DisableLogger():
+                es_client.refresh(index=index_name)
+
+
+def apply_bulk_load_settings(es, index_name):
+    """Save the current settings of an index and apply bulk load settings."""
+    es_client = client.IndicesClient(es)
+    with tolog.DisableLogger():
+        res = es_client.get_settings(index=index_name, flat_settings=True)
+    current = res[index_name]["settings"]
+    BULK_LOAD["saved"][index_name] = {
+        key: current.get(key) for key in BULK_LOAD_SETTINGS
+    }
+    LOGGER.info("Applying bulk load settings to index '%s'", index_name)
+    with tolog.DisableLogger():
+        es_client.put_settings(index=index_name, settings=BULK_LOAD_SETTINGS)
+
 
-    batch = []
-    actions = debug_actions(actions, batch)
+@contextlib.contextmanager
+def bulk_load_settings(es, index_names, *, enabled=True):
+    """Relax index settings during bulk loading.
 
+    Sets refresh_interval to -1 and number_of_replicas to 0 on each existing
+    index and on any of the indices created by index_create within the
+    context, restoring the original settings and refreshing every index on
+    exit.
+    """
+    targets = set(index_names) if enabled else set()
+    BULK_LOAD["targets"].update(targets)
     try:
-        tracer = logging.getLogger("elasticsearch")
-        tracer.setLevel(logging.ERROR)
-        if dry_run:
-            iterator = dry_run_iterator(es, actions)
-        else:
-            chunk_size = int(chunk_size)
-            iterator = helpers.streaming_bulk(es, actions, chunk_size)
-        success = 0
-        failed = 0
-        if log:
-            iterator = tqdm(iterator, unit=" records", unit_scale=True)
-        for ok, response in iterator:
-            if ok:
-                success += 1
-            else:
-                failed += 1
-    except Exception as bulk_err:
-        for action in batch:
-            try:
-                if _op_type == "index":
-                    es.create(
-                        index=index_name, id=action["_id"], document=action["_source"]
-                    )
-                else:
-                    es.update(index=index_name, id=action["_id"], doc=action["doc"])
-            except ConflictError:
-                pass
-            except OverflowError:
-                pass
-            except Exception as err:
-                LOGGER.warn(
-                    "Size of document that failed to index is %d bytes",
-                    get_size(action),
+        for index_name in targets:
+            if index_exists(es, index_name):
+                apply_bulk_load_settings(es, index_name)
+        yield
+    finally:
+        BULK_LOAD["targets"].difference_update(targets)
+        es_client = client.IndicesClient(es)
+        for index_name in targets:
+            if index_name not in BULK_LOAD["saved"]:
+                continue
+            LOGGER.info("Restoring index settings for '%s'", index_name)
+            with tolog.DisableLogger():
+                es_client.put_settings(
+                    index=index_name, settings=BULK_LOAD["saved"].pop(index_name)
                 )
-                LOGGER.warn(action)
-                raise err
-        # raise bulk_err
-    es_client = client.IndicesClient(es)
-    es_client.refresh(index=index_name)
-    return success, failed
+        refresh_indices(es, targets)
 
 
-def stream_template_search_results(es, *, index, body, size=10):
-    """Stream results of a template search."""
+def stream_scroll_results(es, *, index, body, size=10):
+    """Stream results of a template search using the scroll API."""
     body["params"].update({"size": size})
     with tolog.DisableLogger():
         res = es.search_template(
@@ -340,6 +814,172 @@ def stream_template_search_results(es, *, index, body, size=10):
         es.clear_scroll(scroll_id=scroll_id)
 
 
+def open_point_in_time(es, index, keep_alive):
+    """Open a point in time, returning None if unsupported."""
+    try:
+        with tolog.DisableLogger():
+            res = es.open_point_in_time(index=index, keep_alive=keep_alive)
+    except ApiError as err:
+        LOGGER.debug("Unable to open point in time on '%s': %s", index, err)
+        return None
+    return res["id"]
+
+
+def stream_pit_pages(es, *, body, size):
+    """Stream pages of hits from a point in time using search_after."""
+    body = {**body, "pit": {**body["pit"]}}
+    while True:
+        with tolog.DisableLogger():
+            res = es.search(body=body, track_total_hits=False)
+        hits = res["hits"]["hits"]
+        if hits:
+            yield hits
+        if len(hits) < size:
+            break
+        body["pit"]["id"] = res.get("pit_id", body["pit"]["id"])
+        body["search_after"] = hits[-1]["sort"]
+
+
+def put_until_stopped(queue, item, stop):
+    """Put an item on a queue, giving up if stopped while the queue is full."""
+    while not stop.is_set():
+        with contextlib.suppress(Full):
+            queue.put(item, timeout=1)
+            return True
+    return False
+
+
+def prefetch_pages(pages, queue, key, stop):
+    """Pass pages from an iterator to a queue until exhausted or stopped."""
+    try:
+        for page in pages:
+            if not put_until_stopped(queue, (key, page), stop):
+                return
+    except Exception as err:
+        put_until_stopped(queue, (key, err), stop)
+    put_until_stopped(queue, (key, None), stop)
+
+
+def read_prefetched_pages(queue, count):
+    """Yield pages from a queue until count iterators are exhausted."""
+    while count:
+        key, page = queue.get()
+        if page is None:
+            count -= 1
+        elif isinstance(page, Exception):
+            raise page
+        else:
+            yield key, page
+
+
+def stream_sliced_pages(page_iterators, *, ordered=False):
+    """Consume page iterators in threads, merging hits into a single iterator.
+
+    If ordered is True, hits are merged by their sort values so the output
+    matches an unsliced stream, otherwise hits are yielded as pages arrive.
+    Threads are stopped and joined before returning, including when the
+    consumer stops early, so no requests are in flight afterwards.
+    """
+    stop = threading.Event()
+    count = len(page_iterators)
+    queues = (
+        [Queue(maxsize=2) for _ in range(count)]
+        if ordered
+        else [Queue(maxsize=2 * count)] * count
+    )
+    threads = [
+        threading.Thread(
+            target=prefetch_pages, args=(pages, queues[key], key, stop), daemon=True
+        )
+        for key, pages in enumerate(page_iterators)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        if ordered:
+            yield from heapq.merge(
+                *(
+                    (hit for _, page in read_prefetched_pages(queue, 1) for hit in page)
+                    for queue in queues
+                ),
+                key=lambda hit: hit["sort"],
+            )
+        else:
+            for _, page in read_prefetched_pages(queues[0], count):
+                yield from page
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def stream_pit_results(es, *, pit_id, body, size, keep_alive, slices=1, ordered=False):
+    """Stream results of a search body from a point in time using search_after."""
+    body.pop("from", None)
+    body.update({"size": size, "pit": {"id": pit_id, "keep_alive": keep_alive}})
+    if "sort" not in body:
+        body["sort"] = ["_shard_doc"]
+    try:
+        if slices > 1:
+            yield from stream_sliced_pages(
+                [
+                    stream_pit_pages(
+                        es, body={**body, "slice": {"id": i, "max": slices}}, size=size
+                    )
+                    for i in range(slices)
+                ],
+                ordered=ordered,
+            )
+        else:
+            for page in stream_pit_pages(es, body=body, size=size):
+                yield from page
+    finally:
+        with tolog.DisableLogger():
+            es.close_point_in_time(body={"id": pit_id})
+
+
+def stream_template_search_results(
+    es,
+    *,
+    index,
+    body,
+    size=SEARCH_PAGE_SIZE,
+    keep_alive=PIT_KEEP_ALIVE,
+    slices=1,
+    ordered=True,
+):
+    """Stream results of a template search.
+
+    Results that fit in less than a full page are returned from one request,
+    larger result sets are paged through a point in time using search_after.
+    Hit totals are not used as they are capped unless track_total_hits is set.
+    With slices > 1, point in time slices are read in parallel threads.
+    """
+    size = max(1, min(int(size), MAX_SEARCH_PAGE_SIZE))
+    body["params"].update({"from": 0, "size": size})
+    with tolog.DisableLogger():
+        res = es.search_template(index=index, body=body)
+    hits = res["hits"]["hits"]
+    if len(hits) < size:
+        yield from hits
+        return
+    pit_id = open_point_in_time(es, index, keep_alive)
+    if pit_id is None:
+        yield from stream_scroll_results(es, index=index, body=body, size=size)
+        return
+    with tolog.DisableLogger():
+        rendered = es.render_search_template(**body)
+    yield from stream_pit_results(
+        es,
+        pit_id=pit_id,
+        body=rendered["template_output"],
+        size=size,
+        keep_alive=keep_alive,
+        slices=max(1, int(slices)),
+        ordered=ordered,
+    )
+
+
 def query_flexible_template(es, template_name, index, opts=None):
     """Run query using a flexible template."""
     if not index_exists(es, index):
@@ -413,6 +1053,58 @@ def query_value_template(es, template_name, values, index):
     return res
 
 
+def msearch_template_body(template_name, param_sets):
+    """Build a multi search template request body."""
+    buffer = io.BytesIO()
+    for params in param_sets:
+        buffer.write(b"{}\n")
+        buffer.write(ujson.dumps({"id": template_name, "params": params}).encode())
+        buffer.write(b"\n")
+    return buffer.getvalue()
+
+
+def send_msearch_batch(es, template_name, index, param_sets):
+    """Send a batch of template searches as a single multi search request."""
+    body = msearch_template_body(template_name, param_sets)
+    with tolog.DisableLogger():
+        res = es.msearch_template(body=body, index=index)
+    return res["responses"]
+
+
+def response_hits(res):
+    """Get hits from a multi search response, raising an error if the search failed.
+
+    Failed searches in a multi search request are returned as responses with
+    an error, which must not be mistaken for searches with no results.
+    """
+    if "error" in res:
+        error = res["error"]
+        reason = error.get("reason", error) if isinstance(error, dict) else error
+        raise RuntimeError(f'Search failed with status {res.get("status")}: {reason}')
+    return res.get("hits", {})
+
+
+def stream_msearch_template(
+    es,
+    template_name,
+    index,
+    param_sets,
+    *,
+    batch_size=MSEARCH_BATCH_SIZE,
+    threads=MSEARCH_THREADS,
+):
+    """Run a search template for each set of parameters.
+
+    Parameter sets are sent in multi search batches of batch_size using up to
+    threads concurrent requests. Responses are yielded in input order.
+    """
+    param_sets = iter(param_sets)
+    batches = iter(lambda: list(islice(param_sets, batch_size)), [])
+    send = partial(send_msearch_batch, es, template_name, index)
+    for responses in bounded_imap(send, batches, threads):
+        yield from responses
+
+
 def document_by_id(es, ids, index):
     """Get indexed documents by ID."""
     if not index_exists(es, index):
@@ -549,4 +1241,3 @@ class EsQueryBuilder:
     def string(self):
         """Return query as string."""
         return ujson.dumps(self.write())
-        return ujson.dumps(self.write())
@@ -7,12 +7,18 @@ Usage:
     genomehubs fill [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                     [--config-file PATH...] [--config-save PATH]
                     [--es-batch INT] [--es-host URL...]  [--taxonomy-source STRING]
+                    [--es-threads INT] [--es-max-bytes INT]
+                    [--es-chunk-bytes INT] [--es-dead-letter PATH]
+                    [--es-bulk-load] [--es-skip-refresh] [--es-page-size INT]
+                    [--es-connections INT] [--es-compress] [--es-sniff]
+                    [--es-slices INT]
                     [--traverse-limit STRING]
                     [--traverse-infer-ancestors] [--traverse-infer-descendants]
                     [--traverse-infer-both] [--traverse-threads INT]
                     [--traverse-depth INT] [--traverse-root STRING]
+                    [--traverse-in-memory] [--change-log PATH]
                     [--traverse-weight STRING] [--log-interval INT]
-                    [--log-es BOOL]
+                    [--log-es BOOL] [--profile PATH]
                     [-h|--help] [-v|--version]
 
 Options:
@@ -22,13 +28,29 @@ Options:
     --config-file PATH            Path to YAML file containing configuration options.
     --config-save PATH            Path to write configuration options to YAML file.
     --es-batch INT                Batch size for ElasticSearch bulk indexing.
+    --es-threads INT              Number of threads for ElasticSearch bulk indexing.
+    --es-max-bytes INT            Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-chunk-bytes INT          Target size (bytes) for adaptive ElasticSearch bulk requests.
+    --es-dead-letter PATH         Path to JSON Lines file for documents that fail to index.
+    --es-bulk-load                Disable refresh and replicas until indexing completes.
+    --es-skip-refresh             Skip index refresh after each bulk indexing call.
+    --es-page-size INT            Page size (1-10000) for streaming ElasticSearch results.
+    --es-slices INT               Number of parallel slices for streaming large results.
+    --es-connections INT          Number of HTTP connections per ElasticSearch node.
+    --es-compress                 Use gzip compression for ElasticSearch requests.
+    --es-sniff                    Discover ElasticSearch nodes by sniffing the cluster.
     --es-host URL                 ElasticSearch hostname/URL and port.
     --taxonomy-source STRING      Name of taxonomy to use (ncbi or ott).
-    --traverse-depth INT          Maximum depth for tree traversal relative to root taxon.
+    --traverse-depth INT          Maximum depth relative to root taxon at which to split
+                                  the tree for multi-threaded traversal.
     --traverse-infer-ancestors    Flag to enable tree traversal from tips to root.
     --traverse-infer-descendants  Flag to enable tree traversal from root to tips.
     --traverse-infer-both         Flag to enable tree traversal from tips to root and
                                   back to tips.
+    --traverse-in-memory          Flag to load each subtree into memory to infer
+                                  ancestral values in a single pass.
+    --change-log PATH             Path to change log from genomehubs index to limit tree
+                                  traversal to the lineages of changed taxa.
     --traverse-limit STRING       Maximum rank to ascend to during traversal. [Default: null]
     --traverse-root ID            Root taxon id for tree traversal.
     --traverse-threads INT        Number of threads to use for tree traversal. [Default: 1]
@@ -36,6 +58,8 @@ Options:
                                   traversal.
     --log-interval INT            Minimum time (seconds) between prgress bar updates.
     --log-es BOOL                 Show Info-level logs from elasticsearch.
+    --profile PATH                Path to write a JSON report of time and memory used at
+                                  each depth of tree traversal.
     -h, --help                    Show this
     -v, --version                 Show version number
 
@@ -50,7 +74,10 @@ import re
 import sys
 from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 from itertools import groupby
+from itertools import islice
 from multiprocessing import Pool
 from statistics import mean
 from statistics import median
@@ -60,21 +87,46 @@ from statistics import mode
 from traceback import format_exc
 
 from docopt import docopt
+from h3 import cell_to_parent
 from h3 import latlng_to_cell
 from tqdm import tqdm
 
 from genomehubs.vendor.tolkein import tolog
 
 from ..lib import hub
+from ..lib import profiler
 from ..lib import taxon
 from .attributes import fetch_types
+from .changelog import read_change_log
 from .config import config
+from .es_functions import MAX_SEARCH_PAGE_SIZE
+from .es_functions import MSEARCH_BATCH_SIZE
+from .es_functions import MSEARCH_THREADS
+from .es_functions import SEARCH_PAGE_SIZE
+from .es_functions import bulk_load_settings
+from .es_functions import bulk_options
+from .es_functions import es_client
 from .es_functions import index_stream
 from .es_functions import launch_es
+from .es_functions import msearch_options
+from .es_functions import response_hits
+from .es_functions import search_page_size
+from .es_functions import search_slices
+from .es_functions import stream_msearch_template
 from .es_functions import stream_template_search_results
+from .summaries import ValueSketch
+from .summaries import sketchable
+from .summaries import vector_mean
+from .summaries import vector_median
+from .summaries import vector_median_high
+from .summaries import vector_median_low
+from .taxon_tree import TaxonTree
 from .version import __version__
 
 LOGGER = tolog.logger(__name__)
+SUBTREES_PER_THREAD = 8
+HEXBIN_RESOLUTION = 6
+HEXBIN_CACHE_SIZE = 2**16
 
 
 def get_max_depth(es, *, index):
@@ -102,33 +154,94 @@ def get_max_depth_by_lineage(es, *, index, root):
     return res["aggregations"]["depths"]["root"]["max_depth"]["value"]
 
 
-def stream_nodes_by_root_depth(es, *, index, root, depth, size=10):
+def stream_nodes_by_root_depth(
+    es, *, index, root, depth, size=SEARCH_PAGE_SIZE, slices=1
+):
     """Get entries by depth of root taxon."""
     if depth > 0:
         body = {
             "id": "taxon_attributes_by_root_depth",
             "params": {"taxon_id": root, "depth": depth},
         }
-        return stream_template_search_results(es, index=index, body=body, size=size)
+        return stream_template_search_results(
+            es, index=index, body=body, size=size, slices=slices, ordered=False
+        )
     body = {
         "id": "taxon_attributes_by_taxon_id",
         "params": {"taxon_id": root},
     }
-    return stream_template_search_results(es, index=index, body=body)
+    return stream_template_search_results(es, index=index, body=body, size=size)
+
+
+def stream_nodes_by_root(
+    es, *, index, root, max_depth, size=SEARCH_PAGE_SIZE, slices=1
+):
+    """Get entries for root taxon and all descendants up to max_depth."""
+    body = {
+        "id": "taxon_attributes_by_root_max_depth",
+        "params": {"taxon_id": root, "depth": max_depth},
+    }
+    return stream_template_search_results(
+        es, index=index, body=body, size=size, slices=slices, ordered=False
+    )
 
 
-def stream_descendant_nodes_missing_attributes(es, *, index, attributes, root, size=10):
-    """Get entries descended from root that lack one or more attributes."""
+def stream_descendant_nodes_missing_attributes(
+    es,
+    *,
+    index,
+    ancestors,
+    size=SEARCH_PAGE_SIZE,
+    batch_size=MSEARCH_BATCH_SIZE,
+    threads=MSEARCH_THREADS,
+):
+    """Get entries descended from each ancestor that lack one or more attributes.
+
+    Takes (taxon_id, attributes) tuples, where attributes is a dict of
+    attribute entries by key, and yields (taxon_id, attributes, descendants)
+    tuples in the same order. Searches for each ancestor and attribute are
+    batched into multi search requests of up to size hits each, falling back
+    to paged searches for ancestors with a full page of matching descendants.
+    """
+    template_name = "taxon_missing_attribute_by_ancestor_id"
+    size = max(1, min(int(size), MAX_SEARCH_PAGE_SIZE))
+    ancestors = iter(ancestors)
+    for chunk in iter(lambda: list(islice(ancestors, batch_size * threads)), []):
+        responses = stream_msearch_template(
+            es,
+            template_name,
+            index,
+            (
+                {"taxon_id": taxon_id, "attribute": key, "size": size}
+                for taxon_id, attributes in chunk
+                for key in attributes
+            ),
+            batch_size=batch_size,
+            threads=threads,
+        )
+        for taxon_id, attributes in chunk:
+            hit_lists = []
+            for key, res in zip(attributes, islice(responses, len(attributes))):
+                hits = response_hits(res).get("hits", [])
+                if len(hits) >= size:
+                    body = {
+                        "id": template_name,
+                        "params": {"taxon_id": taxon_id, "attribute": key},
+                    }
+                    hits = stream_template_search_results(
+                        es, index=index, body=body, size=size
+                    )
+                hit_lists.append(hits)
+            yield taxon_id, attributes, unique_hits(hit_lists)
+
+
+def unique_hits(hit_lists):
+    """Stream hits from a set of hit lists, skipping repeated IDs."""
     id_list = set()
-    for attribute in attributes:
-        body = {
-            "id": "taxon_missing_attribute_by_ancestor_id",
-            "params": {"taxon_id": root, "attribute": attribute["key"]},
-        }
-        for result in stream_template_search_results(
-            es, index=index, body=body, size=size
-        ):
+    for hits in hit_lists:
+        for result in hits:
             if result["_id"] not in id_list:
+                id_list.add(result["_id"])
                 yield result
 
 
@@ -243,29 +356,44 @@ def deduped_list(arr):
     return list(set(flatten_list(arr)))
 
 
+@lru_cache(maxsize=HEXBIN_CACHE_SIZE)
+def coordinate_cell(coord):
+    """Find the h3 hexagon containing a "lat,lon" string or (lat, lon) tuple.
+
+    Hexagons are found at the finest resolution used by hexbin summaries so
+    each coordinate is converted only once.
+    """
+    if isinstance(coord, str):
+        lat_str, lon_str = coord.split(",")
+        lat, lon = float(lat_str.strip()), float(lon_str.strip())
+    else:
+        lat, lon = float(coord[0]), float(coord[1])
+    return latlng_to_cell(lat, lon, HEXBIN_RESOLUTION)
+
+
 def hex_bin(arr, resolution=6):
-    """Convert list of point coordinates to h3 hexagons."""
-    hexagons = []
+    """Convert list of point coordinates to h3 hexagons.
+
+    Coarser hexagons are the parents of the hexagons found at the finest
+    resolution.
+    """
+    hexagons = set()
     for coord in deduped_list(arr):
         if isinstance(coord, str):
             # Handle comma-separated string "lat,lon"
-            lat_str, lon_str = coord.split(",")
-            lat, lon = float(lat_str.strip()), float(lon_str.strip())
-            hexagons.append(latlng_to_cell(lat, lon, resolution))
+            hexagons.add(coordinate_cell(coord))
         elif isinstance(coord, list):
             # Handle list of [lat, lon] or list of such lists/strings
             for item in coord:
                 if isinstance(item, str):
-                    lat_str, lon_str = item.split(",")
-                    lat, lon = float(lat_str.strip()), float(lon_str.strip())
-                    hexagons.append(latlng_to_cell(lat, lon, resolution))
+                    hexagons.add(coordinate_cell(item))
                 elif isinstance(item, (list, tuple)) and len(item) == 2:
-                    lat, lon = float(item[0]), float(item[1])
-                    hexagons.append(latlng_to_cell(lat, lon, resolution))
+                    hexagons.add(coordinate_cell(tuple(item)))
         elif isinstance(coord, (tuple, list)) and len(coord) == 2:
-            lat, lon = float(coord[0]), float(coord[1])
-            hexagons.append(latlng_to_cell(lat, lon, resolution))
-    return deduped_list(hexagons)
+            hexagons.add(coordinate_cell(tuple(coord)))
+    if resolution < HEXBIN_RESOLUTION:
+        hexagons = {cell_to_parent(hexagon, resolution) for hexagon in hexagons}
+    return list(hexagons)
 
 
 def hexbin1(arr):
@@ -324,10 +452,10 @@ def apply_summary(
         "latest": latest,
         "max": latest,
         "min": earliest,
-        "mean": mean,
-        "median": median,
-        "median_high": median_high,
-        "median_low": median_low,
+        "mean": vector_mean,
+        "median": vector_median,
+        "median_high": vector_median_high,
+        "median_low": vector_median_low,
         "median_list": median_list,
         "mode": mode,
         "most_common": mode,
@@ -468,6 +596,99 @@ def set_traverse_values(
 #         attribute["prefixed_values"] = prefixed_values
 
 
+def set_sketch_values(attribute, meta, sketch, *, count, sp_count, source):
+    """Set summary values for an attribute from a value sketch."""
+    value_type = f'{meta["type"]}_value'
+    primary_values = [
+        value[value_type]
+        for value in attribute.get("values", [])
+        if value.get("is_primary_value") and value_type in value
+    ]
+    summaries = meta["summary"]
+    summaries = summaries[:] if isinstance(summaries, list) else [summaries]
+    traverse = meta.get("traverse", False)
+    if traverse and source != "ancestor" and traverse not in summaries[:2]:
+        summaries.insert(1 if summaries[0] == "primary" else 0, traverse)
+    for index, summary in enumerate(summaries):
+        summary_sketch = sketch
+        if summary == "primary":
+            summary = next(
+                (summary for summary in summaries[index + 1 :] if summary != "primary"),
+                "median",
+            )
+            if primary_values:
+                summary_sketch = ValueSketch().update(primary_values)
+        value = summary_sketch.summary(summary)
+        if index == 0:
+            if (
+                value_type not in attribute
+                or attribute.get("aggregation_method") != "primary"
+            ):
+                attribute[value_type] = value
+                attribute["count"] = count or sketch.count
+                attribute["sp_count"] = sp_count
+                attribute["aggregation_method"] = (
+                    "primary" if summary_sketch is not sketch else summary
+                )
+                attribute["aggregation_source"] = source
+            continue
+        if summary.startswith("median"):
+            summary = "median"
+        if summary == "range":
+            attribute[summary] = value
+        elif summary not in attribute and summary in {"mean", "median", "mode", "sum"}:
+            attribute[summary] = value
+    attribute["max"] = sketch.max
+    attribute["min"] = sketch.min
+
+
+def summarise_attribute_sketch(
+    attribute, meta, *, values=None, count=0, sp_count=0, source="direct"
+):
+    """Calculate summary values for an attribute using mergeable sketches.
+
+    Values may be raw numbers or sketches returned for child nodes. The merged
+    sketch is returned as the traverse value so that ancestors summarise every
+    value in their subtree without holding the full list.
+    """
+    value_type = f'{meta["type"]}_value'
+    sketch = ValueSketch()
+    for value in values or []:
+        if isinstance(value, ValueSketch):
+            sketch.merge(value)
+        else:
+            sketch.update([value])
+    sketch.update(
+        value[value_type]
+        for value in attribute.get("values", [])
+        if value_type in value
+    )
+    if not sketch.count:
+        return None, None, None
+    set_sketch_values(
+        attribute, meta, sketch, count=count, sp_count=sp_count, source=source
+    )
+    return sketch, sketch.max, sketch.min
+
+
+def check_summary_precision(types):
+    """Use exact summaries for attributes that cannot be sketched."""
+    for key, meta in types.items():
+        if meta.get("summary_precision", "exact") == "exact":
+            continue
+        if meta["summary_precision"] != "sketch" or not sketchable(meta):
+            LOGGER.warning(
+                "Using exact summaries for attribute %s, summary_precision %s "
+                "is not supported for type %s with summary %s",
+                key,
+                meta["summary_precision"],
+                meta.get("type"),
+                meta.get("summary"),
+            )
+            meta["summary_precision"] = "exact"
+
+
+@profiler.profile_summary
 def summarise_attribute_values(
     attribute,
     meta,
@@ -483,6 +704,15 @@ def summarise_attribute_values(
     """Calculate a single summary value for an attribute."""
     if values is None and "values" not in attribute:
         return None, None, None
+    if meta.get("summary_precision") == "sketch" and "summary" in meta:
+        return summarise_attribute_sketch(
+            attribute,
+            meta,
+            values=values,
+            count=count,
+            sp_count=sp_count,
+            source=source,
+        )
     if "summary" in meta:
         value_type = f'{meta["type"]}_value'
         primary_values = []
@@ -777,7 +1007,70 @@ def track_descendant_ranks(node, descendant_ranks):
         descendant_ranks[node["_source"]["parent"]].add(node["_source"]["taxon_rank"])
 
 
-def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
+def descendant_values_store():
+    """Create a store for values passed from descendant to ancestral nodes."""
+    return defaultdict(
+        lambda: defaultdict(
+            lambda: {
+                "max": None,
+                "min": None,
+                "values": [],
+                "prefixed_values": [],
+                "count": 0,
+                "sp_count": 0,
+            }
+        )
+    )
+
+
+@profiler.profile_node
+def summarise_node(
+    node, *, attrs, meta, parents, descendant_ranks, traverse_limit, limits
+):
+    """Summarise direct and descendant attribute values for a single node."""
+    changed = False
+    attr_dict = {}
+    if "attributes" in node["_source"] and node["_source"]["attributes"]:
+        changed, attr_dict = summarise_attributes(
+            attributes=node["_source"]["attributes"],
+            rank=node["_source"]["taxon_rank"],
+            attrs=attrs,
+            meta=meta,
+            parent=node["_source"].get("parent", None),
+            parents=parents,
+        )
+    else:
+        node["_source"]["attributes"] = []
+    if node["_source"]["taxon_id"] in parents:
+        modified, attr_dict = set_values_from_descendants(
+            attributes=node["_source"]["attributes"],
+            descendant_values=parents[node["_source"]["taxon_id"]],
+            meta=meta,
+            taxon_id=node["_source"]["taxon_id"],
+            parent=node["_source"].get("parent", None),
+            parents=parents,
+            descendant_ranks=descendant_ranks,
+            taxon_rank=node["_source"]["taxon_rank"],
+            traverse_limit=traverse_limit,
+            attr_dict=attr_dict,
+            limits=limits,
+        )
+        if not changed:
+            changed = modified
+    return changed, attr_dict
+
+
+def traverse_from_tips(
+    es,
+    opts,
+    *,
+    template,
+    root=None,
+    max_depth=None,
+    parents=None,
+    limits=None,
+    descendant_ranks=None,
+):
     """Traverse a tree, filling in values."""
     if root is None:
         root = opts["traverse-root"]
@@ -790,66 +1083,42 @@ def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
     root_depth = max_depth
     meta = template["types"]["attributes"]
     attrs = set(meta.keys())
-    parents = defaultdict(
-        lambda: defaultdict(
-            lambda: {
-                "max": None,
-                "min": None,
-                "values": [],
-                "prefixed_values": [],
-                "count": 0,
-                "sp_count": 0,
-            }
-        )
-    )
-    limits = defaultdict(set)
+    if parents is None:
+        parents = descendant_values_store()
+    if limits is None:
+        limits = defaultdict(set)
+    if descendant_ranks is None:
+        descendant_ranks = defaultdict(set)
     if "traverse-infer-both" in opts and opts["traverse-infer-both"]:
         desc_attrs, desc_attr_limits = set_attributes_to_descend(
             meta, opts["traverse-limit"]
         )
         missing_attributes = defaultdict(dict)
-        descendant_ranks = defaultdict(set)
     else:
         desc_attrs = {}
     while root_depth >= 0:
+        profiler.set_depth(root_depth)
         nodes = stream_nodes_by_root_depth(
             es,
             index=template["index_name"],
             root=root,
             depth=root_depth,
-            size=50,
+            size=search_page_size(opts),
+            slices=search_slices(opts),
         )
-        for ctr, node in enumerate(nodes):
+        for ctr, node in enumerate(profiler.timed_reads(nodes)):
             track_descendant_ranks(node, descendant_ranks)
-            changed = False
-            attr_dict = {}
-            if "attributes" in node["_source"] and node["_source"]["attributes"]:
-                changed, attr_dict = summarise_attributes(
-                    attributes=node["_source"]["attributes"],
-                    rank=node["_source"]["taxon_rank"],
-                    attrs=attrs,
-                    meta=meta,
-                    parent=node["_source"].get("parent", None),
-                    parents=parents,
-                )
-            else:
-                node["_source"]["attributes"] = []
-            if node["_source"]["taxon_id"] in parents:
-                modified, attr_dict = set_values_from_descendants(
-                    attributes=node["_source"]["attributes"],
-                    descendant_values=parents[node["_source"]["taxon_id"]],
-                    meta=meta,
-                    taxon_id=node["_source"]["taxon_id"],
-                    parent=node["_source"].get("parent", None),
-                    parents=parents,
-                    descendant_ranks=descendant_ranks,
-                    taxon_rank=node["_source"]["taxon_rank"],
-                    traverse_limit=opts["traverse-limit"],
-                    attr_dict=attr_dict,
-                    limits=limits,
-                )
-                if not changed:
-                    changed = modified
+            changed, attr_dict = summarise_node(
+                node,
+                attrs=attrs,
+                meta=meta,
+                parents=parents,
+                descendant_ranks=descendant_ranks,
+                traverse_limit=opts["traverse-limit"],
+                limits=limits,
+            )
+            parents.pop(node["_source"]["taxon_id"], None)
+            descendant_ranks.pop(node["_source"]["taxon_id"], None)
             if desc_attrs:
                 yield from track_missing_attribute_values(
                     node, missing_attributes, attr_dict, desc_attrs, desc_attr_limits
@@ -863,6 +1132,413 @@ def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
                 yield obj["node"]["_id"], obj["node"]["_source"]
 
 
+def traverse_in_memory(
+    es,
+    opts,
+    *,
+    template,
+    root=None,
+    max_depth=None,
+    parents=None,
+    limits=None,
+    descendant_ranks=None,
+):
+    """Traverse an in-memory copy of a tree from tips to root, filling in values.
+
+    Loads the subtree once into a TaxonTree and visits nodes in a single
+    bottom-up pass, skipping subtrees with no values to summarise.
+    """
+    if root is None:
+        root = opts["traverse-root"]
+    if max_depth is None:
+        max_depth = get_max_depth_by_lineage(
+            es,
+            index=template["index_name"],
+            root=root,
+        )
+    meta = template["types"]["attributes"]
+    attrs = set(meta.keys())
+    profiler.set_depth(None)
+    tree = TaxonTree(
+        profiler.timed_reads(
+            stream_nodes_by_root(
+                es,
+                index=template["index_name"],
+                root=root,
+                max_depth=max_depth,
+                size=search_page_size(opts),
+                slices=search_slices(opts),
+            )
+        ),
+        attrs,
+    )
+    LOGGER.info("Loaded %d nodes for in-memory traversal", len(tree))
+    if parents is None:
+        parents = descendant_values_store()
+    if limits is None:
+        limits = defaultdict(set)
+    desc_attrs = {}
+    if "traverse-infer-both" in opts and opts["traverse-infer-both"]:
+        desc_attrs, desc_attr_limits = set_attributes_to_descend(
+            meta, opts["traverse-limit"]
+        )
+        missing_attributes = defaultdict(dict)
+    active = tree.active()
+    for idx in tree.bottom_up_order():
+        node = tree.nodes[idx]
+        if descendant_ranks is not None and tree.parent[idx] < 0:
+            track_descendant_ranks(node, descendant_ranks)
+        if not desc_attrs and not active[idx]:
+            continue
+        profiler.set_depth(tree.depth[idx])
+        taxon_id = node["_source"]["taxon_id"]
+        changed, attr_dict = summarise_node(
+            node,
+            attrs=attrs,
+            meta=meta,
+            parents=parents,
+            descendant_ranks={taxon_id: tree.child_ranks(idx)},
+            traverse_limit=opts["traverse-limit"],
+            limits=limits,
+        )
+        parents.pop(taxon_id, None)
+        if desc_attrs:
+            yield from track_missing_attribute_values(
+                node, missing_attributes, attr_dict, desc_attrs, desc_attr_limits
+            )
+        if changed:
+            yield node["_id"], node["_source"]
+    if desc_attrs:
+        for incomplete in missing_attributes.values():
+            for obj in incomplete.values():
+                yield obj["node"]["_id"], obj["node"]["_source"]
+
+
+def stream_changed_lineages(es, *, index, root, changes, opts):
+    """Stream IDs of changed taxa and their ancestors up to root."""
+    responses = stream_msearch_template(
+        es,
+        "taxon_lineage_by_taxon_id",
+        index,
+        ({"taxon_id": taxon_id} for taxon_id in changes),
+        **msearch_options(opts),
+    )
+    for res in responses:
+        for hit in response_hits(res).get("hits", []):
+            taxon_id = hit["_source"]["taxon_id"]
+            if taxon_id == root:
+                yield taxon_id
+                continue
+            lineage = hit["_source"].get("lineage", [])
+            root_depth = next(
+                (
+                    ancestor["node_depth"]
+                    for ancestor in lineage
+                    if ancestor["taxon_id"] == root
+                ),
+                None,
+            )
+            if root_depth is None:
+                continue
+            yield taxon_id
+            for ancestor in lineage:
+                if ancestor["node_depth"] <= root_depth:
+                    yield ancestor["taxon_id"]
+
+
+def stream_nodes_by_parents(es, *, index, parents, opts):
+    """Stream entries for the direct children of a set of taxa."""
+    size = min(search_page_size(opts), MAX_SEARCH_PAGE_SIZE)
+    responses = stream_msearch_template(
+        es,
+        "taxon_attributes_by_root_depth",
+        index,
+        ({"taxon_id": parent, "depth": 1, "size": size} for parent in parents),
+        **msearch_options(opts),
+    )
+    for parent, res in zip(parents, responses):
+        hits = response_hits(res).get("hits", [])
+        if len(hits) < size:
+            yield from hits
+        else:
+            yield from stream_nodes_by_root_depth(
+                es,
+                index=index,
+                root=parent,
+                depth=1,
+                size=size,
+                slices=search_slices(opts),
+            )
+
+
+def stored_traverse_value(attribute, meta):
+    """Find the value a previous traversal passed to the parent of a node."""
+    traverse = meta["traverse"]
+    if traverse == "range":
+        return [attribute.get("min"), attribute.get("max")]
+    value = attribute.get(f'{meta["type"]}_value')
+    if attribute.get("aggregation_method") == traverse:
+        return value
+    if traverse.startswith("median"):
+        traverse = "median"
+    return attribute.get(traverse, value)
+
+
+def pass_stored_values(node, *, attrs, meta, parents, traverse_limit, limits):
+    """Pass stored summary values from an unchanged node to its parent."""
+    parent = node["_source"].get("parent", None)
+    attributes = node["_source"].get("attributes") or []
+    summarise_attributes(
+        attributes=[attribute for attribute in attributes if "values" in attribute],
+        rank=node["_source"]["taxon_rank"],
+        attrs=attrs,
+        meta=meta,
+        parent=parent,
+        parents=parents,
+    )
+    for attribute in attributes:
+        key = attribute["key"]
+        source = attribute.get("aggregation_source", [])
+        if (
+            key not in attrs
+            or not meta[key].get("traverse", False)
+            or meta[key].get("traverse_direction") == "down"
+            or "descendant" not in source
+        ):
+            continue
+        if node["_source"]["taxon_rank"] == meta[key].get(
+            "traverse_limit", traverse_limit
+        ):
+            limits[key].add(parent)
+        value = stored_traverse_value(attribute, meta[key])
+        if value is None:
+            continue
+        obj = parents[parent][key]
+        obj["count"] += 1
+        obj["sp_count"] += attribute.get("sp_count", 0)
+        if isinstance(value, list):
+            obj["values"] = list(set(obj["values"] + value))
+        else:
+            obj["values"].append(value)
+        if "max" in attribute:
+            obj["max"] = (
+                attribute["max"]
+                if obj["max"] is None
+                else latest(obj["max"], attribute["max"])
+            )
+        if "min" in attribute:
+            obj["min"] = (
+                attribute["min"]
+                if obj["min"] is None
+                else earliest(obj["min"], attribute["min"])
+            )
+
+
+def sketch_attributes(meta):
+    """List attributes traversed up the tree as value sketches.
+
+    Stored summary values for these attributes cannot stand in for the values
+    of a whole subtree, so they must be recomputed from all descendants.
+    """
+    return sorted(
+        key
+        for key, attribute in meta.items()
+        if attribute.get("traverse")
+        and attribute.get("traverse_direction") != "down"
+        and attribute.get("summary_precision") == "sketch"
+    )
+
+
+def traverse_changes(
+    opts,
+    *,
+    template,
+    tree,
+    changed,
+    parents=None,
+    limits=None,
+    descendant_ranks=None,
+    recompute=False,
+):
+    """Traverse the lineages of changed taxa from tips to root, filling in values.
+
+    The tree holds changed taxa, their ancestors and the direct children of
+    each. Unchanged children pass stored summary values to their parents so
+    only nodes in changed lineages are recomputed. With recompute, the tree
+    holds complete subtrees and unchanged taxa are summarised as in a full
+    traversal, but only changed taxa are yielded. Values and child ranks
+    already collected for the tree (e.g. by subtree workers) may be passed as
+    parents, limits and descendant_ranks.
+    """
+    meta = template["types"]["attributes"]
+    attrs = set(meta.keys())
+    if parents is None:
+        parents = descendant_values_store()
+    if limits is None:
+        limits = defaultdict(set)
+    if descendant_ranks is None:
+        descendant_ranks = {}
+    active = tree.active() if recompute else None
+    for idx in tree.bottom_up_order():
+        node = tree.nodes[idx]
+        taxon_id = node["_source"]["taxon_id"]
+        profiler.set_depth(tree.depth[idx])
+        if taxon_id not in changed:
+            if recompute:
+                if not active[idx]:
+                    continue
+            else:
+                pass_stored_values(
+                    node,
+                    attrs=attrs,
+                    meta=meta,
+                    parents=parents,
+                    traverse_limit=opts["traverse-limit"],
+                    limits=limits,
+                )
+                continue
+        child_ranks = tree.child_ranks(idx) | descendant_ranks.get(taxon_id, set())
+        changed_values, _attr_dict = summarise_node(
+            node,
+            attrs=attrs,
+            meta=meta,
+            parents=parents,
+            descendant_ranks={taxon_id: child_ranks},
+            traverse_limit=opts["traverse-limit"],
+            limits=limits,
+        )
+        parents.pop(taxon_id, None)
+        if changed_values and taxon_id in changed:
+            yield node["_id"], node["_source"]
+
+
+def fill_from_changed_ancestors(es, opts, *, template, tree, changed):
+    """Fill descendant values below changed taxa, starting from the deepest."""
+    index = template["index_name"]
+    attrs = descending_attributes(template["types"]["attributes"])
+    taxon_ids = [
+        taxon_id
+        for taxon_id in tree.taxon_ids[tree.bottom_up_order()]
+        if taxon_id in changed
+    ]
+    nodes = stream_nodes_by_taxon_ids(es, index=index, taxon_ids=taxon_ids, opts=opts)
+    for depth, level in groupby(
+        nodes, key=lambda node: tree.depth[tree.index[node["_source"]["taxon_id"]]]
+    ):
+        profiler.set_depth(depth)
+        index_attribute_updates(
+            es,
+            opts,
+            index=index,
+            stream=stream_missing_attributes_at_level(
+                es,
+                nodes=profiler.counted_nodes(level),
+                attrs=attrs,
+                template=template,
+                size=search_page_size(opts),
+                **msearch_options(opts),
+            ),
+            attrs=attrs,
+        )
+
+
+def stream_nodes_by_taxon_ids(es, *, index, taxon_ids, opts):
+    """Stream entries for a list of taxon IDs."""
+    responses = stream_msearch_template(
+        es,
+        "taxon_attributes_by_taxon_id",
+        index,
+        ({"taxon_id": taxon_id} for taxon_id in taxon_ids),
+        **msearch_options(opts),
+    )
+    for res in responses:
+        yield from response_hits(res).get("hits", [])
+
+
+def traverse_lineages(es, opts, template, changed, *, state=None):
+    """Recompute values for a connected set of taxa below the root taxon.
+
+    Without state, the direct children of each taxon are loaded to pass their
+    stored values up, or the whole tree if any attribute is summarised with a
+    sketch. With state collected from subtree workers, only the taxa
+    themselves are loaded and traversal starts from the workers' values.
+    """
+    index = template["index_name"]
+    sketched = sketch_attributes(template["types"]["attributes"])
+    if state is None and sketched:
+        LOGGER.info(
+            "Loading all taxa below %s to recompute sketch summaries for %s",
+            opts["traverse-root"],
+            ", ".join(sketched),
+        )
+        nodes = stream_nodes_by_root(
+            es,
+            index=index,
+            root=opts["traverse-root"],
+            max_depth=get_max_depth_by_lineage(
+                es, index=index, root=opts["traverse-root"]
+            ),
+            size=search_page_size(opts),
+            slices=search_slices(opts),
+        )
+        state = {"recompute": True}
+    elif state is None:
+        nodes = chain(
+            stream_nodes_by_root_depth(
+                es,
+                index=index,
+                root=opts["traverse-root"],
+                depth=0,
+                size=search_page_size(opts),
+            ),
+            stream_nodes_by_parents(
+                es, index=index, parents=sorted(changed), opts=opts
+            ),
+        )
+        state = {}
+    else:
+        nodes = stream_nodes_by_taxon_ids(
+            es, index=index, taxon_ids=sorted(changed), opts=opts
+        )
+    profiler.set_depth(None)
+    tree = TaxonTree(profiler.timed_reads(nodes), template["types"]["attributes"])
+    if "traverse-infer-ancestors" in opts:
+        index_attribute_updates(
+            es,
+            opts,
+            index=index,
+            stream=traverse_changes(
+                opts, template=template, tree=tree, changed=changed, **state
+            ),
+            attrs=template["types"]["attributes"],
+        )
+    if "traverse-infer-descendants" in opts or opts.get("traverse-infer-both"):
+        LOGGER.info("Inferring descendant values below %d taxa", len(changed))
+        fill_from_changed_ancestors(
+            es, opts, template=template, tree=tree, changed=changed
+        )
+
+
+def traverse_change_log(es, opts, template):
+    """Recompute values only in the lineages of taxa listed in a change log."""
+    root = opts["traverse-root"]
+    changes = read_change_log(opts["change-log"])
+    changed = set(
+        stream_changed_lineages(
+            es, index=template["index_name"], root=root, changes=changes, opts=opts
+        )
+    )
+    if not changed:
+        LOGGER.info("No changed taxa found below root taxon %s", root)
+        return
+    LOGGER.info(
+        "Filling values in %d lineage nodes for %d changed taxa",
+        len(changed),
+        len(changes),
+    )
+    traverse_lineages(es, opts, template, changed)
+
+
 def copy_attribute_summary(source, meta):
     """Copy an attribute summary, removing values."""
     dest = {}
@@ -881,28 +1557,39 @@ def copy_attribute_summary(source, meta):
     return dest
 
 
-def stream_missing_attributes_at_level(es, *, nodes, attrs, template, level=1):
+def stream_missing_attributes_at_level(
+    es,
+    *,
+    nodes,
+    attrs,
+    template,
+    level=1,
+    size=SEARCH_PAGE_SIZE,
+    batch_size=MSEARCH_BATCH_SIZE,
+    threads=MSEARCH_THREADS,
+):
     """Stream all descendant nodes with missing attributes."""
-    for node in nodes:
-        taxon_id = node["_source"]["taxon_id"]
-        fill_attrs = []
-        if "attributes" in node["_source"]:
-            fill_attrs.extend(
-                attribute
-                for attribute in node["_source"]["attributes"]
+    meta = template["types"]["attributes"]
+    ancestors = (
+        (
+            node["_source"]["taxon_id"],
+            {
+                attribute["key"]: attribute
+                for attribute in node["_source"].get("attributes") or []
                 if attribute["key"] in attrs
-            )
-        if not fill_attrs:
-            continue
-        meta = template["types"]["attributes"]
-        desc_nodes = stream_descendant_nodes_missing_attributes(
-            es,
-            index=template["index_name"],
-            attributes=fill_attrs,
-            root=taxon_id,
-            size=50,
+            },
         )
-        anc_attributes = {attr["key"]: attr for attr in fill_attrs}
+        for node in nodes
+    )
+    results = stream_descendant_nodes_missing_attributes(
+        es,
+        index=template["index_name"],
+        ancestors=(ancestor for ancestor in ancestors if ancestor[1]),
+        size=size,
+        batch_size=batch_size,
+        threads=threads,
+    )
+    for _taxon_id, anc_attributes, desc_nodes in profiler.timed_reads(results):
         for desc_node in desc_nodes:
             skip_attrs = set()
             if "attributes" in desc_node["_source"]:
@@ -920,16 +1607,38 @@ def stream_missing_attributes_at_level(es, *, nodes, attrs, template, level=1):
             yield desc_node["_id"], desc_node["_source"]
 
 
-def traverse_from_root(es, opts, *, template, root=None, max_depth=None, log=True):
-    """Traverse a tree, filling in values."""
-    if root is None:
-        root = opts["traverse-root"]
-    if max_depth is None:
-        max_depth = get_max_depth_by_lineage(
-            es, index=template["index_name"], root=root
+def attribute_updates(stream, attrs):
+    """Convert (id, source) tuples to partial updates of filled attributes.
+
+    Only entries for attributes in attrs are kept and their raw values lists
+    are dropped, as these are unchanged by fill.
+    """
+    for doc_id, source in stream:
+        attributes = [
+            {key: value for key, value in attribute.items() if key != "values"}
+            for attribute in source.get("attributes") or []
+            if attribute["key"] in attrs
+        ]
+        if attributes:
+            yield doc_id, {"attributes": attributes}
+
+
+def index_attribute_updates(es, opts, *, index, stream, attrs):
+    """Index partial updates of filled attributes using a stored script."""
+    with profiler.timed_bulk():
+        return index_stream(
+            es,
+            index,
+            attribute_updates(profiler.timed_writes(stream), attrs),
+            _op_type="update",
+            log=opts.get("log-es", True),
+            script="update_taxon_attributes",
+            **bulk_options(opts, refresh=True),
         )
-    root_depth = max_depth - 1
-    meta = template["types"]["attributes"]
+
+
+def descending_attributes(meta):
+    """List attributes with values that may be inferred from ancestral taxa."""
     attrs = set({})
     for key, value in meta.items():
         if (
@@ -940,46 +1649,78 @@ def traverse_from_root(es, opts, *, template, root=None, max_depth=None, log=Tru
             )
         ):
             attrs.add(key)
+    return attrs
+
+
+def traverse_from_root(es, opts, *, template, root=None, max_depth=None, log=True):
+    """Traverse a tree, filling in values."""
+    if root is None:
+        root = opts["traverse-root"]
+    if max_depth is None:
+        max_depth = get_max_depth_by_lineage(
+            es, index=template["index_name"], root=root
+        )
+    root_depth = max_depth - 1
+    attrs = descending_attributes(template["types"]["attributes"])
     while root_depth >= 0:
         LOGGER.info("Filling values at root depth %d" % root_depth)
+        profiler.set_depth(root_depth)
         nodes = stream_nodes_by_root_depth(
-            es, index=template["index_name"], root=root, depth=root_depth, size=50
+            es,
+            index=template["index_name"],
+            root=root,
+            depth=root_depth,
+            size=search_page_size(opts),
+            slices=search_slices(opts),
         )
         desc_nodes = stream_missing_attributes_at_level(
-            es, nodes=nodes, attrs=attrs, template=template
+            es,
+            nodes=profiler.counted_nodes(nodes),
+            attrs=attrs,
+            template=template,
+            size=search_page_size(opts),
+            **msearch_options(opts),
         )
-        index_stream(
+        index_attribute_updates(
             es,
-            template["index_name"],
-            desc_nodes,
-            _op_type="update",
-            log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
+            opts,
+            index=template["index_name"],
+            stream=desc_nodes,
+            attrs=attrs,
         )
         root_depth -= 1
 
 
-def traverse_tree(es, opts, template, root, max_depth):
-    """Propagate values by tree traversal."""
+def traverse_tree(es, opts, template, root, max_depth, state=None):
+    """Propagate values by tree traversal.
+
+    If a state dict is given, values passed to ancestors outside the tree are
+    left in its parents, limits and descendant_ranks stores.
+    """
     log = True
     if es is None:
         log = False
-        es = launch_es(opts, log=log)
+        es = es_client(opts)
     if "traverse-infer-ancestors" in opts:
         LOGGER.info("Inferring ancestral values for root taxon %s", root)
-        _success, _failed = index_stream(
+        traverse = (
+            traverse_in_memory
+            if opts.get("traverse-in-memory", False)
+            else traverse_from_tips
+        )
+        _success, _failed = index_attribute_updates(
             es,
-            template["index_name"],
-            traverse_from_tips(
+            opts,
+            index=template["index_name"],
+            stream=traverse(
                 es,
                 opts,
                 template=template,
                 root=root,
                 max_depth=max_depth,
+                **(state or {}),
             ),
-            _op_type="update",
-            log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
+            attrs=template["types"]["attributes"],
         )
     if "traverse-infer-descendants" in opts:
         if log:
@@ -989,44 +1730,179 @@ def traverse_tree(es, opts, template, root, max_depth):
         )
 
 
+def stream_child_ids(es, *, index, parent, opts):
+    """Stream taxon IDs of the direct children of a taxon."""
+    body = {"id": "taxon_ids_by_parent", "params": {"taxon_id": parent}}
+    for hit in stream_template_search_results(
+        es, index=index, body=body, size=search_page_size(opts), ordered=False
+    ):
+        yield hit["_source"]["taxon_id"]
+
+
+def descendant_counts(es, *, index, taxon_ids, opts):
+    """Count descendants of each taxon in a list."""
+    responses = stream_msearch_template(
+        es,
+        "taxon_count_by_ancestor",
+        index,
+        ({"taxon_id": taxon_id} for taxon_id in taxon_ids),
+        **msearch_options(opts),
+    )
+    counts = {}
+    for taxon_id, res in zip(taxon_ids, responses):
+        total = response_hits(res).get("total", 0)
+        counts[taxon_id] = total["value"] if isinstance(total, dict) else total
+    return counts
+
+
+def plan_subtrees(es, *, index, root, threads, opts):
+    """Split a tree into groups of subtrees of similar size.
+
+    Subtrees larger than the target size are split into their child subtrees
+    until they fit or --traverse-depth is reached. Small sibling subtrees are
+    grouped to fill a task. Returns tasks as (roots, node count, root depth)
+    tuples, largest first, the set of split taxa and the total node count.
+    """
+    total = descendant_counts(es, index=index, taxon_ids=[root], opts=opts)[root] + 1
+    target = max(1, total // (threads * SUBTREES_PER_THREAD))
+    max_split_depth = int(opts.get("traverse-depth", 0)) or None
+    tasks = []
+    split = set()
+    pending = [(root, total, 0)]
+    while pending:
+        taxon_id, size, depth = pending.pop()
+        child_ids = []
+        if size > target and depth != max_split_depth:
+            child_ids = list(
+                stream_child_ids(es, index=index, parent=taxon_id, opts=opts)
+            )
+        if not child_ids:
+            tasks.append(([taxon_id], size, depth))
+            continue
+        split.add(taxon_id)
+        counts = descendant_counts(es, index=index, taxon_ids=child_ids, opts=opts)
+        group, group_size = [], 0
+        for child_id in child_ids:
+            child_size = counts[child_id] + 1
+            if child_size > target:
+                pending.append((child_id, child_size, depth + 1))
+                continue
+            if group_size + child_size > target:
+                tasks.append((group, group_size, depth + 1))
+                group, group_size = [], 0
+            group.append(child_id)
+            group_size += child_size
+        if group:
+            tasks.append((group, group_size, depth + 1))
+    tasks.sort(key=lambda task: task[1], reverse=True)
+    return tasks, split, total
+
+
+def subtree_state():
+    """Create stores for values passed from subtrees to their ancestors."""
+    return {
+        "parents": descendant_values_store(),
+        "limits": defaultdict(set),
+        "descendant_ranks": defaultdict(set),
+    }
+
+
+def export_subtree_state(state):
+    """Convert subtree state to plain containers to return from a worker."""
+    outside = set(state["descendant_ranks"])
+    return {
+        "parents": {
+            parent: {key: dict(obj) for key, obj in values.items()}
+            for parent, values in state["parents"].items()
+        },
+        "limits": {key: ids & outside for key, ids in state["limits"].items()},
+        "descendant_ranks": dict(state["descendant_ranks"]),
+    }
+
+
+def merge_subtree_state(state, subtree):
+    """Merge values returned by a subtree worker into the connecting state."""
+    for parent, values in subtree["parents"].items():
+        for key, obj in values.items():
+            merged = state["parents"][parent][key]
+            merged["count"] += obj["count"]
+            merged["sp_count"] += obj["sp_count"]
+            merged["values"] += obj["values"]
+            merged["prefixed_values"] += obj["prefixed_values"]
+            for bound, func in (("max", latest), ("min", earliest)):
+                if obj[bound] is not None:
+                    merged[bound] = (
+                        obj[bound]
+                        if merged[bound] is None
+                        else func(merged[bound], obj[bound])
+                    )
+    for key, ids in subtree["limits"].items():
+        state["limits"][key].update(ids)
+    for parent, ranks in subtree["descendant_ranks"].items():
+        state["descendant_ranks"][parent].update(ranks)
+
+
 def traverse_helper(params):
-    """Wrap traverse_tree for multithreaded traversal."""
+    """Wrap traverse_tree for multithreaded traversal of a group of subtrees.
+
+    Returns the number of nodes, the values passed to the subtree roots'
+    parents so that the connecting pass need not read them back and, if
+    profiling, the subtree profile.
+    """
+    es, opts, template, roots, size, depth = params
+    state = subtree_state()
+    if "profile" in opts:
+        profiler.start_profile(offset=depth)
     with tolog.DisableLogger():
-        traverse_tree(*params)
-    return params[3]
+        for root in roots:
+            traverse_tree(es, opts, template, root, None, state=state)
+    return size, export_subtree_state(state), profiler.stop_profile()
 
 
 def traverse_handler(es, opts, template):
     """Handle single or multi-threaded tree traversal."""
+    if "change-log" in opts:
+        traverse_change_log(es, opts, template)
+        return
     root = opts["traverse-root"]
     threads = int(opts["traverse-threads"])
-    max_depth = get_max_depth_by_lineage(es, index=template["index_name"], root=root)
-    subtree_depth = int(opts.get("traverse-depth", 0))
-    if threads > 1 and subtree_depth == 0:
-        subtree_depth = int(max_depth / 2)
     if threads == 1:
+        max_depth = get_max_depth_by_lineage(
+            es, index=template["index_name"], root=root
+        )
         traverse_tree(es, opts, template, root, max_depth)
         return
 
-    max_depth -= subtree_depth
-
-    nodes = stream_nodes_by_root_depth(
-        es, index=template["index_name"], root=root, depth=subtree_depth
+    tasks, split, total = plan_subtrees(
+        es, index=template["index_name"], root=root, threads=threads, opts=opts
     )
-    roots = [
-        (None, opts, template, node["_source"]["taxon_id"], max_depth) for node in nodes
-    ]
-    LOGGER.info("Filling values in subtrees")
+    LOGGER.info(
+        "Filling values in %d subtree groups below %d split taxa",
+        len(tasks),
+        len(split),
+    )
+    state = subtree_state()
     with Pool(processes=threads) as p:
         with tqdm(
-            total=len(roots),
-            unit=" subtrees",
+            total=total,
+            unit=" nodes",
+            unit_scale=True,
             mininterval=int(opts.get("log-interval", 1)),
         ) as pbar:
-            for _ in p.imap_unordered(traverse_helper, roots):
-                pbar.update()
-    LOGGER.info("Connecting subtrees")
-    traverse_tree(es, opts, template, opts["traverse-root"], subtree_depth)
+            for size, subtree, profile in p.imap_unordered(
+                traverse_helper,
+                (
+                    (None, opts, template, roots, size, depth)
+                    for roots, size, depth in tasks
+                ),
+            ):
+                merge_subtree_state(state, subtree)
+                if profile is not None:
+                    profiler.PROFILE.merge(profile)
+                pbar.update(size)
+    if split:
+        LOGGER.info("Connecting subtrees")
+        traverse_lineages(es, opts, template, split, state=state)
 
 
 def main(args):
@@ -1050,8 +1926,17 @@ def main(args):
         template = taxon.index_template(taxonomy_name, options["fill"])
         if types:
             template["types"]["attributes"] = types
+            check_summary_precision(types)
         if "traverse-root" in options["fill"]:
-            traverse_handler(es, options["fill"], template)
+            profile = profiler.start_profile() if "profile" in options["fill"] else None
+            with bulk_load_settings(
+                es,
+                [template["index_name"]],
+                enabled=options["fill"].get("es-bulk-load", False),
+            ):
+                traverse_handler(es, options["fill"], template)
+            if profile is not None:
+                profile.report(options["fill"]["profile"])
 
 
 def cli():
@@ -4,11 +4,13 @@
 
 import contextlib
 import csv
+import gzip
 import json
 import os
 import re
 import shutil
 import sys
+from collections import OrderedDict
 from collections import defaultdict
 from copy import deepcopy
 from operator import add
@@ -24,10 +26,27 @@ from h3 import latlng_to_cell
 from genomehubs.vendor.tolkein import tofile
 from genomehubs.vendor.tolkein import tolog
 
+from .es_functions import msearch_options
+from .es_functions import stream_msearch_template
+from .reader import comment_characters
+
 LOGGER = tolog.logger(__name__)
 MIN_INTEGER = -(2**31)
 MAX_INTEGER = 2**31 - 1
 DATE = re.compile(r"^[12]\d{3}-[01]\d-[0123]\d$")
+SCIENTIFIC = re.compile(r"^\d+\.\d+e[\+-]\d+$")
+ATTRIBUTE_TEMPLATE = re.compile(r"\{\.(.+?)\}")
+ATTRIBUTE_CACHE_SIZE = 100000
+VALUE_TEMPLATE = re.compile(r"^(.*?\{\{)(.+)(\}\}.*)$")
+ROW_GROUPS = (
+    "attributes",
+    "features",
+    "identifiers",
+    "metadata",
+    "taxon_names",
+    "taxonomy",
+    "taxon_attributes",
+)
 
 
 def setup(opts):
@@ -245,19 +264,21 @@ def date_constraint(value, enum):
     return DATE.match(value)
 
 
+CONSTRAINTS = {
+    "byte": byte_type_constraint,
+    "integer": integer_type_constraint,
+    "short": short_type_constraint,
+    "min": min_value_constraint,
+    "max": max_value_constraint,
+    "enum": enum_constraint,
+    "date": date_constraint,
+}
+
+
 def test_constraint(value, constraint):
     """Test value against constraint."""
-    constraints = {
-        "byte": byte_type_constraint,
-        "integer": integer_type_constraint,
-        "short": short_type_constraint,
-        "min": min_value_constraint,
-        "max": max_value_constraint,
-        "enum": enum_constraint,
-        "date": date_constraint,
-    }
     return not any(
-        key in constraints and not constraints[key](value, constraint[key])
+        key in CONSTRAINTS and not CONSTRAINTS[key](value, constraint[key])
         for key in constraint
     )
 
@@ -411,50 +432,63 @@ def calculate(string):
 
 def attribute_value_query(es, index, opts=None):
     """Run attribute value query."""
-    query = {
-        "bool": {
-            "filter": [
-                {"match": {opts["id_field"]: opts["primary_id"]}},
-                {
-                    "nested": {
-                        "path": "attributes",
-                        "query": {
-                            "bool": {
-                                "filter": [
-                                    {"match": {"attributes.key": opts["attribute"]}}
-                                ]
-                            }
-                        },
-                        "inner_hits": {
-                            "_source": False,
-                            "name": "%s_values" % opts["attribute"],
-                            "docvalue_fields": [
-                                "attributes.key",
-                                "attributes.%s_value" % opts["value_type"],
-                            ],
-                        },
-                    }
-                },
-            ]
-        }
-    }
-    return es.search(index=index, body={"query": query, "_source": False})
+    body = {"id": "attribute_value_by_primary_id", "params": opts}
+    with tolog.DisableLogger():
+        return es.search_template(index=index, body=body)
 
 
-def lookup_attribute_value(identifier, attribute, shared_values):
-    """Lookup an indexed attribute value."""
-    value_type = shared_values["_types"]["attributes"][attribute]["type"]
-    opts = {
+class AttributeValueCache:
+    """Bounded LRU cache of indexed attribute values.
+
+    Values are keyed by (identifier, attribute). Lookups that found no value
+    are not cached, as the value may be indexed from a later file.
+    """
+
+    def __init__(self, size=ATTRIBUTE_CACHE_SIZE):
+        """Init AttributeValueCache class."""
+        self.size = size
+        self._values = OrderedDict()
+
+    def __contains__(self, key):
+        """Test whether a value is cached."""
+        return key in self._values
+
+    def __getitem__(self, key):
+        """Get a cached value, marking it as recently used."""
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        """Cache a value, discarding the least recently used value if full."""
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.size:
+            self._values.popitem(last=False)
+
+    def __len__(self):
+        """Return number of cached values."""
+        return len(self._values)
+
+
+def attribute_value_cache(shared_values):
+    """Get the attribute value cache from shared values, adding one if missing."""
+    if not isinstance(shared_values.get("_attribute_values"), AttributeValueCache):
+        shared_values["_attribute_values"] = AttributeValueCache()
+    return shared_values["_attribute_values"]
+
+
+def attribute_lookup_params(identifier, attribute, shared_values):
+    """Set attribute value query parameters."""
+    return {
         "id_field": f'{shared_values["_index_type"]}_id',
         "primary_id": identifier,
         "attribute": attribute,
-        "value_type": value_type,
+        "value_type": shared_values["_types"]["attributes"][attribute]["type"],
     }
-    res = attribute_value_query(
-        shared_values["_es"],
-        shared_values["_index"],
-        opts,
-    )
+
+
+def attribute_value_from_response(res, attribute, value_type):
+    """Get a single attribute value from an attribute value query response."""
     hits = res["hits"]["hits"]
     try:
         if len(hits) == 1:
@@ -462,7 +496,6 @@ def lookup_attribute_value(identifier, attribute, shared_values):
             if len(inner_hits) == 1:
                 field_values = inner_hits[0]["fields"][f"attributes.{value_type}_value"]
                 if len(field_values) == 1:
-                    shared_values[identifier][attribute] = field_values[0]
                     return field_values[0]
     except KeyError:
         print(inner_hits)
@@ -470,6 +503,91 @@ def lookup_attribute_value(identifier, attribute, shared_values):
     return None
 
 
+def lookup_attribute_value(identifier, attribute, shared_values):
+    """Lookup an indexed attribute value."""
+    cache = attribute_value_cache(shared_values)
+    if (identifier, attribute) in cache:
+        return cache[(identifier, attribute)]
+    opts = attribute_lookup_params(identifier, attribute, shared_values)
+    res = attribute_value_query(
+        shared_values["_es"],
+        shared_values["_index"],
+        opts,
+    )
+    value = attribute_value_from_response(res, attribute, opts["value_type"])
+    if value is not None:
+        cache[(identifier, attribute)] = value
+    return value
+
+
+def template_identifiers(row, index, char, pattern, limit):
+    """List values in a row column that function templates use as identifiers."""
+    if char is not None:
+        values = [row[i] for i in index]
+        if not all(values):
+            return []
+        value = char.join(values)
+    else:
+        value = row[index]
+    if pattern is not None and any(sep in value for sep in pattern[0]):
+        values = pattern[1].split(value)[:limit]
+    else:
+        values = [value]
+    return [
+        str(float(value)) if SCIENTIFIC.match(value) else value
+        for value in values
+        if value and value != "None"
+    ]
+
+
+def prefetch_attribute_values(rows, plan, shared_values):
+    """Look up indexed attribute values needed by function templates for rows.
+
+    Values for (identifier, attribute) pairs that are not already cached are
+    fetched in multi search batches and added to the attribute value cache.
+    """
+    if not plan or not plan.get("lookups") or not shared_values:
+        return
+    if shared_values.get("_es") is None:
+        return
+    cache = attribute_value_cache(shared_values)
+    attribute_types = shared_values["_types"].get("attributes", {})
+    needed = {}
+    for row in rows:
+        for index, char, pattern, limit, attributes in plan["lookups"]:
+            with contextlib.suppress(IndexError):
+                for identifier in template_identifiers(
+                    row, index, char, pattern, limit
+                ):
+                    for attribute in attributes:
+                        key = (identifier, attribute)
+                        if key not in cache and "type" in attribute_types.get(
+                            attribute, {}
+                        ):
+                            needed[key] = True
+    if not needed:
+        return
+    param_sets = [
+        attribute_lookup_params(identifier, attribute, shared_values)
+        for identifier, attribute in needed
+    ]
+    responses = stream_msearch_template(
+        shared_values["_es"],
+        "attribute_value_by_primary_id",
+        shared_values["_index"],
+        param_sets,
+        **msearch_options(shared_values["_opts"]),
+    )
+    for key, params, res in zip(needed, param_sets, responses):
+        if "hits" in res:
+            value = attribute_value_from_response(
+                res, params["attribute"], params["value_type"]
+            )
+            if value is not None:
+                cache[key] = value
+    LOGGER.debug("Prefetched %d attribute values", len(needed))
+
+
 def apply_template(value, operation, row_values, shared_values):
     """Apply template to a function description."""
     parts = re.split(r"(\{.*?\})", operation)
@@ -482,12 +600,7 @@ def apply_template(value, operation, row_values, shared_values):
                 parts[index] = str(row_values[part])
             elif part.startswith("."):
                 part = part[1:]
-                if value in shared_values and part in shared_values[value]:
-                    parts[index] = str(shared_values[value][part])
-                else:
-                    parts[index] = str(
-                        lookup_attribute_value(value, part, shared_values)
-                    )
+                parts[index] = str(lookup_attribute_value(value, part, shared_values))
                 if parts[index] is None:
                     LOGGER.error("%s has no value for attribute %s", value, part)
                     sys.exit()
@@ -504,54 +617,79 @@ def calculator(value, operation, row_values, shared_values, template_type):
     return operation if template_type == "template" else calculate(operation)
 
 
-def validate_values(values, key, types, row_values, shared_values, blanks):
+def prefixed_properties(meta, prefix):
+    """List (property, value) tuples for properties with a prefix."""
+    return [(prop, value) for prop, value in meta.items() if prop.startswith(prefix)]
+
+
+def compile_value_checks(meta):
+    """Compile template, conversion, constraint and property settings for a key."""
+    template_type = None
+    if "function" in meta:
+        template_type = "function"
+    elif "template" in meta:
+        template_type = "template"
+    checks = []
+    for name, limit in (meta.get("constraint") or {}).items():
+        if name in CONSTRAINTS:
+            if name == "enum":
+                with contextlib.suppress(TypeError):
+                    limit = frozenset(limit)
+            checks.append((CONSTRAINTS[name], limit))
+    return {
+        "type": meta.get("type", "keyword"),
+        "template_type": template_type,
+        "operation": meta.get(template_type),
+        "translate": meta.get("translate", None),
+        "constraints": checks,
+        "source": prefixed_properties(meta, "source"),
+        "taxon": prefixed_properties(meta, "taxon_"),
+    }
+
+
+def validate_values(
+    values, key, types, row_values, shared_values, blanks, *, checks=None
+):
     """Validate values."""
-    validated = []
     if isinstance(types[key], str) or "type" not in types[key]:
         types[key]["type"] = "keyword"
-    key_type = types[key]["type"]
+    if checks is None:
+        checks = compile_value_checks(types[key])
+    validated = []
+    key_type = checks["type"]
+    template_type = checks["template_type"]
+    translate = checks["translate"]
     for value in values:
         if value in blanks:
             continue
-        if "function" in types[key] or "template" in types[key]:
-            if re.match(r"^\d+\.\d+e[\+-]\d+$", value):
+        if template_type is not None:
+            if SCIENTIFIC.match(value):
                 value = str(float(value))
             try:
-                template_type = "function" if "function" in types[key] else "template"
                 value = calculator(
                     value,
-                    types[key][template_type],
+                    checks["operation"],
                     row_values,
                     shared_values,
                     template_type,
                 )
             except ValueError:
                 continue
-        value = convert_to_type(
-            key, value, key_type, translate=types[key].get("translate", None)
-        )
-        if isinstance(types[key], str):
-            validated.append(value)
-            continue
+        value = convert_to_type(key, value, key_type, translate=translate)
         if value is None:
             continue
         if isinstance(value, str):
             if not value:
                 continue
-            with contextlib.suppress(KeyError):
-                value = types[key]["translate"][value.lower()]
+            if translate is not None:
+                with contextlib.suppress(KeyError):
+                    value = translate[value.lower()]
         if not isinstance(value, list):
             value = [value]
         for v in value:
             if not isinstance(v, dict) and v in blanks:
                 continue
-            try:
-                valid = test_constraint(v, key_type)
-                if valid:
-                    valid = test_constraint(v, types[key]["constraint"])
-            except KeyError:
-                valid = True
-            if valid:
+            if all(check(v, limit) for check, limit in checks["constraints"]):
                 validated.append(v)
             elif v:
                 LOGGER.warning("%s is not a valid %s value", str(v), key)
@@ -560,9 +698,8 @@ def validate_values(values, key, types, row_values, shared_values, blanks):
 
 def apply_value_template(prop, value, attribute, *, taxon_types, has_taxon_data):
     """Set value using template."""
-    template = re.compile(r"^(.*?\{\{)(.+)(\}\}.*)$")
     new_prop = prop.replace("taxon_", "")
-    if match := template.match(str(value)):
+    if match := VALUE_TEMPLATE.match(str(value)):
         groups = match.groups()
         if groups[1] and groups[1] in attribute:
             has_taxon_data = True
@@ -635,6 +772,7 @@ def add_attributes(
     shared_values=None,
     row_values=None,
     blanks=None,
+    checks=None,
 ):
     """Add attributes to a document."""
     (
@@ -645,6 +783,8 @@ def add_attributes(
         taxon_types,
         attribute_values,
     ) = set_add_attributes_defaults(attributes, meta, row_values)
+    if checks is None:
+        checks = {}
     indices = {}
     for k, values in entry.items():
         key, *rest = k.split(".") if "." in k else [k]
@@ -668,13 +808,20 @@ def add_attributes(
                 else:
                     md[part] = values
         elif key in types:
+            key_checks = checks.get(key)
             if not isinstance(values, list):
                 values = [values]
             if attr_type == "taxon_names":
                 validated = values
             else:
                 validated = validate_values(
-                    values, key, types, row_values, shared_values, blanks
+                    values,
+                    key,
+                    types,
+                    row_values,
+                    shared_values,
+                    blanks,
+                    checks=key_checks,
                 )
             # TODO: handle invalid values
             if validated:
@@ -693,8 +840,12 @@ def add_attributes(
                     attribute.update(
                         {
                             k: v
-                            for k, v in types[key].items()
-                            if k.startswith("source") and k not in attribute
+                            for k, v in (
+                                key_checks["source"]
+                                if key_checks
+                                else prefixed_properties(types[key], "source")
+                            )
+                            if k not in attribute
                         }
                     )
                 else:
@@ -735,16 +886,20 @@ def add_attributes(
             taxon_attribute_types = {**types[attribute["key"]]}
             taxon_attribute = {**attribute, "source_index": "assembly"}
             # taxon_props = []
-            for prop, value in types[attribute["key"]].items():
-                if prop.startswith("taxon_"):
-                    has_taxon_data = apply_value_template(
-                        prop,
-                        value,
-                        attribute,
-                        taxon_types=taxon_attribute_types,
-                        has_taxon_data=has_taxon_data,
-                    )
-                    # taxon_props.append(prop)
+            key_checks = checks.get(attribute["key"])
+            for prop, value in (
+                key_checks["taxon"]
+                if key_checks
+                else prefixed_properties(types[attribute["key"]], "taxon_")
+            ):
+                has_taxon_data = apply_value_template(
+                    prop,
+                    value,
+                    attribute,
+                    taxon_types=taxon_attribute_types,
+                    has_taxon_data=has_taxon_data,
+                )
+                # taxon_props.append(prop)
             # for prop in taxon_props:
             #     del types[attribute["key"]][prop]
             if has_taxon_data:
@@ -818,9 +973,7 @@ def add_attribute_values(existing, new, *, raw=True):
 
 def strip_comments(data, types):
     """Strip comment lines from a file stream."""
-    comment_chars = {"#"}
-    if "file" in types and "comment" in types["file"]:
-        comment_chars.update(set(types["file"]["comment"]))
+    comment_chars = comment_characters(types)
     for row in data:
         if row[0] in comment_chars:
             continue
@@ -887,45 +1040,73 @@ def set_row_defaults(types, data):
             data["metadata"] = {**types["defaults"]["metadata"]}
 
 
-def process_row_values(row, types, data):
+def compile_row_plan(types):
+    """Compile types into a plan for extracting and validating row values.
+
+    Columns are listed as (group, key, index, value, join, pattern, limit)
+    tuples. Keys without an index have a fixed value and list indices are
+    joined with the join string. Separator patterns are compiled once and
+    conversion, constraint and property settings are compiled for each key.
+    Columns with function templates that look up indexed attribute values are
+    listed as (index, join, pattern, limit, attributes) lookups.
+    """
+    columns = []
+    checks = defaultdict(dict)
+    lookups = []
+    for group in ROW_GROUPS:
+        for key, meta in types.get(group, {}).items():
+            if not isinstance(meta, dict):
+                columns.append((group, key, None, meta, None, None, None))
+                continue
+            checks[group][key] = compile_value_checks(meta)
+            if "index" not in meta:
+                if "default" in meta:
+                    columns.append(
+                        (group, key, None, meta["default"], None, None, None)
+                    )
+                continue
+            pattern = None
+            if "separator" in meta:
+                separator = "|".join([re.escape(sep) for sep in meta["separator"]])
+                pattern = (meta["separator"], re.compile(rf"\s*{separator}\s*"))
+            join = meta.get("join", "") if isinstance(meta["index"], list) else None
+            limit = meta.get("limit")
+            columns.append((group, key, meta["index"], None, join, pattern, limit))
+            if checks[group][key]["template_type"] is not None:
+                operation = str(checks[group][key]["operation"])
+                if attributes := ATTRIBUTE_TEMPLATE.findall(operation):
+                    lookups.append((meta["index"], join, pattern, limit, attributes))
+    return {"columns": columns, "checks": checks, "lookups": lookups}
+
+
+def process_row_values(row, types, data, *, plan=None):
     """Process row values."""
-    for group in data.keys():
-        if group in types:
-            for key, meta in types[group].items():
-                if not isinstance(meta, dict):
-                    data[group][key] = meta
-                    continue
-                if "index" not in meta:
-                    if "default" in meta:
-                        data[group][key] = meta["default"]
+    if plan is None:
+        plan = compile_row_plan(types)
+    try:
+        for group, key, index, value, char, pattern, limit in plan["columns"]:
+            if index is None:
+                data[group][key] = value
+                continue
+            if char is not None:
+                values = [row[i] for i in index]
+                if not all(values):
                     continue
-                try:
-                    if isinstance(meta["index"], list):
-                        char = meta.get("join", "")
-                        values = [row[i] for i in meta["index"]]
-                        if all(values):
-                            value = char.join(values)
-                        else:
-                            continue
-                    else:
-                        value = row[meta["index"]]
-                    if "separator" in meta and any(
-                        sep in value for sep in meta["separator"]
-                    ):
-                        separator = "|".join(
-                            [re.escape(sep) for sep in meta["separator"]]
-                        )
-                        data[group][key] = re.split(rf"\s*{separator}\s*", value)
-                        if "limit" in meta:
-                            data[group][key] = data[group][key][: meta["limit"]]
-                    elif value is not None and value != "None":
-                        data[group][key] = value
-                except IndexError:
-                    LOGGER.warning(f"Missing fields in row '{str(row)}'")
-                    return None
-                except Exception as err:
-                    LOGGER.warning(f"Cannot parse row '{str(row)}'")
-                    raise err
+                value = char.join(values)
+            else:
+                value = row[index]
+            if pattern is not None and any(sep in value for sep in pattern[0]):
+                data[group][key] = pattern[1].split(value)
+                if limit is not None:
+                    data[group][key] = data[group][key][:limit]
+            elif value is not None and value != "None":
+                data[group][key] = value
+    except IndexError:
+        LOGGER.warning(f"Missing fields in row '{str(row)}'")
+        return None
+    except Exception as err:
+        LOGGER.warning(f"Cannot parse row '{str(row)}'")
+        raise err
     return True
 
 
@@ -961,9 +1142,21 @@ def contains_excluded_value(data, exclusions):
 
 
 def process_row(
-    types, names, row, shared_values, blanks, *, index_type="assembly", exclusions=None
+    types,
+    names,
+    row,
+    shared_values,
+    blanks,
+    *,
+    index_type="assembly",
+    exclusions=None,
+    plan=None,
 ):
-    """Process a row of data."""
+    """Process a row of data.
+
+    A plan from compile_row_plan may be passed to avoid compiling the types
+    for every row.
+    """
     data = {
         "attributes": {},
         "features": {},
@@ -974,7 +1167,9 @@ def process_row(
         "taxon_attributes": {},
     }
     set_row_defaults(types, data)
-    if process_row_values(row, types, data) is None:
+    if plan is None:
+        plan = compile_row_plan(types)
+    if process_row_values(row, types, data, plan=plan) is None:
         return None, None, None
     if exclusions is None:
         exclusions = defaultdict(dict)
@@ -1012,6 +1207,7 @@ def process_row(
                 shared_values=shared_values,
                 row_values=row_values,
                 blanks=blanks,
+                checks=plan["checks"].get(attr_type),
             )
         else:
             data[attr_type] = []
@@ -1077,8 +1273,25 @@ def set_column_indices(types, header):
                     )
 
 
-def write_imported_rows(rows, opts, *, types, header=None, label="imported"):
-    """Write imported rows to processed file."""
+def append_rows(outfile, rows):
+    """Append rows to a delimited, optionally gzipped, file."""
+    opener = gzip.open if ".gz" in outfile else open
+    with opener(outfile, "at", newline="") as fh:
+        if ".csv" in outfile:
+            writer = csv.writer(fh, quoting=csv.QUOTE_NONNUMERIC)
+        else:
+            writer = csv.writer(fh, delimiter="\t")
+        writer.writerows(rows)
+
+
+def write_imported_rows(
+    rows, opts, *, types, header=None, label="imported", append=False
+):
+    """Write imported rows to processed file.
+
+    With append set, rows are added to the end of an existing file without
+    a header, so that large files can be written in batches.
+    """
     file_key = f'{opts["index"]}-exception'
     dir_key = f'{opts["index"]}-dir'
     if file_key in opts and opts[file_key]:
@@ -1089,7 +1302,7 @@ def write_imported_rows(rows, opts, *, types, header=None, label="imported"):
     outfile = f'{outdir}/{types["file"]["name"]}'
     data = []
     header_len = 0
-    if header is not None:
+    if header is not None and not append:
         data.append(header)
         header_len = 1
     if isinstance(rows, dict):
@@ -1100,7 +1313,10 @@ def write_imported_rows(rows, opts, *, types, header=None, label="imported"):
     LOGGER.info(
         "Writing %d records to %s file '%s'", len(data) - header_len, label, outfile
     )
-    tofile.write_file(outfile, data)
+    if append:
+        append_rows(outfile, data)
+    else:
+        tofile.write_file(outfile, data)
 
 
 def write_spellchecked_taxa(spellings, opts, *, types):
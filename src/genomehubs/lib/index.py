@@ -6,7 +6,13 @@ Index a file, directory or repository.
 Usage:
     genomehubs index [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                      [--config-file PATH...] [--config-save PATH]
-                     [--es-batch INT] [--es-host URL...] [--assembly-dir PATH]
+                     [--es-batch INT] [--es-host URL...] [--es-threads INT]
+                     [--es-max-bytes INT] [--es-chunk-bytes INT] [--es-dead-letter PATH]
+                     [--es-bulk-load] [--es-skip-refresh] [--es-page-size INT]
+                     [--es-connections INT] [--es-compress] [--es-sniff]
+                     [--es-slices INT] [--es-msearch-batch INT]
+                     [--es-msearch-threads INT]
+                     [--assembly-dir PATH]
                      [--feature-dir PATH] [--sample-dir PATH]
                      [--taxon-dir PATH] [--taxon-repo URL] [--taxon-exception PATH]
                      [--taxon-lookup STRING] [--taxon-lookup-root STRING]
@@ -19,6 +25,8 @@ Usage:
                      [--taxon-id STRING] [--assembly-id STRING]
                      [--sample-id STRING] [--analysis-id STRING]
                      [--file-title STRING] [--file-description STRING] [--file-metadata PATH]
+                     [--change-log PATH] [--index-threads INT] [--index-window INT]
+                     [--index-fast-reader]
                      [--dry-run] [--log-interval INT] [--log-es BOOL]
                      [-h|--help] [-v|--version]
 
@@ -29,6 +37,19 @@ Options:
     --config-file PATH         Path to YAML file containing configuration options.
     --config-save PATH         Path to write configuration options to YAML file.
     --es-batch INT             Batch size for ElasticSearch bulk indexing.
+    --es-threads INT           Number of threads for ElasticSearch bulk indexing.
+    --es-max-bytes INT         Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-chunk-bytes INT       Target size (bytes) for adaptive ElasticSearch bulk requests.
+    --es-dead-letter PATH      Path to JSON Lines file for documents that fail to index.
+    --es-bulk-load             Disable refresh and replicas until indexing completes.
+    --es-skip-refresh          Skip index refresh after each bulk indexing call.
+    --es-page-size INT         Page size (1-10000) for streaming ElasticSearch results.
+    --es-slices INT            Number of parallel slices for streaming large results.
+    --es-connections INT       Number of HTTP connections per ElasticSearch node.
+    --es-compress              Use gzip compression for ElasticSearch requests.
+    --es-sniff                 Discover ElasticSearch nodes by sniffing the cluster.
+    --es-msearch-batch INT     Number of searches per ElasticSearch multi search request.
+    --es-msearch-threads INT   Number of concurrent ElasticSearch multi search requests.
     --es-host URL              ElasticSearch hostname/URL and port.
     --assembly-dir PATH        Path to directory containing assembly-level data.
     --sample-dir PATH          Path to directory containing sample-level data.
@@ -57,6 +78,10 @@ Options:
     --file-description STRING  Default description for all indexed files.
     --file-metadata PATH       CSV, TSV, YAML or JSON file metadata with one entry per file to be indexed.
     --blank STRING...          List of strings to treat as blank values in files. Default: ['', 'NA', 'N/A', 'None']
+    --change-log PATH          Path to file to append IDs of taxa with new attribute values.
+    --index-threads INT        Number of processes to use to process rows in each file. [Default: 1]
+    --index-window INT         Number of rows with taxon IDs to index at a time to limit memory use.
+    --index-fast-reader        Read files in blocks of lines, only using a CSV parser for quoted lines.
     --dry-run                  Flag to run without loading data into the elasticsearch index.
     --log-interval INT         Minimum time (seconds) between prgress bar updates
     --log-es BOOL              Show Info-level logs from elasticsearch
@@ -73,7 +98,13 @@ import sys
 
 # import time
 from collections import defaultdict
+from collections import deque
+from itertools import chain
+from itertools import islice
+from multiprocessing import Pool
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 from time import sleep
 from traceback import format_exc
 
@@ -88,17 +119,28 @@ from ..lib import hub
 from ..lib import taxon
 from . import sample
 from .attributes import index_types
+from .changelog import record_changed_taxa
+from .changelog import write_change_log
 from .config import config
+from .es_functions import bulk_options
+from .es_functions import es_client
 from .es_functions import index_stream
+from .es_functions import msearch_options
 from .files import index_files
 from .files import index_metadata
+from .files import index_template as files_index_template
+from .hub import AttributeValueCache
+from .hub import compile_row_plan
 from .hub import list_files
+from .hub import prefetch_attribute_values
 from .hub import process_row
 from .hub import set_column_indices
 from .hub import strip_comments
 from .hub import write_imported_rows
 from .hub import write_imported_taxa
 from .hub import write_spellchecked_taxa
+from .reader import comment_characters
+from .reader import read_blocks
 from .sample import add_identifiers_and_attributes_to_entries
 from .taxon import add_names_and_attributes_to_taxa
 from .taxon import fix_missing_ids
@@ -109,6 +151,9 @@ from .validate import validate_types_file
 from .version import __version__
 
 LOGGER = tolog.logger(__name__)
+ROW_BLOCK_SIZE = 1000
+BLOCKS_PER_THREAD = 4
+ROW_WORKER = {}
 
 
 def not_blank(key, obj, blanks):
@@ -171,23 +216,47 @@ def group_rows(
                 failed_rows["None"].append(row)
 
 
-def index_taxon_records(es, taxonomy_name, opts, with_ids, blanks, types):
-    """Index a taxon records."""
+def index_taxon_docs(es, index_name, docs, opts):
+    """Index taxon docs, recording changed taxa if a change log is set."""
+    changed = set()
+    if "change-log" in opts and not opts.get("dry-run", False):
+        docs = record_changed_taxa(docs, changed)
+    index_stream(
+        es,
+        index_name,
+        docs,
+        _op_type="update",
+        dry_run=opts.get("dry-run", False),
+        log=opts.get("log-es", True),
+        **bulk_options(opts),
+    )
+    if changed:
+        write_change_log(opts["change-log"], changed)
+
+
+def index_taxon_records(
+    es, taxonomy_name, opts, with_ids, blanks, types, imported_taxa=None
+):
+    """Index a taxon records.
+
+    If an imported_taxa dict is passed, imported taxa are added to it for
+    the caller to write, otherwise they are written once indexed.
+    """
     taxon_template = taxon.index_template(taxonomy_name, opts)
     docs = add_names_and_attributes_to_taxa(
         es, dict(with_ids), opts, template=taxon_template, blanks=blanks
     )
-    imported_taxa = defaultdict(list)
-    index_stream(
+    write_taxa = imported_taxa is None
+    if write_taxa:
+        imported_taxa = defaultdict(list)
+    index_taxon_docs(
         es,
         taxon_template["index_name"],
         summarise_imported_taxa(docs, imported_taxa),
-        _op_type="update",
-        dry_run=opts.get("dry-run", False),
-        log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        opts,
     )
-    write_imported_taxa(imported_taxa, opts, types=types)
+    if write_taxa:
+        write_imported_taxa(imported_taxa, opts, types=types)
 
 
 def index_sample_records(
@@ -218,7 +287,7 @@ def index_sample_records(
         docs,
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
     # index taxon-level attributes
     index_types(
@@ -239,15 +308,7 @@ def index_sample_records(
         template=taxon_template,
         blanks=blanks,
     )
-    index_stream(
-        es,
-        taxon_template["index_name"],
-        taxon_docs,
-        _op_type="update",
-        dry_run=opts.get("dry-run", False),
-        log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
-    )
+    index_taxon_docs(es, taxon_template["index_name"], taxon_docs, opts)
 
 
 def process_taxon_sample_records(
@@ -264,8 +325,13 @@ def process_taxon_sample_records(
     header,
     taxon_table,
     taxon_types,
+    stream=None,
 ):
-    """Process taxon and sample records."""
+    """Process taxon and sample records.
+
+    If stream holds the state of a file indexed in windows, imported rows
+    are appended to those already written.
+    """
     taxon_template = taxon.index_template(taxonomy_name, opts)
     without_ids = defaultdict(list)
     if "taxon-id-as-xref" in opts:
@@ -274,6 +340,7 @@ def process_taxon_sample_records(
             index=taxon_template["index_name"],
             xrefs=list(processed_rows.keys()),
             source=opts["taxon-id-as-xref"],
+            **msearch_options(opts),
         )
         updated_rows = defaultdict(list)
         for xref, taxon_id in id_map.items():
@@ -316,35 +383,111 @@ def process_taxon_sample_records(
     write_spellchecked_taxa(spellings, opts, types=types)
     if with_ids or create_ids:
         write_imported_rows(
-            imported_rows, opts, types=types, header=header, label="imported"
+            imported_rows,
+            opts,
+            types=types,
+            header=header,
+            label="imported",
+            append=stream is not None and stream["windows"] > 0,
         )
         LOGGER.info("Indexing %d entries", len(with_ids.keys()))
-        if opts["index"] == "taxon":
-            index_taxon_records(es, taxonomy_name, opts, with_ids, blanks, types)
-        elif opts["index"] == "assembly":
-            # TODO: keep track of taxon_id not found exceptions
-            index_sample_records(
-                es,
-                taxonomy_name,
-                opts,
-                with_ids,
-                blanks,
-                taxon_types,
-                taxon_asm_data,
-                index_type="assembly",
-            )
-        elif opts["index"] == "sample":
-            # TODO: keep track of taxon_id not found exceptions
-            index_sample_records(
-                es,
-                taxonomy_name,
-                opts,
-                with_ids,
-                blanks,
-                taxon_types,
-                taxon_asm_data,
-                index_type="sample",
-            )
+        index_records(
+            es,
+            taxonomy_name,
+            opts,
+            with_ids,
+            blanks,
+            types,
+            taxon_types,
+            taxon_asm_data,
+            imported_taxa=None if stream is None else stream["imported_taxa"],
+        )
+
+
+def index_records(
+    es,
+    taxonomy_name,
+    opts,
+    with_ids,
+    blanks,
+    types,
+    taxon_types,
+    taxon_asm_data,
+    imported_taxa=None,
+):
+    """Index taxon, assembly or sample records grouped by taxon ID."""
+    if opts["index"] == "taxon":
+        index_taxon_records(
+            es, taxonomy_name, opts, with_ids, blanks, types, imported_taxa
+        )
+    elif opts["index"] == "assembly":
+        # TODO: keep track of taxon_id not found exceptions
+        index_sample_records(
+            es,
+            taxonomy_name,
+            opts,
+            with_ids,
+            blanks,
+            taxon_types,
+            taxon_asm_data,
+            index_type="assembly",
+        )
+    elif opts["index"] == "sample":
+        # TODO: keep track of taxon_id not found exceptions
+        index_sample_records(
+            es,
+            taxonomy_name,
+            opts,
+            with_ids,
+            blanks,
+            taxon_types,
+            taxon_asm_data,
+            index_type="sample",
+        )
+
+
+def index_window(
+    es,
+    taxonomy_name,
+    opts,
+    with_ids,
+    taxon_asm_data,
+    imported_rows,
+    *,
+    blanks,
+    types,
+    taxon_types,
+    header,
+    stream,
+):
+    """Index a window of rows with taxon IDs from a file indexed in windows.
+
+    Taxon, assembly and sample documents are refreshed after each window so
+    that later windows update documents written by earlier ones.
+    """
+    if opts["index"] == "feature":
+        index_feature_records(es, opts, taxonomy_name, with_ids, blanks)
+    else:
+        write_imported_rows(
+            imported_rows,
+            opts,
+            types=types,
+            header=header,
+            label="imported",
+            append=stream["windows"] > 0,
+        )
+        index_records(
+            es,
+            taxonomy_name,
+            {**opts, "es-skip-refresh": False, "es-bulk-load": False},
+            with_ids,
+            blanks,
+            types,
+            taxon_types,
+            taxon_asm_data,
+            imported_taxa=stream["imported_taxa"],
+        )
+    stream["windows"] += 1
 
 
 def convert_features_to_docs(with_ids):
@@ -370,10 +513,97 @@ def index_feature_records(es, opts, taxonomy_name, with_ids, blanks):
         docs,
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        # later feature files look up {.attr} values from these features by search
+        **bulk_options(opts, refresh=True),
     )
 
 
+def process_row_safely(row, **kwargs):
+    """Process a row, returning a formatted traceback if processing fails."""
+    try:
+        return process_row(row=row, **kwargs), None
+    except Exception:
+        return None, format_exc()
+
+
+def init_row_worker(kwargs):
+    """Store arguments to process_row once per worker process."""
+    shared_values = kwargs["shared_values"]
+    if shared_values is not None and "_es" in shared_values:
+        shared_values["_es"] = es_client(shared_values["_opts"])
+    ROW_WORKER.update(kwargs)
+
+
+def process_row_block(rows):
+    """Process a block of rows in a worker process."""
+    prefetch_attribute_values(
+        rows, ROW_WORKER.get("plan"), ROW_WORKER.get("shared_values")
+    )
+    return [process_row_safely(row, **ROW_WORKER) for row in rows]
+
+
+def row_blocks(rows, size=ROW_BLOCK_SIZE):
+    """Split rows into blocks of a fixed size."""
+    while block := list(islice(rows, size)):
+        yield block
+
+
+def read_row_blocks(blocks, queue):
+    """Read blocks of rows into a queue, ending with None or an exception."""
+    try:
+        for block in blocks:
+            queue.put(block)
+        queue.put(None)
+    except Exception as err:
+        queue.put(err)
+
+
+def process_rows(blocks, *, threads=1, **kwargs):
+    """Process blocks of rows, yielding each row with its result and any error.
+
+    Indexed attribute values used by function templates are prefetched for
+    each block. With more than one thread, a reader thread queues blocks
+    that are processed by a pool of worker processes. Arguments to
+    process_row are sent to each worker once and results are returned in
+    file order.
+    """
+    if threads <= 1:
+        for block in blocks:
+            prefetch_attribute_values(
+                block, kwargs.get("plan"), kwargs.get("shared_values")
+            )
+            for row in block:
+                yield (row, *process_row_safely(row, **kwargs))
+        return
+    shared_values = kwargs.get("shared_values")
+    if shared_values is not None and "_es" in shared_values:
+        kwargs["shared_values"] = defaultdict(dict, {**shared_values, "_es": None})
+    queue = Queue(maxsize=threads * BLOCKS_PER_THREAD)
+    pending = deque()
+    with Pool(
+        processes=threads, initializer=init_row_worker, initargs=(kwargs,)
+    ) as pool:
+        Thread(target=read_row_blocks, args=(blocks, queue), daemon=True).start()
+        while (block := queue.get()) is not None:
+            if isinstance(block, Exception):
+                raise block
+            pending.append((block, pool.apply_async(process_row_block, (block,))))
+            if len(pending) >= threads * BLOCKS_PER_THREAD:
+                block, results = pending.popleft()
+                yield from ((row, *result) for row, result in zip(block, results.get()))
+        while pending:
+            block, results = pending.popleft()
+            yield from ((row, *result) for row, result in zip(block, results.get()))
+
+
+def read_header(blocks):
+    """Read the first row from blocks of rows, returning it with the other rows."""
+    for block in blocks:
+        if block:
+            return block[0], chain([block[1:]], blocks)
+    return None, blocks
+
+
 def index_file(
     es,
     types,
@@ -385,7 +615,12 @@ def index_file(
     shared_values=None,
     exclusions=None,
 ):
-    """Index a file."""
+    """Index a file.
+
+    If --index-window is set, rows with taxon IDs are indexed in windows of
+    that many rows as the file is read, so memory use does not grow with
+    file size. Rows that need a taxon lookup are still indexed at the end.
+    """
     delimiters = {"csv": ",", "tsv": "\t"}
     # Increase the maximum field size limit for CSV reader
     maxInt = sys.maxsize
@@ -396,13 +631,21 @@ def index_file(
             break
         except OverflowError:
             maxInt = int(maxInt / 10)
-    rows = csv.reader(
-        strip_comments(data, types),
-        delimiter=delimiters[types["file"]["format"]],
-        quotechar='"',
-    )
+    if opts.get("index-fast-reader"):
+        blocks = read_blocks(
+            data,
+            delimiter=delimiters[types["file"]["format"]],
+            comment_chars=comment_characters(types),
+        )
+    else:
+        rows = csv.reader(
+            strip_comments(data, types),
+            delimiter=delimiters[types["file"]["format"]],
+            quotechar='"',
+        )
+        blocks = row_blocks(rows)
     if "header" in types["file"] and types["file"]["header"]:
-        header = next(rows)
+        header, blocks = read_header(blocks)
         set_column_indices(types, header)
     else:
         header = None
@@ -418,21 +661,30 @@ def index_file(
     taxonomy_name = opts["taxonomy-source"].lower()
     LOGGER.info("Processing rows")
     processed_rows = defaultdict(list)
-    for row in tqdm(rows, mininterval=int(opts.get("log-interval", 1))):
-        try:
-            processed_data, taxon_data, new_taxon_types = process_row(
-                types,
-                names,
-                row,
-                shared_values,
-                blanks,
-                index_type=opts["index"],
-                exclusions=exclusions,
-            )
-        except Exception:
-            print(format_exc())
+    window_size = int(opts.get("index-window", 0) or 0)
+    stream = None
+    if window_size > 0:
+        stream = {"windows": 0, "imported_taxa": defaultdict(list)}
+    window_rows = 0
+    results = process_rows(
+        blocks,
+        threads=int(opts.get("index-threads", 1)),
+        plan=compile_row_plan(types),
+        types=types,
+        names=names,
+        shared_values=shared_values,
+        blanks=blanks,
+        index_type=opts["index"],
+        exclusions=exclusions,
+    )
+    for row, result, error in tqdm(
+        results, mininterval=int(opts.get("log-interval", 1))
+    ):
+        if error is not None:
+            print(error)
             failed_rows["None"].append(row)
             continue
+        processed_data, taxon_data, new_taxon_types = result
         if processed_data is None:
             continue
         taxon_types.update(new_taxon_types)
@@ -440,16 +692,45 @@ def index_file(
             "taxon_id", processed_data["taxonomy"], blanks
         ):
             with_ids[processed_data["taxonomy"]["taxon_id"]].append(processed_data)
+            window_rows += 1
         elif not_blank("_taxon_id", processed_data["taxonomy"], blanks):
             # if opts["taxon-id-as-xref"]:
             with_ids[processed_data["taxonomy"]["_taxon_id"]].append(processed_data)
             taxon_asm_data[processed_data["taxonomy"]["_taxon_id"]].append(taxon_data)
             imported_rows.append(row)
+            window_rows += 1
+        elif (
+            stream is not None
+            and "taxon-id-as-xref" not in opts
+            and not_blank("taxon_id", processed_data["taxonomy"], blanks)
+        ):
+            with_ids[processed_data["taxonomy"]["taxon_id"]].append(processed_data)
+            taxon_asm_data[processed_data["taxonomy"]["taxon_id"]].append(taxon_data)
+            imported_rows.append(row)
+            window_rows += 1
         else:
             tmp_taxon_id = "other"
             if not_blank("taxon_id", processed_data["taxonomy"], blanks):
                 tmp_taxon_id = processed_data["taxonomy"]["taxon_id"]
             processed_rows[tmp_taxon_id].append((processed_data, taxon_data, row))
+        if stream is not None and window_rows >= window_size:
+            index_window(
+                es,
+                taxonomy_name,
+                opts,
+                with_ids,
+                taxon_asm_data,
+                imported_rows,
+                blanks=blanks,
+                types=types,
+                taxon_types=taxon_types,
+                header=header,
+                stream=stream,
+            )
+            with_ids = defaultdict(list)
+            taxon_asm_data = defaultdict(list)
+            imported_rows = []
+            window_rows = 0
     if opts["index"] in ["taxon", "sample", "assembly"]:
         process_taxon_sample_records(
             es,
@@ -465,11 +746,25 @@ def index_file(
             header,
             taxon_table,
             taxon_types,
+            stream,
         )
+        if stream is not None:
+            write_imported_taxa(stream["imported_taxa"], opts, types=types)
     elif opts["index"] == "feature":
         index_feature_records(es, opts, taxonomy_name, with_ids, blanks)
 
 
+def target_index_names(taxonomy_name, opts):
+    """List names of indices that receive documents during indexing."""
+    return [
+        taxon.index_template(taxonomy_name, opts)["index_name"],
+        sample.index_template(taxonomy_name, opts, index_type="assembly")["index_name"],
+        sample.index_template(taxonomy_name, opts, index_type="sample")["index_name"],
+        feature.index_template(taxonomy_name, opts)["index_name"],
+        files_index_template(taxonomy_name, opts)["index_name"],
+    ]
+
+
 def index_taxon_sample(es, opts, index="taxon", *, dry_run=False, taxonomy_name):
     """Call taxon- or sample-specific indexing functions."""
     taxon_table = None
@@ -502,6 +797,9 @@ def index_taxon_sample(es, opts, index="taxon", *, dry_run=False, taxonomy_name)
                     taxon_table=taxon_table,
                 )
                 if "tests" in types["file"]:
+                    es_functions.refresh_indices(
+                        es, target_index_names(taxonomy_name, opts)
+                    )
                     result = test_json_dir(
                         f'{dir_path}/{types["file"]["tests"]}',
                         opts["es-host"][0],
@@ -533,6 +831,9 @@ def index_taxon_sample(es, opts, index="taxon", *, dry_run=False, taxonomy_name)
                     exclusions=exclusions,
                 )
                 if "tests" in types["file"]:
+                    es_functions.refresh_indices(
+                        es, target_index_names(taxonomy_name, opts)
+                    )
                     result = test_json_dir(
                         f'{dir_path}/{types["file"]["tests"]}',
                         opts["es-host"][0],
@@ -575,6 +876,7 @@ def index_features(es, opts, *, dry_run=False):
     template = feature.index_template(opts["taxonomy-source"].lower(), opts)
     shared_values["_index"] = template["index_name"]
     shared_values["_index_type"] = index
+    shared_values["_attribute_values"] = AttributeValueCache()
     for types_file in file_list:
         types, data, names, exclusions = validate_types_file(
             types_file, dir_path, es, index, opts, attributes=stored_attributes
@@ -612,28 +914,33 @@ def main(args):
 
     taxonomy_name = options["index"]["taxonomy-source"].lower()
     dry_run = options["index"].get("dry-run", False)
-    for index in ["taxon", "sample", "assembly"]:
-        index_taxon_sample(
-            es,
-            options["index"],
-            index=index,
-            dry_run=dry_run,
-            taxonomy_name=taxonomy_name,
-        )
+    with es_functions.bulk_load_settings(
+        es,
+        target_index_names(taxonomy_name, options["index"]),
+        enabled=options["index"].get("es-bulk-load", False),
+    ):
+        for index in ["taxon", "sample", "assembly"]:
+            index_taxon_sample(
+                es,
+                options["index"],
+                index=index,
+                dry_run=dry_run,
+                taxonomy_name=taxonomy_name,
+            )
 
-    if "feature-dir" in options["index"]:
-        index_features(es, options["index"], dry_run=dry_run)
+        if "feature-dir" in options["index"]:
+            index_features(es, options["index"], dry_run=dry_run)
 
-    if "file" in options["index"]:
-        index_files(es, options["index"]["file"], taxonomy_name, options["index"])
-    elif "file-metadata" in options["index"]:
-        index_metadata(
-            es,
-            options["index"]["file-metadata"],
-            taxonomy_name,
-            options["index"],
-            dry_run=dry_run,
-        )
+        if "file" in options["index"]:
+            index_files(es, options["index"]["file"], taxonomy_name, options["index"])
+        elif "file-metadata" in options["index"]:
+            index_metadata(
+                es,
+                options["index"]["file-metadata"],
+                taxonomy_name,
+                options["index"],
+                dry_run=dry_run,
+            )
 
 
 def cli():
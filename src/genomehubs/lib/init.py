@@ -7,6 +7,10 @@ Usage:
     genomehubs init [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                     [--config-file PATH...] [--config-save PATH]
                     [--es-batch INT] [--es-host URL...] [--es-url URL]
+                    [--es-threads INT] [--es-max-bytes INT]
+                    [--es-chunk-bytes INT] [--es-dead-letter PATH]
+                    [--es-bulk-load] [--es-skip-refresh]
+                    [--es-connections INT] [--es-compress] [--es-sniff]
                     [--insdc-metadata] [--insdc-root INT...] [--restore-indices]
                     [--taxonomy-path PATH] [--taxonomy-source STRING]
                     [--taxonomy-ncbi-root INT] [--taxonomy-ncbi-url URL]
@@ -27,6 +31,15 @@ Options:
     --config-file PATH            Path to YAML file containing configuration options.
     --config-save PATH            Path to write configuration options to YAML file.
     --es-batch INT                Batch size for ElasticSearch bulk indexing.
+    --es-threads INT              Number of threads for ElasticSearch bulk indexing.
+    --es-max-bytes INT            Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-chunk-bytes INT          Target size (bytes) for adaptive ElasticSearch bulk requests.
+    --es-dead-letter PATH         Path to JSON Lines file for documents that fail to index.
+    --es-bulk-load                Disable refresh and replicas until indexing completes.
+    --es-skip-refresh             Skip index refresh after each bulk indexing call.
+    --es-connections INT          Number of HTTP connections per ElasticSearch node.
+    --es-compress                 Use gzip compression for ElasticSearch requests.
+    --es-sniff                    Discover ElasticSearch nodes by sniffing the cluster.
     --es-host URL                 ElasticSearch hostname/URL and port.
     --es-url URL                  Remote URL to fetch ElasticSearch code.
     --insdc-metadata              Flag to index metadata for public INSDC assemblies.
@@ -211,13 +224,18 @@ def main(args):
             if "taxonomy-root" in options["init"]:
                 es_functions.index_create(es, template["index_name"])
                 es_functions.load_mapping(es, template["name"], template["mapping"])
-                es_functions.index_stream(
+                with es_functions.bulk_load_settings(
                     es,
-                    template["index_name"],
-                    stream,
-                    log=options["init"].get("log-es", True),
-                    chunk_size=options["init"].get("es-batch", 500),
-                )
+                    [template["index_name"]],
+                    enabled=options["init"].get("es-bulk-load", False),
+                ):
+                    es_functions.index_stream(
+                        es,
+                        template["index_name"],
+                        stream,
+                        log=options["init"].get("log-es", True),
+                        **es_functions.bulk_options(options["init"]),
+                    )
 
         # Prepare taxon index
         taxon_template = taxon.index_template(taxonomy_name, options["init"])
@@ -229,7 +247,12 @@ def main(args):
                 "source": {"index": template["index_name"]},
                 "dest": {"index": taxon_template["index_name"]},
             }
-            es.reindex(body=body)
+            with es_functions.bulk_load_settings(
+                es,
+                [taxon_template["index_name"]],
+                enabled=options["init"].get("es-bulk-load", False),
+            ):
+                es.reindex(body=body)
 
         # Prepare assembly index
         assembly_template = sample.index_template(
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""Record time and memory used by tree traversal."""
+
+import contextlib
+import sys
+import time
+from collections import defaultdict
+from functools import wraps
+
+import ujson
+
+from genomehubs.vendor.tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+PHASES = ("read", "summarise", "write")
+PROFILE = None
+
+
+class FillProfile:
+    """Class for collecting traversal costs by depth and attribute.
+
+    Time is split into ES reads, summarising and ES writes for each depth
+    below the traversal root. Costs that cannot be assigned to a single
+    depth, such as loading a whole subtree, are recorded with depth None.
+    Peak RSS is the process high-water mark when each depth was completed.
+    """
+
+    def __init__(self, offset=0):
+        """Init FillProfile class."""
+        self.offset = offset
+        self.depth = None
+        self.nodes = defaultdict(int)
+        self.rss = {}
+        self.seconds = defaultdict(lambda: dict.fromkeys(PHASES, 0.0))
+        self.attributes = defaultdict(
+            lambda: {"calls": 0, "seconds": 0.0, "values": 0, "max_values": 0}
+        )
+
+    def set_depth(self, depth):
+        """Set the depth at which costs are recorded."""
+        if depth is not None:
+            depth = int(depth) + self.offset
+        if depth != self.depth:
+            self.rss[self.depth] = peak_rss()
+            self.depth = depth
+
+    def add_time(self, phase, seconds, depth=False):
+        """Add time spent in a phase at the current depth."""
+        self.seconds[self.depth if depth is False else depth][phase] += seconds
+
+    def phase_total(self):
+        """Return total time recorded for all phases."""
+        return sum(sum(seconds.values()) for seconds in self.seconds.values())
+
+    def add_summary(self, key, seconds, length):
+        """Record time taken to summarise a list of values for an attribute."""
+        entry = self.attributes[key]
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["values"] += length
+        entry["max_values"] = max(entry["max_values"], length)
+
+    def to_dict(self):
+        """Convert the profile to a JSON-serialisable dict."""
+        self.rss[self.depth] = peak_rss()
+        depths = sorted(set(self.nodes) | set(self.seconds), key=depth_order)
+        return {
+            "depths": [
+                {
+                    "depth": depth,
+                    "nodes": self.nodes.get(depth, 0),
+                    **{
+                        f"{phase}_seconds": self.seconds[depth][phase]
+                        for phase in PHASES
+                    },
+                    "peak_rss_bytes": self.rss.get(depth),
+                }
+                for depth in depths
+            ],
+            "attributes": {key: dict(value) for key, value in self.attributes.items()},
+            "peak_rss_bytes": max_rss(self.rss.values()),
+        }
+
+    def merge(self, data):
+        """Merge a profile dict returned by another process."""
+        for entry in data["depths"]:
+            depth = entry["depth"]
+            self.nodes[depth] += entry["nodes"]
+            for phase in PHASES:
+                self.seconds[depth][phase] += entry[f"{phase}_seconds"]
+            self.rss[depth] = max_rss([self.rss.get(depth), entry["peak_rss_bytes"]])
+        for key, value in data["attributes"].items():
+            entry = self.attributes[key]
+            entry["calls"] += value["calls"]
+            entry["seconds"] += value["seconds"]
+            entry["values"] += value["values"]
+            entry["max_values"] = max(entry["max_values"], value["max_values"])
+
+    def report(self, path):
+        """Write the profile to a JSON file and print summary tables."""
+        data = self.to_dict()
+        with open(path, "w") as fh:
+            fh.write(ujson.dumps(data, indent=2))
+        rows = [
+            [
+                "all" if entry["depth"] is None else str(entry["depth"]),
+                str(entry["nodes"]),
+                *(f'{entry[f"{phase}_seconds"]:.3f}' for phase in PHASES),
+                format_rss(entry["peak_rss_bytes"]),
+            ]
+            for entry in data["depths"]
+        ]
+        print_table(
+            ["depth", "nodes", *(f"{phase} (s)" for phase in PHASES), "peak RSS"],
+            rows,
+        )
+        rows = [
+            [
+                key,
+                str(value["calls"]),
+                f'{value["seconds"]:.3f}',
+                str(value["values"]),
+                str(value["max_values"]),
+            ]
+            for key, value in sorted(
+                data["attributes"].items(), key=lambda item: -item[1]["seconds"]
+            )
+        ]
+        print_table(["attribute", "calls", "seconds", "values", "max values"], rows)
+        print(f'Peak RSS: {format_rss(data["peak_rss_bytes"])}')
+        LOGGER.info("Wrote fill profile to %s", path)
+
+
+def depth_order(depth):
+    """Sort depths with unassigned costs first."""
+    return (depth is not None, depth or 0)
+
+
+def peak_rss():
+    """Return peak resident set size in bytes of this process and its children."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def max_rss(values):
+    """Find the largest of a set of RSS values, ignoring missing values."""
+    return max((value for value in values if value is not None), default=None)
+
+
+def format_rss(value):
+    """Format an RSS value in MiB."""
+    return "-" if value is None else f"{value / 2**20:.1f} MiB"
+
+
+def print_table(header, rows):
+    """Print rows as an aligned text table."""
+    widths = [
+        max(len(row[idx]) for row in [header, *rows]) for idx, _ in enumerate(header)
+    ]
+    for row in [header, ["-" * width for width in widths], *rows]:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+    print()
+
+
+def start_profile(offset=0):
+    """Start collecting a new profile with depths offset by a number of levels."""
+    global PROFILE
+    PROFILE = FillProfile(offset)
+    return PROFILE
+
+
+def stop_profile():
+    """Stop collecting a profile, returning it as a dict."""
+    global PROFILE
+    data = PROFILE.to_dict() if PROFILE is not None else None
+    PROFILE = None
+    return data
+
+
+def set_depth(depth):
+    """Set the depth at which costs are recorded if profiling."""
+    if PROFILE is not None:
+        PROFILE.set_depth(depth)
+
+
+def timed_reads(iterable):
+    """Time iteration over an ES result stream as reads at the current depth."""
+    if PROFILE is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            PROFILE.add_time("read", time.perf_counter() - start)
+        yield item
+
+
+def counted_nodes(nodes):
+    """Count nodes processed at the current depth."""
+    if PROFILE is None:
+        yield from nodes
+        return
+    for node in nodes:
+        PROFILE.nodes[PROFILE.depth] += 1
+        yield node
+
+
+def timed_writes(stream):
+    """Time bulk writes of a document stream by the depth of each document."""
+    if PROFILE is None:
+        yield from stream
+        return
+    for item in stream:
+        depth = PROFILE.depth
+        start = time.perf_counter()
+        yield item
+        PROFILE.add_time("write", time.perf_counter() - start, depth)
+
+
+@contextlib.contextmanager
+def timed_bulk():
+    """Time a bulk indexing call, adding untimed work to writes."""
+    if PROFILE is None:
+        yield
+        return
+    start = time.perf_counter()
+    timed = PROFILE.phase_total()
+    try:
+        yield
+    finally:
+        timed = PROFILE.phase_total() - timed
+        PROFILE.add_time("write", time.perf_counter() - start - timed)
+
+
+def profile_summary(func):
+    """Record time and value list length for calls to summarise an attribute."""
+
+    @wraps(func)
+    def wrapper(attribute, meta, **kwargs):
+        if PROFILE is None:
+            return func(attribute, meta, **kwargs)
+        values = kwargs.get("values")
+        length = len(values if values is not None else attribute.get("values", []))
+        start = time.perf_counter()
+        try:
+            return func(attribute, meta, **kwargs)
+        finally:
+            PROFILE.add_summary(meta["key"], time.perf_counter() - start, length)
+
+    return wrapper
+
+
+def profile_node(func):
+    """Record time taken to summarise a node at the current depth."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILE is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            PROFILE.add_time("summarise", time.perf_counter() - start)
+            PROFILE.nodes[PROFILE.depth] += 1
+
+    return wrapper
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""Read delimited files in blocks of rows."""
+
+import csv
+from io import StringIO
+from itertools import chain
+
+from genomehubs.vendor.tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+BLOCK_CHARS = 2**18
+QUOTECHAR = '"'
+
+
+def comment_characters(types):
+    """Return the set of characters that mark a comment line."""
+    comment_chars = {"#"}
+    if "file" in types and "comment" in types["file"]:
+        comment_chars.update(set(types["file"]["comment"]))
+    return comment_chars
+
+
+def has_comments(text, comment_chars):
+    """Test whether any line in a block of text starts with a comment character."""
+    return text.startswith(comment_chars) or any(
+        f"\n{char}" in text for char in comment_chars
+    )
+
+
+def parse_quoted_lines(lines, data, *, delimiter, comment_chars):
+    """Parse lines with csv.reader, reading on from data to close a quoted field."""
+    more = (line for line in data if not line.startswith(comment_chars))
+    reader = csv.reader(chain(lines, more), delimiter=delimiter, quotechar=QUOTECHAR)
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if reader.line_num >= len(lines):
+            break
+    return rows
+
+
+def read_blocks(data, *, delimiter, comment_chars=("#",), size=BLOCK_CHARS):
+    """Read rows from a delimited file stream in blocks.
+
+    Text is read about size characters at a time, up to the end of a line,
+    and comment lines are only filtered out of blocks that contain them.
+    Blocks without quotes are split on newlines and the delimiter directly,
+    others are parsed with csv.reader, so rows match those from csv.reader
+    over hub.strip_comments.
+    """
+    comment_chars = tuple(char for char in comment_chars if len(char) == 1)
+    while text := data.read(size):
+        if not text.endswith("\n"):
+            text += data.readline()
+        if QUOTECHAR in text:
+            lines = StringIO(text).readlines()
+        else:
+            lines = text.split("\n")
+            if text.endswith("\n"):
+                lines.pop()
+        if has_comments(text, comment_chars):
+            lines = [line for line in lines if not line.startswith(comment_chars)]
+        if not lines:
+            continue
+        if QUOTECHAR in text:
+            yield parse_quoted_lines(
+                lines, data, delimiter=delimiter, comment_chars=comment_chars
+            )
+        else:
+            yield [line.split(delimiter) if line else [] for line in lines]
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Summary statistics for tree traversal.
+
+The vector_* functions return exactly the value of the statistics function
+they replace. Long lists holding only ints or only floats are summarised with
+NumPy, anything else (short lists, mixed types, strings and dates) uses the
+original function.
+
+ValueSketch is a mergeable summary used for attributes with
+summary_precision: sketch. A sketch summarises every raw value in a subtree,
+whereas exact summaries of an ancestor are calculated from the traverse
+values of its children (e.g. a median of child medians), so the two settings
+can give different values even when a sketch is exact.
+"""
+
+from fractions import Fraction
+from statistics import mean
+from statistics import median
+from statistics import median_high
+from statistics import median_low
+
+import numpy as np
+
+MIN_VECTOR_LENGTH = 32
+MIN_SELECT_LENGTH = 1000
+MAX_EXACT_INT = 2**62
+QUANTILE_SKETCH_SIZE = 256
+MODE_SKETCH_SIZE = 64
+SKETCH_SUMMARIES = {
+    "count",
+    "max",
+    "mean",
+    "median",
+    "median_high",
+    "median_low",
+    "min",
+    "mode",
+    "most_common",
+    "range",
+    "sp_count",
+    "sum",
+}
+SKETCH_TYPES = {
+    "byte",
+    "double",
+    "float",
+    "half_float",
+    "integer",
+    "long",
+    "scaled_float",
+    "short",
+    "unsigned_long",
+}
+ARRAY_TYPES = {int: np.int64, float: np.float64}
+
+
+def numeric_array(arr, min_length=MIN_VECTOR_LENGTH):
+    """Convert a list of ints or of floats to a NumPy array.
+
+    Returns None if the list is shorter than min_length, does not hold a
+    single numeric type or contains values that NumPy would not order exactly
+    as Python does.
+    """
+    if len(arr) < min_length:
+        return None
+    types = set(map(type, arr))
+    if len(types) != 1:
+        return None
+    value_type = types.pop()
+    try:
+        values = np.array(arr, dtype=ARRAY_TYPES[value_type])
+    except (KeyError, OverflowError):
+        return None
+    if value_type is float and (
+        np.isnan(values).any() or np.signbit(values[values == 0]).any()
+    ):
+        return None
+    return values
+
+
+def select(values, positions):
+    """Select values at positions in sorted order as Python numbers."""
+    partitioned = np.partition(values, positions)
+    return [partitioned[position].item() for position in positions]
+
+
+def vector_mean(arr):
+    """Calculate the mean of a list."""
+    values = numeric_array(arr)
+    if values is None or values.dtype.kind != "i":
+        return mean(arr)
+    if np.abs(values).max() > MAX_EXACT_INT // len(arr):
+        return mean(arr)
+    quotient = Fraction(int(values.sum()), len(arr))
+    return int(quotient) if quotient.denominator == 1 else float(quotient)
+
+
+def vector_median(arr):
+    """Calculate the median of a list."""
+    values = numeric_array(arr, MIN_SELECT_LENGTH)
+    if values is None:
+        return median(arr)
+    length = len(arr)
+    if length % 2 == 1:
+        return select(values, [length // 2])[0]
+    lower, upper = select(values, [length // 2 - 1, length // 2])
+    return (lower + upper) / 2
+
+
+def vector_median_high(arr):
+    """Calculate the high median of a list."""
+    values = numeric_array(arr, MIN_SELECT_LENGTH)
+    if values is None:
+        return median_high(arr)
+    return select(values, [len(arr) // 2])[0]
+
+
+def vector_median_low(arr):
+    """Calculate the low median of a list."""
+    values = numeric_array(arr, MIN_SELECT_LENGTH)
+    if values is None:
+        return median_low(arr)
+    return select(values, [(len(arr) - 1) // 2])[0]
+
+
+def sketchable(meta):
+    """Test whether an attribute can be summarised using a ValueSketch."""
+    summaries = meta.get("summary", [])
+    if not isinstance(summaries, list):
+        summaries = [summaries]
+    if meta.get("type") not in SKETCH_TYPES or not summaries:
+        return False
+    if (meta.get("traverse") or "median") not in SKETCH_SUMMARIES:
+        return False
+    return all(
+        summary in SKETCH_SUMMARIES or summary == "primary" for summary in summaries
+    )
+
+
+def exact_mean(total, count):
+    """Divide a total by a count, returning an int if an int total divides exactly."""
+    if isinstance(total, int):
+        quotient = Fraction(total, count)
+        return int(quotient) if quotient.denominator == 1 else float(quotient)
+    return total / count
+
+
+class ValueSketch:
+    """Mergeable summary of a collection of numeric values.
+
+    Count, sum, min and max are exact. Quantiles come from a compactor
+    (KLL-style) sketch that keeps at most about size values per level and
+    modes from a Misra-Gries frequency sketch with at most mode_size
+    counters, so merging a child into an ancestor costs the same however
+    large the child's subtree is. The mode_size most frequent counters are
+    always kept. Until a sketch overflows, its quantiles and modes are exact.
+    """
+
+    def __init__(self, size=QUANTILE_SKETCH_SIZE, mode_size=MODE_SKETCH_SIZE):
+        """Init ValueSketch class."""
+        self.size = size
+        self.mode_size = mode_size
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.levels = [[]]
+        self.frequencies = {}
+
+    def update(self, values):
+        """Add values to the sketch."""
+        for value in values:
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            self.levels[0].append(value)
+            self.frequencies[value] = self.frequencies.get(value, 0) + 1
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Merge another sketch into this sketch."""
+        if not other.count:
+            return self
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].extend(items)
+        for value, count in other.frequencies.items():
+            self.frequencies[value] = self.frequencies.get(value, 0) + count
+        self._compress()
+        return self
+
+    def _compress(self):
+        """Halve overfull levels and drop infrequent values."""
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.size:
+                items.sort()
+                kept = [items.pop()] if len(items) % 2 else []
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[level + 1].extend(items[(self.count + level) % 2 :: 2])
+                self.levels[level] = kept
+            level += 1
+        if len(self.frequencies) > self.mode_size:
+            ranked = sorted(self.frequencies.items(), key=lambda item: -item[1])
+            threshold = ranked[self.mode_size][1]
+            self.frequencies = {
+                value: count - threshold for value, count in ranked[: self.mode_size]
+            }
+
+    def exact(self):
+        """Test whether all values are still held in the sketch."""
+        return len(self.levels) == 1
+
+    def rank_value(self, rank):
+        """Find the value at a zero-based rank in sorted order."""
+        items = sorted(
+            (value, 2**level)
+            for level, values in enumerate(self.levels)
+            for value in values
+        )
+        position = 0
+        for value, weight in items:
+            position += weight
+            if position > rank:
+                return value
+        return items[-1][0]
+
+    def median(self):
+        """Estimate the median."""
+        if self.exact():
+            return median(self.levels[0])
+        if self.count % 2 == 1:
+            return self.rank_value(self.count // 2)
+        return (
+            self.rank_value(self.count // 2 - 1) + self.rank_value(self.count // 2)
+        ) / 2
+
+    def median_high(self):
+        """Estimate the high median."""
+        if self.exact():
+            return median_high(self.levels[0])
+        return self.rank_value(self.count // 2)
+
+    def median_low(self):
+        """Estimate the low median."""
+        if self.exact():
+            return median_low(self.levels[0])
+        return self.rank_value((self.count - 1) // 2)
+
+    def mode(self):
+        """Estimate the most common value."""
+        if not self.frequencies:
+            return None
+        return max(self.frequencies, key=self.frequencies.get)
+
+    def summary(self, name):
+        """Calculate a named summary statistic."""
+        summaries = {
+            "count": lambda: self.count,
+            "max": lambda: self.max,
+            "mean": lambda: exact_mean(self.total, self.count),
+            "median": self.median,
+            "median_high": self.median_high,
+            "median_low": self.median_low,
+            "min": lambda: self.min,
+            "mode": self.mode,
+            "most_common": self.mode,
+            "range": lambda: self.max - self.min,
+            "sp_count": lambda: self.count,
+            "sum": lambda: self.total,
+        }
+        return summaries[name]()
@@ -11,11 +11,17 @@ from tqdm import tqdm
 
 from genomehubs.vendor.tolkein import tolog
 
+from .es_functions import MSEARCH_BATCH_SIZE
+from .es_functions import MSEARCH_THREADS
 from .es_functions import EsQueryBuilder
+from .es_functions import bulk_options
 from .es_functions import document_by_id
+from .es_functions import index_exists
 from .es_functions import index_stream
-from .es_functions import query_keyword_value_template
-from .es_functions import query_value_template
+from .es_functions import msearch_options
+from .es_functions import search_page_size
+from .es_functions import search_slices
+from .es_functions import stream_msearch_template
 from .es_functions import stream_template_search_results
 from .hub import add_attribute_values
 from .hub import chunks
@@ -162,19 +168,23 @@ def lookup_missing_taxon_ids(
     return with_ids, without_ids, found_ids
 
 
-def stream_taxon_names(es, *, index, root=None, size=1000):
+def stream_taxon_names(es, *, index, root=None, size=1000, slices=1):
     """Get entries by depth of root taxon."""
     if root is not None:
         body = {
             "id": "taxon_names_by_root",
             "params": {"root": root},
         }
-        return stream_template_search_results(es, index=index, body=body, size=size)
+        return stream_template_search_results(
+            es, index=index, body=body, size=size, slices=slices
+        )
     body = {
         "id": "taxon_names",
         "params": {},
     }
-    return stream_template_search_results(es, index=index, body=body)
+    return stream_template_search_results(
+        es, index=index, body=body, size=size, slices=slices
+    )
 
 
 def chunker(seq, size):
@@ -182,23 +192,30 @@ def chunker(seq, size):
     return (seq[pos : pos + size] for pos in range(0, len(seq), size))
 
 
-def translate_xrefs(es, *, index, xrefs, source):
+def translate_xrefs(
+    es,
+    *,
+    index,
+    xrefs,
+    source,
+    batch_size=MSEARCH_BATCH_SIZE,
+    threads=MSEARCH_THREADS,
+):
     """Translate a list of xrefs into taxon_ids."""
     id_map = {}
-    for refs in chunker(xrefs, 20):
-        responses = query_keyword_value_template(
-            es,
-            "taxon_by_specific_name",
-            source,
-            refs,
-            index,
-            opts={"keyword": "source", "value": "name"},
-        )
-        for idx, res in enumerate(responses["responses"]):
-            if "hits" in res and "hits" in res["hits"]:
-                hits = res["hits"]["hits"]
-                if len(hits) == 1:
-                    id_map[refs[idx]] = hits[0]["_source"]["taxon_id"]
+    responses = stream_msearch_template(
+        es,
+        "taxon_by_specific_name",
+        index,
+        ({"source": source, "name": xref} for xref in xrefs),
+        batch_size=batch_size,
+        threads=threads,
+    )
+    for xref, res in zip(xrefs, responses):
+        if "hits" in res and "hits" in res["hits"]:
+            hits = res["hits"]["hits"]
+            if len(hits) == 1:
+                id_map[xref] = hits[0]["_source"]["taxon_id"]
     return id_map
 
 
@@ -208,7 +225,13 @@ def load_taxon_table(es, opts, taxonomy_name, taxon_table):
     taxon_template = index_template(taxonomy_name, opts)
     root = opts["taxon-lookup-root"] if "taxon-lookup-root" in opts else None
     for node in tqdm(
-        stream_taxon_names(es, index=taxon_template["index_name"], root=root),
+        stream_taxon_names(
+            es,
+            index=taxon_template["index_name"],
+            root=root,
+            size=search_page_size(opts),
+            slices=search_slices(opts),
+        ),
         mininterval=int(opts.get("log-interval", 1)),
     ):
         lineage = {}
@@ -314,6 +337,17 @@ def stream_taxa(taxa):
         yield (f"taxon-{taxon_id}", value)
 
 
+def stream_taxonomy_nodes(es, index, taxon_ids, opts):
+    """Stream taxonomy index search responses for a set of taxon IDs."""
+    return stream_msearch_template(
+        es,
+        "taxonomy_node_by_taxon_id",
+        index,
+        ({"value": taxon_id} for taxon_id in taxon_ids),
+        **msearch_options(opts),
+    )
+
+
 def get_taxa_to_create(
     es,
     opts,
@@ -329,20 +363,16 @@ def get_taxa_to_create(
     if asm_by_taxon_id is None:
         asm_by_taxon_id = {}
     taxonomy_template = taxonomy_index_template(taxonomy_name, opts)
-    taxonomy_res = query_value_template(
-        es,
-        "taxonomy_node_by_taxon_id",
-        taxon_ids,
-        taxonomy_template["index_name"],
-    )
-    if taxonomy_res is None:
+    if not index_exists(es, taxonomy_template["index_name"]):
         LOGGER.error(
             "Could not connect to taxonomy index '%s'",
             taxonomy_template["index_name"],
         )
         sys.exit(1)
     ancestors = set()
-    for taxonomy_result in taxonomy_res["responses"]:
+    for taxonomy_result in stream_taxonomy_nodes(
+        es, taxonomy_template["index_name"], taxon_ids, opts
+    ):
         if taxonomy_result["hits"]["total"]["value"] == 1:
             source = taxonomy_result["hits"]["hits"][0]["_source"]
             taxa_to_create[source["taxon_id"]] = source
@@ -351,17 +381,12 @@ def get_taxa_to_create(
             if source["taxon_id"] in asm_by_taxon_id:
                 for asm in asm_by_taxon_id[source["taxon_id"]]:
                     add_taxonomy_info_to_meta(asm, source)
-    taxonomy_res = query_value_template(
-        es,
-        "taxonomy_node_by_taxon_id",
-        list(ancestors),
-        taxonomy_template["index_name"],
-    )
-    if taxonomy_res and "responses" in taxonomy_res:
-        for taxonomy_result in taxonomy_res["responses"]:
-            if taxonomy_result["hits"]["total"]["value"] == 1:
-                source = taxonomy_result["hits"]["hits"][0]["_source"]
-                taxa_to_create[source["taxon_id"]] = source
+    for taxonomy_result in stream_taxonomy_nodes(
+        es, taxonomy_template["index_name"], ancestors, opts
+    ):
+        if taxonomy_result["hits"]["total"]["value"] == 1:
+            source = taxonomy_result["hits"]["hits"][0]["_source"]
+            taxa_to_create[source["taxon_id"]] = source
     return taxa_to_create
 
 
@@ -385,7 +410,7 @@ def find_or_create_taxa(es, opts, *, taxon_ids, taxon_template, asm_by_taxon_id=
             stream_taxa(to_create),
             dry_run=opts.get("dry-run", False),
             log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
+            **bulk_options(opts, refresh=True),
         )
         taxa.update(
             {
@@ -1044,7 +1069,7 @@ def create_taxa(
         stream_taxa(new_taxa),
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts, refresh=True),
     )
     # return a list of alt_taxon_ids for the created taxa
     return new_taxa.keys()
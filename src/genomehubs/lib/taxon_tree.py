@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Array-backed taxon tree for in-memory traversal."""
+
+import numpy as np
+
+from genomehubs.vendor.tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+
+
+class TaxonTree:
+    """Compact array-backed copy of a taxonomy subtree.
+
+    Nodes are kept in load order. Parent indices, depths, rank codes and
+    per-attribute columns are held in NumPy arrays so that traversal order
+    and subtree membership can be computed without per-level queries.
+    """
+
+    def __init__(self, nodes, attrs=()):
+        """Init TaxonTree class."""
+        self.nodes = []
+        taxon_ids = []
+        parent_ids = []
+        ranks = []
+        for node in nodes:
+            source = node["_source"]
+            self.nodes.append(node)
+            taxon_ids.append(source["taxon_id"])
+            parent_ids.append(source.get("parent"))
+            ranks.append(source.get("taxon_rank", "no rank"))
+        self.index = {taxon_id: idx for idx, taxon_id in enumerate(taxon_ids)}
+        self.taxon_ids = np.array(taxon_ids, dtype=object)
+        self.parent = np.array(
+            [self.index.get(parent_id, -1) for parent_id in parent_ids],
+            dtype=np.int64,
+        )
+        self.rank_names, rank = np.unique(
+            np.array(ranks, dtype=str), return_inverse=True
+        )
+        self.rank = rank.astype(np.int32)
+        self.depth = self._set_depths()
+        self._child_order = np.argsort(self.parent, kind="stable")
+        self._child_offsets = np.searchsorted(
+            self.parent[self._child_order], np.arange(len(self.nodes) + 1)
+        )
+        self.columns = {key: self._attribute_column(key) for key in attrs}
+
+    def __len__(self):
+        """Return number of nodes."""
+        return len(self.nodes)
+
+    def _set_depths(self):
+        """Calculate depth of each node below the subtree root(s)."""
+        depth = np.zeros(len(self.nodes), dtype=np.int32)
+        ancestor = self.parent.copy()
+        while True:
+            has_ancestor = ancestor >= 0
+            if not has_ancestor.any():
+                return depth
+            depth += has_ancestor
+            ancestor[has_ancestor] = self.parent[ancestor[has_ancestor]]
+
+    def _attribute_column(self, key):
+        """Create an object column holding each node's attribute entry for a key."""
+        column = np.full(len(self.nodes), None, dtype=object)
+        for idx, node in enumerate(self.nodes):
+            for attribute in node["_source"].get("attributes") or []:
+                if attribute["key"] == key:
+                    column[idx] = attribute
+                    break
+        return column
+
+    def has_attribute(self, key):
+        """Return a mask of nodes with a direct entry for an attribute."""
+        return np.not_equal(self.columns[key], None)
+
+    def bottom_up_order(self):
+        """Return node indices sorted from the deepest level to the root."""
+        return np.argsort(-self.depth, kind="stable")
+
+    def active(self):
+        """Return a mask of nodes with attribute values in their subtree."""
+        active = np.zeros(len(self.nodes), dtype=bool)
+        for key in self.columns:
+            active |= self.has_attribute(key)
+        for level in np.arange(self.depth.max(initial=0), 0, -1):
+            idx = np.flatnonzero((self.depth == level) & active)
+            parent = self.parent[idx]
+            active[parent[parent >= 0]] = True
+        return active
+
+    def children(self, idx):
+        """Return indices of the direct children of a node."""
+        start, end = self._child_offsets[idx], self._child_offsets[idx + 1]
+        return self._child_order[start:end]
+
+    def child_ranks(self, idx):
+        """Return the set of ranks of the direct children of a node."""
+        return set(self.rank_names[np.unique(self.rank[self.children(idx)])])
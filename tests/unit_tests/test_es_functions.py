@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""Elasticsearch functions tests."""
+
+import threading
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import ujson
+from elastic_transport import ApiResponseMeta
+from elastic_transport import HttpHeaders
+from elastic_transport import JsonSerializer
+from elastic_transport import NodeConfig
+from elasticsearch import ApiError
+
+from genomehubs.lib import es_functions
+
+
+def api_error(status):
+    """Create an ApiError with a given status code."""
+    meta = ApiResponseMeta(
+        status=status,
+        http_version="1.1",
+        headers=HttpHeaders(),
+        duration=0,
+        node=NodeConfig("http", "localhost", 9200),
+    )
+    return ApiError("error", meta, {"error": {"type": "test_exception"}})
+
+
+def mock_es(bad_ids=()):
+    """Create a mock Elasticsearch client that rejects requests with bad_ids."""
+    es = MagicMock()
+    es.transport.serializers.get_serializer.return_value = JsonSerializer()
+    es.requests = []
+
+    def bulk(operations):
+        ids = [ujson.loads(op.split(b"\n")[0])["index"]["_id"] for op in operations]
+        es.requests.append(ids)
+        if any(doc_id in bad_ids for doc_id in ids):
+            raise api_error(400)
+        return {"items": [{"index": {"_id": doc_id, "status": 201}} for doc_id in ids]}
+
+    es.bulk.side_effect = bulk
+    return es
+
+
+def stream_docs(count):
+    """Stream a set of test documents."""
+    for i in range(count):
+        yield f"doc-{i}", {"value": i}
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_stream_limits_chunk_size(_indices_client):
+    """Test bulk requests contain no more than chunk_size documents."""
+    es = mock_es()
+    success, failed = es_functions.index_stream(
+        es, "test", stream_docs(25), chunk_size=10
+    )
+    assert (success, failed) == (25, 0)
+    assert [len(ids) for ids in es.requests] == [10, 10, 5]
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_stream_limits_chunk_bytes(_indices_client):
+    """Test bulk requests are split when they exceed max_chunk_bytes."""
+    es = mock_es()
+    success, failed = es_functions.index_stream(
+        es, "test", stream_docs(25), chunk_size=100, max_chunk_bytes=500
+    )
+    assert (success, failed) == (25, 0)
+    assert len(es.requests) > 1
+    assert sum(len(ids) for ids in es.requests) == 25
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_stream_isolates_failed_documents(_indices_client, tmp_path):
+    """Test failed chunks are bisected and bad documents are dead-lettered."""
+    es = mock_es(bad_ids={"doc-3", "doc-12"})
+    dead_letter = tmp_path / "dead_letter.jsonl"
+    success, failed = es_functions.index_stream(
+        es, "test", stream_docs(16), chunk_size=16, dead_letter=str(dead_letter)
+    )
+    assert (success, failed) == (14, 2)
+    entries = [ujson.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert sorted(entry["_id"] for entry in entries) == ["doc-12", "doc-3"]
+    assert all(entry["status"] == 400 and entry["size"] > 0 for entry in entries)
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_stream_threads(_indices_client):
+    """Test bulk requests can be sent using multiple threads."""
+    es = mock_es()
+    success, failed = es_functions.index_stream(
+        es, "test", stream_docs(100), chunk_size=7, threads=3
+    )
+    assert (success, failed) == (100, 0)
+    assert sorted(doc_id for ids in es.requests for doc_id in ids) == sorted(
+        f"doc-{i}" for i in range(100)
+    )
+
+
+@patch.object(es_functions, "index_exists", return_value=True)
+@patch.object(es_functions.client, "IndicesClient")
+def test_bulk_load_settings_restores_settings(indices_client, _index_exists):
+    """Test bulk load settings are applied and original settings restored."""
+    es_client = indices_client.return_value
+    es_client.get_settings.return_value = {
+        "test": {"settings": {"index.number_of_replicas": "1"}}
+    }
+    with es_functions.bulk_load_settings(MagicMock(), ["test"]):
+        es_client.put_settings.assert_called_once_with(
+            index="test", settings=es_functions.BULK_LOAD_SETTINGS
+        )
+    es_client.put_settings.assert_called_with(
+        index="test",
+        settings={"index.refresh_interval": None, "index.number_of_replicas": "1"},
+    )
+    es_client.refresh.assert_called_once_with(index="test")
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_bulk_load_settings_apply_to_created_indices(indices_client):
+    """Test indices created during bulk loading get bulk load settings."""
+    es_functions.invalidate_index_cache()
+    es_client = indices_client.return_value
+    es_client.exists.return_value = False
+    es_client.get_settings.return_value = {"new": {"settings": {}}}
+    with es_functions.bulk_load_settings(MagicMock(), ["new"]):
+        es_client.put_settings.assert_not_called()
+        es_client.create.side_effect = lambda **kwargs: setattr(
+            es_client.exists, "return_value", True
+        )
+        es_functions.index_create(MagicMock(), "new")
+        es_client.put_settings.assert_called_once_with(
+            index="new", settings=es_functions.BULK_LOAD_SETTINGS
+        )
+    es_client.put_settings.assert_called_with(
+        index="new",
+        settings={"index.refresh_interval": None, "index.number_of_replicas": None},
+    )
+    es_client.refresh.assert_called_once_with(index="new")
+    assert es_functions.BULK_LOAD == {"targets": set(), "saved": {}}
+    es_functions.invalidate_index_cache()
+
+
+def mock_search_es(count, first_page):
+    """Create a mock Elasticsearch client with count search hits."""
+    es = MagicMock()
+    hits = [{"_id": f"doc-{i}", "sort": [i]} for i in range(count)]
+    es.search_template.return_value = {
+        "hits": {"total": count, "hits": hits[:first_page]}
+    }
+    es.open_point_in_time.return_value = {"id": "pit"}
+    es.render_search_template.return_value = {"template_output": {"from": "0"}}
+
+    def search(body, **kwargs):
+        selected = hits
+        if "slice" in body:
+            slice_id, slice_max = body["slice"]["id"], body["slice"]["max"]
+            selected = [hit for hit in hits if hit["sort"][0] % slice_max == slice_id]
+        if "search_after" in body:
+            selected = [hit for hit in selected if hit["sort"] > body["search_after"]]
+        return {"pit_id": "pit", "hits": {"hits": selected[: body["size"]]}}
+
+    es.search.side_effect = search
+    return es
+
+
+def test_stream_template_search_results_single_page():
+    """Test results that fit in the first page do not open a point in time."""
+    es = mock_search_es(5, 5)
+    body = {"id": "test", "params": {}}
+    results = list(
+        es_functions.stream_template_search_results(es, index="test", body=body)
+    )
+    assert len(results) == 5
+    es.open_point_in_time.assert_not_called()
+
+
+def test_stream_template_search_results_point_in_time():
+    """Test larger result sets are paged using search_after."""
+    es = mock_search_es(25, 10)
+    body = {"id": "test", "params": {}}
+    results = list(
+        es_functions.stream_template_search_results(
+            es, index="test", body=body, size=10
+        )
+    )
+    assert [hit["_id"] for hit in results] == [f"doc-{i}" for i in range(25)]
+    assert es.search.call_count == 3
+    es.close_point_in_time.assert_called_once_with(body={"id": "pit"})
+
+
+def test_stream_template_search_results_capped_total():
+    """Test a full first page is paged on when the hit total is capped."""
+    es = mock_search_es(25, 10)
+    es.search_template.return_value["hits"]["total"] = 10
+    body = {"id": "test", "params": {}}
+    results = list(
+        es_functions.stream_template_search_results(
+            es, index="test", body=body, size=10
+        )
+    )
+    assert [hit["_id"] for hit in results] == [f"doc-{i}" for i in range(25)]
+    es.open_point_in_time.assert_called_once()
+
+
+def test_stream_template_search_results_slices():
+    """Test point in time slices are merged in order or as pages arrive."""
+    for ordered in (True, False):
+        es = mock_search_es(50, 10)
+        body = {"id": "test", "params": {}}
+        results = list(
+            es_functions.stream_template_search_results(
+                es, index="test", body=body, size=10, slices=3, ordered=ordered
+            )
+        )
+        ids = [hit["_id"] for hit in results]
+        expected = [f"doc-{i}" for i in range(50)]
+        assert ids == expected if ordered else sorted(ids) == sorted(expected)
+        es.close_point_in_time.assert_called_once_with(body={"id": "pit"})
+
+
+def test_stream_sliced_results_stop_before_closing_point_in_time():
+    """Test slice threads finish before the point in time is closed."""
+    es = mock_search_es(3000, 10)
+    search = es.search.side_effect
+    in_flight = []
+
+    def slow_search(body, **kwargs):
+        in_flight.append(True)
+        time.sleep(0.01)
+        in_flight.pop()
+        return search(body, **kwargs)
+
+    def close_point_in_time(body):
+        assert not in_flight
+        assert not [
+            thread
+            for thread in threading.enumerate()
+            if "prefetch_pages" in thread.name
+        ]
+
+    es.search.side_effect = slow_search
+    es.close_point_in_time.side_effect = close_point_in_time
+    for ordered in (True, False):
+        results = es_functions.stream_template_search_results(
+            es,
+            index="test",
+            body={"id": "test", "params": {}},
+            size=10,
+            slices=3,
+            ordered=ordered,
+        )
+        assert len([hit for hit, _ in zip(results, range(25))]) == 25
+        results.close()
+    assert es.close_point_in_time.call_count == 2
+
+
+@patch.object(es_functions, "Elasticsearch")
+def test_es_client_is_cached(elasticsearch):
+    """Test one client is created per set of hosts and reset by clear_clients."""
+    es_functions.clear_clients()
+    opts = {"es-host": ["localhost:9200", "https://remote:9200"], "es-compress": True}
+    es = es_functions.es_client(opts)
+    assert es_functions.es_client(opts) is es
+    hosts = elasticsearch.call_args.kwargs["hosts"]
+    assert hosts == ["http://localhost:9200", "https://remote:9200"]
+    assert elasticsearch.call_args.kwargs["http_compress"] is True
+    es_functions.clear_clients()
+    es_functions.es_client(opts)
+    assert elasticsearch.call_count == 2
+    es_functions.clear_clients()
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_exists_is_cached(indices_client):
+    """Test existing indices are cached until invalidated by index_create."""
+    es_functions.invalidate_index_cache()
+    es_client = indices_client.return_value
+    es_client.exists.return_value = False
+    assert not es_functions.index_exists(MagicMock(), "test")
+    es_client.exists.return_value = True
+    for _ in range(3):
+        assert es_functions.index_exists(MagicMock(), "test")
+    assert es_client.exists.call_count == 2
+    es_functions.index_create(MagicMock(), "test")
+    assert es_client.exists.call_count == 3
+    es_functions.invalidate_index_cache()
+
+
+def test_stream_msearch_template_preserves_order():
+    """Test batched multi search responses are yielded in input order."""
+    es = MagicMock()
+
+    def msearch_template(body, index):
+        lines = body.decode().splitlines()[1::2]
+        values = [ujson.loads(line)["params"]["value"] for line in lines]
+        return {"responses": [{"value": value} for value in values]}
+
+    es.msearch_template.side_effect = msearch_template
+    responses = es_functions.stream_msearch_template(
+        es,
+        "test_template",
+        "test",
+        ({"value": i} for i in range(53)),
+        batch_size=5,
+        threads=3,
+    )
+    assert [res["value"] for res in responses] == list(range(53))
+    assert es.msearch_template.call_count == 11
+
+
+@patch.object(es_functions.client, "IndicesClient")
+def test_index_stream_script_updates(_indices_client):
+    """Test update entries are sent as stored script params when script is set."""
+    es = mock_es()
+    bodies = []
+
+    def bulk(operations):
+        lines = [op.split(b"\n") for op in operations]
+        bodies.extend(ujson.loads(line[1]) for line in lines)
+        ids = [ujson.loads(line[0])["update"]["_id"] for line in lines]
+        return {"items": [{"update": {"_id": doc_id, "status": 200}} for doc_id in ids]}
+
+    es.bulk.side_effect = bulk
+    success, failed = es_functions.index_stream(
+        es, "test", stream_docs(3), _op_type="update", script="update_script"
+    )
+    assert (success, failed) == (3, 0)
+    assert bodies[1] == {"script": {"id": "update_script", "params": {"value": 1}}}
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""Fill tests."""
+
+from copy import deepcopy
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+import ujson
+
+from genomehubs.lib import fill
+from genomehubs.lib import profiler
+from genomehubs.lib.taxon_tree import TaxonTree
+
+TREE = [
+    ("1", None, "order", 0, None),
+    ("2", "1", "family", 1, None),
+    ("3", "1", "family", 1, None),
+    ("4", "2", "genus", 2, None),
+    ("5", "2", "genus", 2, None),
+    ("6", "4", "species", 3, [4, 6]),
+    ("7", "4", "species", 3, [10]),
+    ("8", "5", "species", 3, [1]),
+    ("9", "3", "genus", 2, None),
+    ("10", "9", "species", 3, None),
+    ("11", "4", "subspecies", 3, None),
+    ("12", "11", "strain", 4, [7]),
+]
+
+TEMPLATE = {
+    "index_name": "taxon",
+    "types": {
+        "attributes": {
+            "genome_size": {
+                "type": "long",
+                "summary": ["median", "min", "max"],
+                "traverse": "median",
+                "traverse_direction": "both",
+            }
+        }
+    },
+}
+
+
+def tree_nodes():
+    """Create a list of test nodes."""
+    nodes = []
+    for taxon_id, parent, rank, _depth, values in TREE:
+        source = {"taxon_id": taxon_id, "taxon_rank": rank, "scientific_name": rank}
+        if parent is not None:
+            source["parent"] = parent
+        if values is not None:
+            source["attributes"] = [
+                {
+                    "key": "genome_size",
+                    "values": [{"long_value": value} for value in values],
+                }
+            ]
+        nodes.append({"_id": f"taxon-{taxon_id}", "_source": source})
+    return nodes
+
+
+def sorted_value(value):
+    """Sort list values that are built from sets."""
+    return sorted(value) if isinstance(value, list) else value
+
+
+def nodes_by_depth(nodes, depth):
+    """Stream test nodes at a given depth."""
+    return [node for node, row in zip(nodes, TREE) if row[3] == depth]
+
+
+def test_taxon_tree_arrays():
+    """Test parent, depth and child rank arrays."""
+    tree = TaxonTree(tree_nodes(), ["genome_size"])
+    assert [int(depth) for depth in tree.depth] == [row[3] for row in TREE]
+    assert tree.taxon_ids[tree.parent[tree.index["12"]]] == "11"
+    assert tree.child_ranks(tree.index["4"]) == {"species", "subspecies"}
+    order = tree.bottom_up_order()
+    assert list(tree.depth[order]) == sorted(tree.depth, reverse=True)
+    active = tree.active()
+    assert not active[tree.index["9"]] and not active[tree.index["10"]]
+    assert active[tree.index["1"]] and active[tree.index["11"]]
+
+
+def test_traverse_in_memory_matches_traverse_from_tips():
+    """Test the in-memory engine yields the same documents as per-level queries."""
+    opts = {"traverse-limit": "null", "traverse-infer-both": True}
+    es_nodes = tree_nodes()
+    with patch.object(
+        fill,
+        "stream_nodes_by_root_depth",
+        side_effect=lambda es, depth, **kwargs: nodes_by_depth(es_nodes, depth),
+    ):
+        expected = dict(
+            fill.traverse_from_tips(
+                None, opts, template=deepcopy(TEMPLATE), root="1", max_depth=4
+            )
+        )
+    with patch.object(fill, "stream_nodes_by_root", return_value=tree_nodes()):
+        result = dict(
+            fill.traverse_in_memory(
+                None, opts, template=deepcopy(TEMPLATE), root="1", max_depth=4
+            )
+        )
+    assert result == expected
+    assert {"taxon-1", "taxon-10"} <= set(result)
+
+
+def test_traverse_in_memory_sketch_precision():
+    """Test sketch precision summarises all values in each subtree."""
+    opts = {"traverse-limit": "null", "traverse-infer-both": True}
+    template = deepcopy(TEMPLATE)
+    types = template["types"]["attributes"]
+    types["genome_size"]["summary_precision"] = "sketch"
+    fill.check_summary_precision(types)
+    with patch.object(fill, "stream_nodes_by_root", return_value=tree_nodes()):
+        result = dict(
+            fill.traverse_in_memory(
+                None, opts, template=template, root="1", max_depth=4
+            )
+        )
+    (attribute,) = result["taxon-1"]["attributes"]
+    assert attribute["long_value"] == 6
+    assert (attribute["min"], attribute["max"]) == (1, 10)
+    assert attribute["aggregation_method"] == "median"
+
+
+def test_traverse_changes_matches_full_traversal():
+    """Test recomputing changed lineages gives the same values as a full run."""
+    opts = {"traverse-limit": "null"}
+    nodes = tree_nodes()
+    with patch.object(fill, "stream_nodes_by_root", return_value=nodes):
+        list(
+            fill.traverse_in_memory(
+                None, opts, template=TEMPLATE, root="1", max_depth=4
+            )
+        )
+    (attribute,) = nodes[TREE.index(("8", "5", "species", 3, [1]))]["_source"][
+        "attributes"
+    ]
+    attribute["values"] = [{"long_value": 100}]
+    with patch.object(fill, "stream_nodes_by_root", return_value=deepcopy(nodes)):
+        expected = dict(
+            fill.traverse_in_memory(
+                None, opts, template=TEMPLATE, root="1", max_depth=4
+            )
+        )
+    changed = {"8", "5", "2", "1"}
+    tree = TaxonTree(
+        [node for node in nodes if node["_source"].get("parent", "1") in changed],
+        TEMPLATE["types"]["attributes"],
+    )
+    result = dict(
+        fill.traverse_changes(opts, template=TEMPLATE, tree=tree, changed=changed)
+    )
+    assert set(result) == {f"taxon-{taxon_id}" for taxon_id in changed}
+    fields = ("long_value", "count", "max", "min", "aggregation_source")
+    for doc_id, doc in result.items():
+        (attribute,) = doc["attributes"]
+        (expected_attribute,) = expected[doc_id]["attributes"]
+        assert [attribute.get(field) for field in fields] == [
+            expected_attribute.get(field) for field in fields
+        ]
+    assert result["taxon-1"]["attributes"][0]["long_value"] == 53.5
+
+
+def test_traverse_lineages_recomputes_sketch_summaries():
+    """Test changed lineages match a full run for sketch and hexbin summaries."""
+    opts = {"traverse-limit": "null", "traverse-root": "1"}
+    template = deepcopy(TEMPLATE)
+    types = template["types"]["attributes"]
+    types["genome_size"]["summary_precision"] = "sketch"
+    types["sample_location"] = {
+        "type": "geo_point",
+        "summary": ["list", "hexbin1", "hexbin3"],
+        "traverse": "list",
+        "traverse_direction": "up",
+    }
+    fill.check_summary_precision(types)
+    nodes = tree_nodes()
+    for taxon_id, location in (("6", "51.5,-0.12"), ("8", "-33.9,151.2")):
+        (node,) = [node for node in nodes if node["_source"]["taxon_id"] == taxon_id]
+        node["_source"]["attributes"].append(
+            {"key": "sample_location", "values": [{"geo_point_value": location}]}
+        )
+    with patch.object(fill, "stream_nodes_by_root", return_value=nodes):
+        list(
+            fill.traverse_in_memory(
+                None, opts, template=deepcopy(template), root="1", max_depth=4
+            )
+        )
+    (node,) = [node for node in nodes if node["_source"]["taxon_id"] == "8"]
+    node["_source"]["attributes"][0]["values"] = [{"long_value": 100}]
+    node["_source"]["attributes"][1]["values"] = [{"geo_point_value": "48.85,2.35"}]
+    with patch.object(fill, "stream_nodes_by_root", return_value=deepcopy(nodes)):
+        expected = dict(
+            fill.traverse_in_memory(
+                None, opts, template=deepcopy(template), root="1", max_depth=4
+            )
+        )
+    changed = {"8", "5", "2", "1"}
+    result = {}
+
+    def index_attribute_updates(es, opts, *, index, stream, attrs):
+        result.update(stream)
+
+    with patch.object(
+        fill, "stream_nodes_by_root", return_value=deepcopy(nodes)
+    ), patch.object(fill, "get_max_depth_by_lineage", return_value=4), patch.object(
+        fill, "index_attribute_updates", side_effect=index_attribute_updates
+    ):
+        fill.traverse_lineages(
+            None,
+            {**opts, "traverse-infer-ancestors": True},
+            deepcopy(template),
+            changed,
+        )
+    assert set(result) == {f"taxon-{taxon_id}" for taxon_id in changed}
+    fields = ("long_value", "geo_point_value", "hexbin1", "hexbin3", "count", "max")
+    for doc_id, doc in result.items():
+        for attribute, expected_attribute in zip(
+            doc["attributes"], expected[doc_id]["attributes"]
+        ):
+            assert [sorted_value(attribute.get(field)) for field in fields] == [
+                sorted_value(expected_attribute.get(field)) for field in fields
+            ]
+    attribute, location = result["taxon-1"]["attributes"]
+    assert attribute["long_value"] == 7
+    assert sorted(location["geo_point_value"]) == ["48.85,2.35", "51.5,-0.12"]
+
+
+def test_plan_subtrees_splits_large_subtrees():
+    """Test oversized subtrees are split and tasks are sorted largest first."""
+    children = {row[0]: [r[0] for r in TREE if r[1] == row[0]] for row in TREE}
+
+    def count(taxon_id):
+        return sum(count(child_id) + 1 for child_id in children[taxon_id])
+
+    with patch.object(
+        fill,
+        "stream_child_ids",
+        side_effect=lambda es, parent, **kwargs: iter(children[parent]),
+    ), patch.object(
+        fill,
+        "descendant_counts",
+        side_effect=lambda es, taxon_ids, **kwargs: {
+            taxon_id: count(taxon_id) for taxon_id in taxon_ids
+        },
+    ):
+        tasks, split, total = fill.plan_subtrees(
+            None, index="taxon", root="1", threads=1, opts={"traverse-depth": 0}
+        )
+    assert total == len(TREE)
+    assert split == {"1", "2", "3", "4", "5", "9", "11"}
+    assert sorted(root for roots, _size, _depth in tasks for root in roots) == sorted(
+        ["6", "7", "8", "10", "12"]
+    )
+    assert sum(size for _roots, size, _depth in tasks) == total - len(split)
+    assert [size for _roots, size, _depth in tasks] == sorted(
+        (size for _roots, size, _depth in tasks), reverse=True
+    )
+
+
+def test_descendant_counts_raise_on_failed_search():
+    """Test failed count searches are not treated as taxa with no descendants."""
+    es = MagicMock()
+    es.msearch_template.return_value = {
+        "responses": [
+            {"hits": {"total": {"value": 3, "relation": "eq"}}},
+            {"error": {"reason": "search timed out"}, "status": 504},
+        ]
+    }
+    assert fill.descendant_counts(es, index="test", taxon_ids=["2"], opts={}) == {
+        "2": 3
+    }
+    with pytest.raises(RuntimeError, match="search timed out"):
+        fill.descendant_counts(es, index="test", taxon_ids=["2", "3"], opts={})
+
+
+def test_connecting_pass_uses_subtree_state():
+    """Test values returned by subtree workers give the same result as one pass."""
+    opts = {"traverse-limit": "null"}
+    with patch.object(fill, "stream_nodes_by_root", return_value=tree_nodes()):
+        expected = dict(
+            fill.traverse_in_memory(
+                None, opts, template=TEMPLATE, root="1", max_depth=4
+            )
+        )
+    nodes = {node["_source"]["taxon_id"]: node for node in tree_nodes()}
+    subtrees = {
+        "3": ["3", "9", "10"],
+        "4": ["4", "6", "7", "11", "12"],
+        "5": ["5", "8"],
+    }
+    state = fill.subtree_state()
+    for root, taxon_ids in subtrees.items():
+        worker_state = fill.subtree_state()
+        subtree = [nodes[taxon_id] for taxon_id in taxon_ids]
+        with patch.object(fill, "stream_nodes_by_root", return_value=subtree):
+            list(
+                fill.traverse_in_memory(
+                    None,
+                    opts,
+                    template=TEMPLATE,
+                    root=root,
+                    max_depth=2,
+                    **worker_state,
+                )
+            )
+        fill.merge_subtree_state(state, fill.export_subtree_state(worker_state))
+    assert set(state["parents"]) == {"2"}
+    assert state["descendant_ranks"] == {"1": {"family"}, "2": {"genus"}}
+    split = {"1", "2"}
+    tree = TaxonTree([nodes["1"], nodes["2"]], TEMPLATE["types"]["attributes"])
+    result = dict(
+        fill.traverse_changes(
+            opts, template=TEMPLATE, tree=tree, changed=split, **state
+        )
+    )
+    for doc_id in ("taxon-1", "taxon-2"):
+        assert result[doc_id]["attributes"] == expected[doc_id]["attributes"]
+
+
+def test_stream_missing_attributes_at_level_batches_searches():
+    """Test descendant lookups for a level are sent as multi search batches."""
+    es = MagicMock()
+    descendants = {"2": ["4", "5"], "4": ["11"], "5": []}
+
+    def msearch_template(body, index):
+        lines = body.decode().splitlines()[1::2]
+        params = [ujson.loads(line)["params"] for line in lines]
+        return {
+            "responses": [
+                {
+                    "hits": {
+                        "hits": [
+                            {
+                                "_id": f"taxon-{taxon_id}",
+                                "_source": {"taxon_id": taxon_id},
+                            }
+                            for taxon_id in descendants[param["taxon_id"]]
+                        ]
+                    }
+                }
+                for param in params
+            ]
+        }
+
+    es.msearch_template.side_effect = msearch_template
+    nodes = [
+        {
+            "_source": {
+                "taxon_id": taxon_id,
+                "attributes": [
+                    {
+                        "key": "genome_size",
+                        "long_value": value,
+                        "count": 1,
+                        "aggregation_method": "median",
+                    }
+                ],
+            }
+        }
+        for taxon_id, value in (("2", 5), ("4", 7), ("5", 1))
+    ]
+    result = list(
+        fill.stream_missing_attributes_at_level(
+            es,
+            nodes=nodes,
+            attrs={"genome_size"},
+            template=TEMPLATE,
+            batch_size=2,
+            threads=1,
+        )
+    )
+    assert [(doc_id, doc["attributes"][0]["long_value"]) for doc_id, doc in result] == [
+        ("taxon-4", 5),
+        ("taxon-5", 5),
+        ("taxon-11", 7),
+    ]
+    assert result[0][1]["attributes"][0]["aggregation_source"] == "ancestor"
+    assert es.msearch_template.call_count == 2
+
+
+def test_stream_descendants_uses_page_size():
+    """Test batched descendant searches use the page size and page on when full."""
+    es = MagicMock()
+    descendants = {"2": ["4", "5", "6"], "3": ["7"]}
+
+    def msearch_template(body, index):
+        lines = body.decode().splitlines()[1::2]
+        params = [ujson.loads(line)["params"] for line in lines]
+        return {
+            "responses": [
+                {
+                    "hits": {
+                        "hits": [
+                            {"_id": f"taxon-{taxon_id}"}
+                            for taxon_id in descendants[param["taxon_id"]]
+                        ][: param["size"]]
+                    }
+                }
+                for param in params
+            ]
+        }
+
+    es.msearch_template.side_effect = msearch_template
+    with patch.object(
+        fill,
+        "stream_template_search_results",
+        return_value=[{"_id": f"taxon-{taxon_id}"} for taxon_id in descendants["2"]],
+    ) as stream_template_search_results:
+        results = fill.stream_descendant_nodes_missing_attributes(
+            es,
+            index="test",
+            ancestors=[("2", {"genome_size": {}}), ("3", {"genome_size": {}})],
+            size=2,
+        )
+        result = [
+            (taxon_id, [hit["_id"] for hit in hits])
+            for taxon_id, _attributes, hits in results
+        ]
+    assert result == [
+        ("2", ["taxon-4", "taxon-5", "taxon-6"]),
+        ("3", ["taxon-7"]),
+    ]
+    stream_template_search_results.assert_called_once()
+    assert stream_template_search_results.call_args.kwargs["size"] == 2
+
+
+def test_stream_descendants_raise_on_failed_search():
+    """Test failed descendant searches are not treated as complete taxa."""
+    es = MagicMock()
+    es.msearch_template.return_value = {
+        "responses": [{"error": {"reason": "too many clauses"}, "status": 400}]
+    }
+    results = fill.stream_descendant_nodes_missing_attributes(
+        es, index="test", ancestors=[("2", {"genome_size": {}})]
+    )
+    with pytest.raises(RuntimeError, match="too many clauses"):
+        list(results)
+
+
+def test_stream_nodes_by_parents_uses_page_size():
+    """Test child searches use the page size and page on when full."""
+    es = MagicMock()
+    children = {"2": ["4", "5", "6"], "3": ["7"]}
+
+    def msearch_template(body, index):
+        lines = body.decode().splitlines()[1::2]
+        params = [ujson.loads(line)["params"] for line in lines]
+        return {
+            "responses": [
+                {
+                    "hits": {
+                        "hits": [
+                            {"_id": f"taxon-{taxon_id}"}
+                            for taxon_id in children[param["taxon_id"]]
+                        ][: param["size"]]
+                    }
+                }
+                for param in params
+            ]
+        }
+
+    es.msearch_template.side_effect = msearch_template
+    with patch.object(
+        fill,
+        "stream_nodes_by_root_depth",
+        return_value=[{"_id": f"taxon-{taxon_id}"} for taxon_id in children["2"]],
+    ) as stream_nodes_by_root_depth:
+        hits = fill.stream_nodes_by_parents(
+            es, index="test", parents=["2", "3"], opts={"es-page-size": 2}
+        )
+        assert [hit["_id"] for hit in hits] == [
+            "taxon-4",
+            "taxon-5",
+            "taxon-6",
+            "taxon-7",
+        ]
+    stream_nodes_by_root_depth.assert_called_once()
+    assert stream_nodes_by_root_depth.call_args.kwargs["root"] == "2"
+    assert stream_nodes_by_root_depth.call_args.kwargs["size"] == 2
+
+
+def test_stream_nodes_by_parents_raises_on_failed_search():
+    """Test failed child searches are not treated as taxa with no children."""
+    es = MagicMock()
+    es.msearch_template.return_value = {
+        "responses": [
+            {"hits": {"hits": []}},
+            {"error": {"reason": "search rejected"}, "status": 429},
+        ]
+    }
+    with pytest.raises(RuntimeError, match="search rejected"):
+        list(
+            fill.stream_nodes_by_parents(es, index="test", parents=["2", "3"], opts={})
+        )
+
+
+def test_attribute_updates_send_only_filled_attributes():
+    """Test fill updates omit names, other attributes and raw values."""
+    source = {
+        "taxon_id": "6",
+        "scientific_name": "species",
+        "attributes": [
+            {"key": "genome_size", "long_value": 5, "values": [{"long_value": 5}]},
+            {"key": "other", "keyword_value": "x"},
+        ],
+    }
+    assert list(fill.attribute_updates([("taxon-6", source)], {"genome_size"})) == [
+        ("taxon-6", {"attributes": [{"key": "genome_size", "long_value": 5}]})
+    ]
+
+
+def test_hex_bin_uses_cached_cells():
+    """Test hexbins derive coarse cells from cached fine cells."""
+    coords = ["51.5,-0.12", "51.5,-0.12", [(48.85, 2.35)], "-33.9, 151.2"]
+    points = ((51.5, -0.12), (48.85, 2.35), (-33.9, 151.2))
+    fine_cells = {fill.latlng_to_cell(lat, lon, 6) for lat, lon in points}
+    assert sorted(fill.hex_bin(coords, 6)) == sorted(fine_cells)
+    for resolution in (1, 3):
+        assert sorted(fill.hex_bin(coords, resolution)) == sorted(
+            {fill.cell_to_parent(cell, resolution) for cell in fine_cells}
+        )
+    assert fill.coordinate_cell.cache_info().hits > 0
+    assert fill.coordinate_cell.cache_info().maxsize == fill.HEXBIN_CACHE_SIZE
+
+
+def test_profile_records_costs_by_depth(tmp_path, capsys):
+    """Test profiling counts nodes by depth and value list sizes by attribute."""
+    opts = {"traverse-limit": "null"}
+    es_nodes = tree_nodes()
+    profile = profiler.start_profile()
+    try:
+        with patch.object(
+            fill,
+            "stream_nodes_by_root_depth",
+            side_effect=lambda es, depth, **kwargs: nodes_by_depth(es_nodes, depth),
+        ):
+            list(
+                fill.traverse_from_tips(
+                    None, opts, template=deepcopy(TEMPLATE), root="1", max_depth=4
+                )
+            )
+        worker = profiler.start_profile(offset=2)
+        worker.set_depth(1)
+        worker.nodes[worker.depth] += 3
+        profile.merge(profiler.stop_profile())
+    finally:
+        profiler.PROFILE = None
+    profile.report(tmp_path / "profile.json")
+    with open(tmp_path / "profile.json") as fh:
+        report = ujson.load(fh)
+    nodes = {entry["depth"]: entry["nodes"] for entry in report["depths"]}
+    assert nodes == {0: 1, 1: 2, 2: 3, 3: 5 + 3, 4: 1}
+    genome_size = report["attributes"]["genome_size"]
+    assert genome_size["values"] >= 5
+    assert genome_size["max_values"] == 3
+    assert report["peak_rss_bytes"] > 0
+    assert "genome_size" in capsys.readouterr().out
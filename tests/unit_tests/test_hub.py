@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Hub tests."""
+
+from collections import defaultdict
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from genomehubs.lib import hub
+
+TYPES = {
+    "defaults": {},
+    "attributes": {
+        "assembly_level": {
+            "index": 1,
+            "type": "keyword",
+            "constraint": {"enum": ["chromosome", "contig"]},
+            "translate": {"complete genome": "chromosome"},
+        },
+        "busco_lineage": {"index": 2, "separator": [";", ","], "limit": 2},
+        "genome_size": {"index": 3, "type": "long", "constraint": {"min": 1}},
+    },
+    "identifiers": {"assembly_id": {"index": [0, 4], "join": "."}},
+    "metadata": {"source": "test"},
+    "taxonomy": {"taxon_id": {"index": 5}},
+}
+
+
+def test_process_row_with_compiled_plan():
+    """Test a compiled plan extracts, splits, translates and validates values."""
+    plan = hub.compile_row_plan(TYPES)
+    blanks = {"", "NA", None}
+    row = ["GCA_1", "Complete Genome", "a;b;c", "0", "1", "9606"]
+    data, _taxon_data, _taxon_types = hub.process_row(
+        TYPES, {}, row, None, blanks, index_type="assembly", plan=plan
+    )
+    assert data["identifiers"][0]["identifier"] == "GCA_1.1"
+    assert [
+        {key: attribute[key] for key in attribute if key.endswith("_value")}
+        for attribute in data["attributes"]
+    ] == [
+        {"keyword_value": "chromosome"},
+        {"keyword_value": ["a", "b"]},
+    ]
+    assert data["taxonomy"] == {"taxon_id": "9606"}
+    row[1] = "scaffold"
+    data, _taxon_data, _taxon_types = hub.process_row(
+        TYPES, {}, row, None, blanks, index_type="assembly", plan=plan
+    )
+    assert [attribute["key"] for attribute in data["attributes"]] == ["busco_lineage"]
+    assert hub.process_row(TYPES, {}, row[:3], None, blanks, plan=plan) == (
+        None,
+        None,
+        None,
+    )
+
+
+def attribute_value_response(value):
+    """Build an attribute value query response."""
+    inner_hits = [{"fields": {"attributes.long_value": [value]}}]
+    return {
+        "hits": {
+            "hits": [{"inner_hits": {"length_values": {"hits": {"hits": inner_hits}}}}]
+        }
+    }
+
+
+@patch.object(hub, "attribute_value_query")
+@patch.object(hub, "stream_msearch_template")
+def test_prefetch_attribute_values(stream_msearch_template, attribute_value_query):
+    """Test attribute values for function templates are fetched once per block."""
+    types = {
+        "attributes": {
+            "length": {"type": "long"},
+            "midpoint": {"index": 1, "type": "long"},
+            "proportion": {
+                "index": 0,
+                "type": "float",
+                "function": "{midpoint} / {.length}",
+            },
+        },
+    }
+    stream_msearch_template.side_effect = lambda es, name, index, params, **kwargs: [
+        (
+            attribute_value_response(100)
+            if p["primary_id"] == "chr1"
+            else {"hits": {"hits": []}}
+        )
+        for p in params
+    ]
+    shared_values = defaultdict(dict)
+    shared_values.update(
+        {
+            "_es": MagicMock(),
+            "_opts": {},
+            "_index": "feature--ncbi--test--1",
+            "_index_type": "feature",
+            "_types": types,
+            "_attribute_values": hub.AttributeValueCache(size=2),
+        }
+    )
+    plan = hub.compile_row_plan(types)
+    assert plan["lookups"] == [(0, None, None, None, ["length"])]
+    rows = [["chr1", "10"], ["chr1", "50"], ["chr2", "5"]]
+    hub.prefetch_attribute_values(rows, plan, shared_values)
+    hub.prefetch_attribute_values(rows[:2], plan, shared_values)
+    assert stream_msearch_template.call_count == 1
+    (_es, name, _index, params), _kwargs = stream_msearch_template.call_args
+    assert name == "attribute_value_by_primary_id"
+    assert [p["primary_id"] for p in params] == ["chr1", "chr2"]
+    assert hub.apply_template("chr1", "{.length}", {}, shared_values) == "100"
+    attribute_value_query.assert_not_called()
+    attribute_value_query.return_value = attribute_value_response(200)
+    assert hub.apply_template("chr3", "{.length}", {}, shared_values) == "200"
+    assert len(shared_values["_attribute_values"]) == 2
+    assert ("chr1", "length") in shared_values["_attribute_values"]
+    assert ("chr2", "length") not in shared_values["_attribute_values"]
+
+
+@patch.object(hub, "attribute_value_query")
+def test_attribute_value_found_after_miss(attribute_value_query):
+    """Test attribute values that were missing are found once indexed."""
+    shared_values = defaultdict(dict)
+    shared_values.update(
+        {
+            "_es": MagicMock(),
+            "_index": "feature--ncbi--test--1",
+            "_index_type": "feature",
+            "_types": {"attributes": {"length": {"type": "long"}}},
+            "_attribute_values": hub.AttributeValueCache(),
+        }
+    )
+    attribute_value_query.return_value = {"hits": {"hits": []}}
+    assert hub.lookup_attribute_value("chr1", "length", shared_values) is None
+    attribute_value_query.return_value = attribute_value_response(100)
+    assert hub.apply_template("chr1", "{.length}", {}, shared_values) == "100"
+    assert hub.apply_template("chr1", "{.length}", {}, shared_values) == "100"
+    assert attribute_value_query.call_count == 2
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Index tests."""
+
+import io
+from unittest.mock import patch
+
+from genomehubs.lib import index
+
+TYPES = {
+    "file": {"format": "tsv", "header": True},
+    "defaults": {},
+    "attributes": {"genome_size": {"index": 1, "type": "long"}},
+    "taxonomy": {"taxon_id": {"index": 0}},
+}
+
+
+def test_process_rows_in_parallel_keeps_row_order():
+    """Test rows processed in worker processes match serial processing."""
+    rows = [[str(idx), "x" if idx % 7 == 0 else str(idx * 10)] for idx in range(50)]
+    rows[13] = ["13"]
+    kwargs = {
+        "types": TYPES,
+        "names": {},
+        "shared_values": None,
+        "blanks": {"", "NA", None},
+        "index_type": "taxon",
+        "exclusions": None,
+    }
+    expected = list(index.process_rows([rows], **kwargs))
+    result = list(
+        index.process_rows(index.row_blocks(iter(rows), 4), threads=2, **kwargs)
+    )
+    assert [row for row, _result, _error in result] == rows
+    assert result == expected
+    assert expected[1][1][0]["attributes"] == [
+        {"key": "genome_size", "long_value": 10, "metadata": {}}
+    ]
+
+
+def test_index_file_in_windows():
+    """Test rows with taxon IDs are indexed in windows and imported rows appended."""
+    types = {
+        **TYPES,
+        "file": {"format": "tsv", "header": False, "name": "test.tsv"},
+    }
+    data = io.StringIO("".join(f"{idx}\t{idx * 10}\n" for idx in range(1, 6)))
+    opts = {
+        "index": "taxon",
+        "taxonomy-source": "ncbi",
+        "hub-name": "test",
+        "hub-version": "v1",
+        "hub-separator": "--",
+        "index-window": 2,
+    }
+    with patch.object(index, "index_records") as index_records, patch.object(
+        index, "write_imported_rows"
+    ) as write_imported_rows, patch.object(
+        index, "fix_missing_ids", return_value=({}, {})
+    ), patch.object(
+        index, "write_spellchecked_taxa"
+    ), patch.object(
+        index, "write_imported_taxa"
+    ):
+        index.index_file(None, types, {}, data, opts)
+    windows = [sorted(call.args[3]) for call in index_records.call_args_list]
+    assert windows == [["1", "2"], ["3", "4"], ["5"]]
+    assert [call.kwargs["append"] for call in write_imported_rows.call_args_list] == [
+        False,
+        True,
+        True,
+    ]
+    assert all(
+        call.args[2]["es-skip-refresh"] is False
+        for call in index_records.call_args_list[:2]
+    )
+
+
+def test_index_feature_records_refreshes_for_lookups():
+    """Test feature records are refreshed after indexing even when bulk loading."""
+    opts = {
+        "taxonomy-source": "ncbi",
+        "hub-name": "test",
+        "hub-version": "v1",
+        "hub-separator": "--",
+        "es-bulk-load": True,
+    }
+    with patch.object(index, "index_stream") as index_stream:
+        index.index_feature_records(None, opts, "ncbi", {}, set())
+    assert index_stream.call_args.kwargs["refresh"] is True
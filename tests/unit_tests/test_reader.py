@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Reader tests."""
+
+import csv
+import io
+from itertools import chain
+from pathlib import Path
+
+from genomehubs.lib import reader
+from genomehubs.lib.hub import strip_comments
+from genomehubs.vendor.tolkein import tofile
+
+DATA_DIR = Path(__file__).parents[1] / "integration_tests" / "data"
+DELIMITERS = {"csv": ",", "tsv": "\t"}
+
+
+def csv_rows(path, types):
+    """Read rows from a file using csv.reader."""
+    data = tofile.open_file_handle(path)
+    delimiter = DELIMITERS[types["file"]["format"]]
+    return list(
+        csv.reader(strip_comments(data, types), delimiter=delimiter, quotechar='"')
+    )
+
+
+def block_rows(path, types, size):
+    """Read rows from a file in blocks."""
+    blocks = reader.read_blocks(
+        tofile.open_file_handle(path),
+        delimiter=DELIMITERS[types["file"]["format"]],
+        comment_chars=reader.comment_characters(types),
+        size=size,
+    )
+    return list(chain.from_iterable(blocks))
+
+
+def test_read_blocks_matches_csv_reader():
+    """Test rows read in blocks match csv.reader for integration test data."""
+    files = 0
+    for types_file in sorted(DATA_DIR.glob("**/*.types.yaml")):
+        types = tofile.load_yaml(str(types_file))
+        path = types_file.parent / types.get("file", {}).get("name", "")
+        if not path.is_file():
+            continue
+        files += 1
+        expected = csv_rows(path, types)
+        for size in (1, 4096, reader.BLOCK_CHARS):
+            assert block_rows(path, types, size) == expected, f"{path} ({size})"
+    assert files > 0
+
+
+def test_read_blocks_with_quoted_lines():
+    """Test quoted fields spanning lines and comments are read as by csv.reader."""
+    text = '#comment\na\tb\n\nc\t"d\n#e"\n"f""g"\th\n#end\ni\t"j'
+    types = {"file": {"format": "tsv", "comment": "!"}}
+    expected = list(
+        csv.reader(strip_comments(io.StringIO(text), types), delimiter="\t")
+    )
+    for size in (1, 8, 100):
+        blocks = reader.read_blocks(
+            io.StringIO(text),
+            delimiter="\t",
+            comment_chars=reader.comment_characters(types),
+            size=size,
+        )
+        assert list(chain.from_iterable(blocks)) == expected
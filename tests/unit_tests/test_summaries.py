@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Summary statistics tests."""
+
+import random
+import statistics
+
+from genomehubs.lib import summaries
+
+FUNCTIONS = {
+    summaries.vector_mean: statistics.mean,
+    summaries.vector_median: statistics.median,
+    summaries.vector_median_high: statistics.median_high,
+    summaries.vector_median_low: statistics.median_low,
+}
+
+
+def value_lists():
+    """Generate lists of values to summarise."""
+    rng = random.Random(42)
+    for length in (1, 2, 31, 32, 33, 100, 1000, 1001):
+        yield [rng.randint(0, 20) for _ in range(length)]
+        yield [rng.randint(-(10**12), 10**12) for _ in range(length)]
+        yield [rng.choice([0.1, 0.2, 0.3, 1e-9, 2.5e10]) for _ in range(length)]
+        yield [rng.gauss(1e6, 1e5) for _ in range(length)]
+        yield [rng.choice([1, 2.0, 3]) for _ in range(length)]
+        yield [rng.choice([0.0, -0.0, 1.5]) for _ in range(length)]
+    yield [2**63 + i for i in range(40)]
+
+
+def test_vector_summaries_match_python_summaries():
+    """Test vectorised summaries give identical values and types."""
+    for values in value_lists():
+        for vector_function, function in FUNCTIONS.items():
+            expected = function(values)
+            result = vector_function(values)
+            assert (result, type(result)) == (expected, type(expected))
+
+
+def test_value_sketch_is_exact_until_compacted():
+    """Test small sketches give the same values as statistics functions."""
+    for values in value_lists():
+        if len(values) > summaries.QUANTILE_SKETCH_SIZE or len(set(values)) > 64:
+            continue
+        sketch = summaries.ValueSketch().update(values)
+        assert sketch.median() == statistics.median(values)
+        assert sketch.median_low() == statistics.median_low(values)
+        assert sketch.mode() == statistics.mode(values)
+        assert sketch.summary("sum") == sum(values)
+
+
+def test_value_sketch_merge():
+    """Test merged sketches keep exact totals and bounded quantile error."""
+    rng = random.Random(42)
+    values = [rng.randint(0, 10**6) for _ in range(20000)] + [7] * 2000
+    sketch = summaries.ValueSketch()
+    for start in range(0, len(values), 500):
+        sketch.merge(summaries.ValueSketch().update(values[start : start + 500]))
+    assert sketch.count == len(values)
+    assert sketch.summary("sum") == sum(values)
+    assert (sketch.min, sketch.max) == (min(values), max(values))
+    assert sketch.summary("mean") == statistics.mean(values)
+    rank = sorted(values).index(sketch.median_high())
+    assert abs(rank - len(values) // 2) < len(values) * 0.02
+    assert sketch.mode() == 7
+    assert sum(len(level) for level in sketch.levels) < 3000
+
+
+def test_value_sketch_mode_with_tied_counts():
+    """Test sketches with more distinct tied values than counters keep a mode."""
+    sketch = summaries.ValueSketch().update(range(100))
+    assert len(sketch.frequencies) == summaries.MODE_SKETCH_SIZE
+    assert sketch.mode() in range(100)
+    merged = summaries.ValueSketch()
+    for start in range(0, 1000, 100):
+        merged.merge(
+            summaries.ValueSketch().update(list(range(start, start + 100)) * 2)
+        )
+    assert merged.mode() in range(1000)
+    merged.update([12345] * 50)
+    assert merged.mode() == 12345
+    assert summaries.ValueSketch().mode() is None